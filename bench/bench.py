@@ -0,0 +1,406 @@
+#!/usr/bin/env python
+"""Time the client's parse, store, query, pathfinding and redraw code."""
+
+#    Copyright (C) 1998-1999 Kevin O'Connor
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import sys
+import os
+import getopt
+import string
+import time
+import tempfile
+
+# Key Ideas:
+
+
+# What is contained within this file:
+
+# This file contains a set of benchmarks for the hot paths of the client.
+# Each benchmark is run against synthetic worlds of one or more sizes.  The
+# worlds are built by empServer.World, so the dumps have the same fields
+# that a real server reports.  Every result is printed as one line of JSON
+# so that results from different releases can be compared by a script.
+# (See bench/README.)
+
+sys.path[0] = os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])),
+                           os.pardir, "src")
+
+import empDb
+import empQueue
+import empParse
+import empEval
+import empPath
+import empSector
+import empServer
+
+
+###########################################################################
+#############################  Helpers        #############################
+class NullOut:
+    """A display class that discards everything."""
+    Begin = data = End = flush = Answer = Process = empQueue.doNothing
+    inform = flash = Error = empQueue.doNothing
+
+def newWorld(width, height):
+    """Build a synthetic world and load it into a new megaDB."""
+    units = width * height / 20
+    world = empServer.World(width, height, units, units, units)
+    loadWorld(world)
+    return world
+
+def loadWorld(world, sectors=1):
+    """Reset megaDB and load WORLD into it.
+
+    If SECTORS is false, the sector table is left empty.
+    """
+    empDb.DBIO.reset()
+    empDb.DBIO.resetUpdate()
+    megaDB = empDb.megaDB
+    megaDB['version']['worldsize'] = (world.width, world.height)
+    megaDB['nation']['capital'] = (0, 0)
+    dumps = [("sdump *", 'SHIPS'), ("pdump *", 'PLANES'),
+             ("ldump *", 'LAND UNITS')]
+    if sectors:
+        dumps.insert(0, ("dump *", 'SECTOR'))
+    for cmd, dbname in dumps:
+        parseDump(cmd, world.dump(dbname))
+    parseDump("show sect stats", world.sectorStats(), empParse.ParseShow)
+
+def parseDump(cmd, lines, parserClass=empParse.ParseDump):
+    """Run the output LINES through a parser."""
+    parser = parserClass(NullOut())
+    parser.Begin(cmd)
+    data = parser.data
+    for line in lines:
+        data(line)
+    parser.End(cmd)
+
+def decodeRows(lines):
+    """Return the rows of a dump as the dictionaries dictDB.updates takes."""
+    fields = string.split(lines[2])
+    rows = []
+    for line in lines[3:-1]:
+        row = {}
+        values = string.split(line)
+        for i in range(len(fields)):
+            row[fields[i]] = empParse.convertValue(values[i])
+        row['owner'] = empDb.CN_OWNED
+        rows.append(row)
+    return rows
+
+class CanvasStub:
+    """A canvas that only counts the items drawn on it.
+
+    The options are read from the TkOption file, so the map draws the same
+    items it would in the real client.
+    """
+    def __init__(self, optionFile):
+        self.options = {}
+        self.items = 0
+        prefix = "Ptkei*Map.sectors."
+        lines = open(optionFile).readlines()
+        i = 0
+        while i < len(lines):
+            line = string.strip(lines[i])
+            while line[-1:] == "\\" and i + 1 < len(lines):
+                i = i + 1
+                line = line[:-1] + " " + string.strip(lines[i])
+            i = i + 1
+            if line[:len(prefix)] != prefix:
+                continue
+            pos = string.find(line, ":")
+            if pos == -1:
+                continue
+            name = string.strip(line[len(prefix):pos])
+            self.options[name] = string.strip(line[pos+1:])
+
+    def option_get(self, name, className):
+        return self.options.get(name, self.options.get(className, ""))
+
+    def create(self, *args, **kw):
+        self.items = self.items + 1
+        return self.items
+    create_arc = create_bitmap = create_image = create_line = create
+    create_oval = create_polygon = create_rectangle = create_text = create
+
+    def find_enclosed(self, *args):
+        return ()
+
+    def xview(self, *args):
+        return (0.0, 1.0)
+    yview = xview
+
+    def __setitem__(self, key, value):
+        pass
+
+    delete = lower = lift = empQueue.doNothing
+
+def headlessMap(optionFile):
+    """Return a MapWin.mapSubWin that draws on a CanvasStub."""
+    import MapWin
+    class HeadlessMap(MapWin.mapSubWin):
+        def __init__(self, canvas):
+            self.maxCoord = empDb.megaDB['version']['worldsize']
+            self.origin = (self.maxCoord[0]/2, self.maxCoord[1]/2)
+            self.Map = canvas
+            self.gridsize = [18.0, 24.0]
+            self.combatmode = 0
+            self.optionsDict = {}
+            self.changed = {}
+    return HeadlessMap(CanvasStub(optionFile))
+
+###########################################################################
+#############################  Benchmarks     #############################
+
+# Each benchmark function is given the world and returns a (setup, run)
+# pair.  setup() is called before each timed call of run(); run() returns
+# the number of items it processed.
+
+def benchParseFull(world):
+    lines = world.dump('SECTOR')
+    def setup(world=world):
+        loadWorld(world, 0)
+    def run(lines=lines):
+        parseDump("dump *", lines)
+        return len(lines) - 4
+    return setup, run
+
+def benchParseTimestamp(world):
+    since = world.now
+    world.now = world.now + 1
+    world.churn(len(world.coords) / 10)
+    lines = world.dump('SECTOR', since)
+    cmd = "dump * ?timestamp>%d" % since
+    def run(lines=lines, cmd=cmd):
+        parseDump(cmd, lines)
+        return len(lines) - 4
+    return None, run
+
+def benchUpdates(world):
+    rows = decodeRows(world.dump('SECTOR'))
+    def run(rows=rows):
+        empDb.megaDB['SECTOR'].updates(rows)
+        return len(rows)
+    return None, run
+
+def benchUpdatesSeen(world):
+    rows = decodeRows(world.dump('SECTOR'))
+    def run(rows=rows):
+        db = empDb.megaDB['SECTOR']
+        seen = {}
+        db.updates(rows, seen)
+        db.unseen(seen)
+        return len(rows)
+    return None, run
+
+def benchGetSectors(world):
+    exprs = map(lambda s: "owner==-1 and " + empEval.selectToExpr(
+        'SECTOR', '*', s), ("des=m", "mob>50&civ>500", "food<100",
+                            "des=g&eff>=60"))
+    def run(exprs=exprs):
+        count = 0
+        for expr in exprs:
+            count = count + len(empEval.getSectors(expr, 'SECTOR'))
+        return count
+    return None, run
+
+def benchForeach(world):
+    cond = "owner==-1 and " + empEval.selectToExpr('SECTOR', '*',
+                                                    'food>100')
+    txt = "(xloc+0,yloc+0), __db[1], int(food-100), int(mob-20)"
+    def run(cond=cond, txt=txt):
+        return len(empEval.foreach(cond, txt, 'SECTOR'))
+    return None, run
+
+def benchMoveGenerator(world):
+    area = "-8:8,-8:8"
+    slist = empEval.foreach(
+        "owner==-1 and " + empEval.selectToExpr('SECTOR', area, 'food>500'),
+        "(xloc+0,yloc+0), __db[1], int(food-500), int(mob-20)", 'SECTOR')
+    dlist = empEval.foreach(
+        "owner==-1 and " + empEval.selectToExpr('SECTOR', area, 'food<200'),
+        "(xloc+0,yloc+0), __db[1], int(200-food)", 'SECTOR')
+    ddict = {}
+    for coord, db, amount in dlist:
+        if amount > 0 and empSector.is_movable_into(db, 'food'):
+            ddict[coord] = amount
+    sdict = {}
+    for coord, db, amount, mobility in slist:
+        if (amount > 0 and mobility > 0 and not ddict.has_key(coord)
+            and empSector.is_movable_from(db, 'food')):
+            sdict[coord] = (amount, mobility,
+                            empSector.move_weight(db, 'food'))
+    def run(sdict=sdict, ddict=ddict):
+        mmove = empPath.MoveGenerator('food', sdict.copy(), ddict.copy())
+        count = 0
+        while not mmove.empty():
+            count = count + 1
+            mmove.next()
+        return count
+    return None, run
+
+def benchSave(world):
+    filename = tempFile()
+    def setup(filename=filename):
+        empDb.DBIO.filename = filename
+        empDb.DBIO.needSave = 1
+    def run(filename=filename):
+        quiet(empDb.DBIO.save)
+        return len(empDb.megaDB['SECTOR'].keys())
+    return setup, run
+
+def benchLoad(world):
+    filename = tempFile()
+    empDb.DBIO.filename = filename
+    empDb.DBIO.needSave = 1
+    quiet(empDb.DBIO.save)
+    def run(filename=filename):
+        empDb.DBIO.load(filename)
+        # Force the sectors to be unpickled.
+        return len(empDb.megaDB['SECTOR'].keys())
+    return None, run
+
+optionFile = os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])),
+                          os.pardir, "TkOption")
+
+def benchRedraw(world):
+    win = headlessMap(optionFile)
+    def run(win=win):
+        win.redraw(1)
+        return win.Map.items
+    def setup(win=win):
+        win.Map.items = 0
+    return setup, run
+
+def benchRedrawChanged(world):
+    win = headlessMap(optionFile)
+    keys = empDb.megaDB['SECTOR'].keys()[::100]
+    def setup(win=win, keys=keys):
+        win.Map.items = 0
+        changed = {}
+        for key in keys:
+            changed[key] = {'des': (None, None)}
+        win.changed = {'SECTOR': changed}
+    def run(win=win):
+        win.redraw(0)
+        return win.Map.items
+    return setup, run
+
+# Database files written by the benchmarks; removed on exit.
+tempFiles = []
+
+def tempFile():
+    """Return the name of a new temporary file."""
+    filename = tempfile.mktemp()
+    tempFiles.append(filename)
+    return filename
+
+def quiet(func):
+    """Call FUNC with its standard output discarded."""
+    stdout = sys.stdout
+    sys.stdout = NullOut()
+    sys.stdout.write = empQueue.doNothing
+    try:
+        func()
+    finally:
+        sys.stdout = stdout
+
+# The benchmarks in the order they are run.  Each benchmark leaves the
+# database in the state the next one expects.
+benchmarks = (
+    ('parse_full', benchParseFull),
+    ('parse_timestamp', benchParseTimestamp),
+    ('updates', benchUpdates),
+    ('updates_seen', benchUpdatesSeen),
+    ('getsectors', benchGetSectors),
+    ('foreach', benchForeach),
+    ('movegen', benchMoveGenerator),
+    ('redraw', benchRedraw),
+    ('redraw_changed', benchRedrawChanged),
+    ('save', benchSave),
+    ('load', benchLoad),
+    )
+
+###########################################################################
+#############################  Main           #############################
+
+def runBenchmark(name, func, world, size, repeat, out):
+    setup, run = func(world)
+    times = []
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.time()
+        count = run()
+        times.append(time.time() - start)
+    best = min(times)
+    result = {'bench': name, 'size': size, 'runs': repeat,
+              'best': best, 'mean': reduce(lambda a, b: a+b, times) / repeat,
+              'items': count, 'time': int(time.time()),
+              'python': string.split(sys.version)[0]}
+    if best > 0:
+        result['rate'] = count / best
+    out.write(empQueue.jsonEncode(result) + "\n")
+    out.flush()
+
+def main():
+    usage = ("Usage:\n" + str(sys.argv[0])
+             + " [-s <width>x<height>[,...]] [-n <repeat>] [-o <file>]"
+             + " [<benchmark> ...]")
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 's:n:o:lh?')
+    except getopt.error:
+        print usage
+        sys.exit(1)
+    sizes = ["64x32", "128x128", "256x256"]
+    repeat = 3
+    out = sys.stdout
+    for i, j in opts:
+        if i == '-s':
+            sizes = string.split(j, ",")
+        elif i == '-n':
+            repeat = int(j)
+        elif i == '-o':
+            out = open(j, 'a')
+        elif i == '-l':
+            for name, func in benchmarks:
+                print name
+            return
+        else:
+            print usage
+            return
+    names = map(lambda b: b[0], benchmarks)
+    for i in args:
+        if i not in names:
+            print "Unknown benchmark '%s'.  (Use -l to list them.)" % i
+            sys.exit(1)
+
+    empDb.viewer = empQueue.viewer = NullOut()
+    try:
+        for size in sizes:
+            width, height = map(int, string.split(size, "x"))
+            world = newWorld(width, height)
+            for name, func in benchmarks:
+                if not args or name in args:
+                    runBenchmark(name, func, world, size, repeat, out)
+    finally:
+        for filename in tempFiles:
+            if os.path.exists(filename):
+                os.unlink(filename)
+
+if __name__=='__main__':
+    main()
@@ -97,7 +97,8 @@ def initialize():
 
     # Check command line for the database filename.
     usage = ("Usage:\n"
-             + str(sys.argv[0]) + " [-v] [-l] [-t|-c|-x] [-n] [-I <include directory>] "
+             + str(sys.argv[0]) + " [-v] [-l] [-t|-c|-x] [-n] [-j] [-C] [-H] "
+             +"[-I <include directory>] "
              +"[<database filename>]")
     versionText = """Python/Tk Empire Interface (PTkEI) %s
 Copyright (C) 1998-2002 Kevin O'Connor and others.
@@ -129,7 +130,7 @@ To contact the developers, please mail to <laurent@lfmm.org>.
 
 
     try:
-        opts, args = getopt.getopt(sys.argv[1:], 'vltcxnh?I:', ['help'])
+        opts, args = getopt.getopt(sys.argv[1:], 'vltcxnjCHh?I:', ['help'])
     except getopt.error:
         print usage
         sys.exit()
@@ -190,6 +191,14 @@ To contact the developers, please mail to <laurent@lfmm.org>.
     # Hack!  Pass on the pathPrefix function
     empQueue.pathPrefix = pathPrefix
 
+    # Check for a request to journal database changes.
+    empDb.DBIO.journalMode = ('-j' in argnames)
+    # Check for a request to store sectors in compact columns.
+    if '-C' in argnames:
+        empDb.DBIO.sectorClass = empDb.columnDB
+    # Check for a request to record the history of the sectors and units.
+    empDb.DBIO.historyMode = ('-H' in argnames)
+
     # Load the database.
     try:
         empDb.DBIO.load(FILE)
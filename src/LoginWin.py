@@ -381,6 +381,12 @@ class QueueStatus:
 
         self.queueStatus.set(status)
 
+        # Periodically save the database in the background.
+        try:
+            empDb.DBIO.checkAutoSave()
+        except:
+            empQueue.flashException()
+
     def DoSetRaw(self):
         viewer.ioq.raw = (self.raw.get() == 1)
 
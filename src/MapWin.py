@@ -119,9 +119,33 @@ class mapSubWin:
 
         # Register automatic updating
         viewer.updateList.append(self)
+        self.changed = {}
+        self.feeds = []
+        for dbname, fields in (
+            ('SECTOR', ('des', 'sdes', 'owner', 'oldown', 'mob')),
+            ('LAND UNITS', self.unitFields), ('SHIPS', self.unitFields),
+            ('PLANES', self.unitFields), ('NUKES', self.unitFields)):
+            self.feeds.append(empDb.subscribe(dbname, self.noteChanges,
+                                              fields=fields))
 
         self.redraw(1)
 
+    # Unit fields that are shown on the map.
+    unitFields = ('x', 'y', 'owner', 'id', 'type')
+
+    def noteChanges(self, dbname, events):
+        """empDb change feed: Note the items that need to be redrawn."""
+        try:
+            self.changed[dbname].update(events)
+        except KeyError:
+            self.changed[dbname] = events
+
+    def cancelFeeds(self):
+        """Stop tracking database changes - the window is going away."""
+        for i in self.feeds:
+            i.cancel()
+        self.feeds = []
+
     def adjustSector(self, ratio):
         """Scale the size of the map by RATIO."""
         self.gridsize = map(operator.mul, [ratio]*len(self.gridsize),
@@ -266,11 +290,16 @@ class mapSubWin:
         CN_ENEMY = empDb.CN_ENEMY
         CN_UNOWNED = empDb.CN_UNOWNED
 
+        changed = self.changed
+        self.changed = {}
         if total:
             db = megaDB['SECTOR']
             self.Map.delete('SECTOR')
         else:
-            db = updateDB['SECTOR']
+            db = {}
+            sectors = megaDB['SECTOR']
+            for i in changed.get('SECTOR', {}).keys():
+                db[i] = sectors[i]
         for i, j in db.items():
             des = j.get('des')
             if not des:
@@ -351,7 +380,7 @@ class mapSubWin:
             ('SHIPS', "SHIP", "ships", "enemyShips"),
             ('PLANES', "PLANE", "planes", "enemyPlanes"),
             ('NUKES', "NUKE", "nukes", "enemyNukes")):
-            if not total and not updateDB[dbname]:
+            if not total and not changed.has_key(dbname):
                 # No objects in this database have been updated.
                 self.Map.lift(ownedInfo)
                 self.Map.lift(enemyInfo)
@@ -625,6 +654,7 @@ class CmdMap(empCmd.baseCommand):
         """Tk callback: Remove the window from the display."""
         viewer.updateList.remove(self.Map)
         viewer.mapList.remove(self.Map)
+        self.Map.cancelFeeds()
         self.Root.destroy()
 
 class CmdBestpath(empCmd.baseCommand):
@@ -710,6 +740,8 @@ class MoveMode:
         self.sectors = []
         self.pathList = []
         self.flags = 0
+        self.dirty = 0
+        self.feed = empDb.subscribe('SECTOR', self.noteChanges)
 
         if quantity is not None:
             self.Quantity.set(quantity)
@@ -731,6 +763,11 @@ class MoveMode:
             self.Map.tk.call("bind", self.Map, action, command)
         viewer.Prompt.focus()
         viewer.updateList.remove(self)
+        self.feed.cancel()
+
+    def noteChanges(self, dbname, events):
+        """empDb change feed: The sectors have changed."""
+        self.dirty = 1
 
     def DoOk(self, event=None):
         scts = ""
@@ -810,9 +847,10 @@ class MoveMode:
             self.redraw()
 
     def redraw(self, total=1):
-        if not total and not empDb.updateDB.has_key('SECTOR'):
+        if not total and not self.dirty:
             # Nothing changed.
             return
+        self.dirty = 0
 
         # Remove any existing path.
         self.map.drawPath()
@@ -22,6 +22,7 @@ import string
 import re
 import bisect
 import types
+import time
 
 import empQueue
 import empDb
@@ -176,7 +177,9 @@ class EmpParse:
                           , CmdOut, CmdNova, CmdPredict, CmdMover
                           , CmdRaw, CmdOrigin, CmdMMove, CmdEMove
                           , CmdRemove, CmdDanno, CmdDtele, CmdProjection
-                          , CmdDmove, CmdSetFood, CmdLTest)
+                          , CmdDmove, CmdSetFood, CmdLTest, CmdHistory
+                          , CmdPipeline, CmdQStats, CmdRecord, CmdExplain
+                          , CmdTally)
 
     def registerCmds(self, *args):
         """Register a list of commands."""
@@ -514,6 +517,102 @@ class CmdBurst(baseCommand):
         self.Send(args, self.out)
         self.ioq.preFlag, self.ioq.postFlag = pre, post
 
+class CmdPipeline(baseCommand):
+
+    description = "Set the number of sub-prompt free commands sent at once."
+
+    defaultBinding = (('pipeline', 8),)
+
+    commandUsage = "pipeline [<depth>]"
+    commandFormat = re.compile(r"^(?P<depth>\d+)?\s*$")
+
+    def receive(self):
+        depth = self.parameterMatch.group('depth')
+        if depth is not None:
+            self.ioq.sock.pipelineDepth = max(1, int(depth))
+        self.out.data("Pipeline depth is %d." % self.ioq.sock.pipelineDepth)
+
+class CmdQStats(baseCommand):
+
+    description = "Show command queue latency and throughput statistics."
+
+    defaultBinding = (('qstats', 6),)
+
+    commandUsage = "qstats [reset | json <file>]"
+    commandFormat = re.compile(
+        r"^(?:(?P<reset>reset)|json\s+(?P<file>.*?))?\s*$")
+
+    def receive(self):
+        sock = self.ioq.sock
+        stats = sock.stats
+        mm = self.parameterMatch
+        if mm.group('reset'):
+            stats.reset()
+            empEval.queryCache.clear()
+            self.out.data("Queue statistics reset.")
+            return
+        info = stats.summary(len(sock.FuncList))
+        cache = empEval.queryCache
+        info['queryCache'] = {'hits': cache.hits, 'misses': cache.misses,
+                              'compiled': len(cache.order)}
+        if mm.group('file'):
+            try:
+                file = open(mm.group('file'), 'a')
+                file.write(empQueue.jsonEncode(info) + "\n")
+                file.close()
+            except IOError, e:
+                viewer.Error("Unable to write file [%s]: %s" % (
+                    mm.group('file'), e))
+            return
+        self.out.data("Commands: %d (%.1f/s)  Bytes: %d (%.0f/s)  Lines: %d"
+                      % (info['commands'], info['cmdRate'], info['bytes'],
+                         info['byteRate'], info['lines']))
+        depths = map(lambda d: d[1], info['depths'])
+        self.out.data("Queue depth: %d now, %d max over %d samples" % (
+            info['depth'], max(depths), len(depths)))
+        self.out.data("Query cache: %(hits)d hits, %(misses)d misses,"
+                      " %(compiled)d compiled" % info['queryCache'])
+        verbs = info['verbs'].keys()
+        if not verbs:
+            return
+        verbs.sort()
+        self.out.data("%-10s %6s %8s %8s %8s %8s %8s %9s" % (
+            "verb", "count", "p50 ms", "p95 ms", "p99 ms", "first", "wait",
+            "bytes"))
+        for verb in verbs:
+            v = info['verbs'][verb]
+            self.out.data("%-10s %6d %8.1f %8.1f %8.1f %8.1f %8.1f %9d" % (
+                verb, v['count'], v['p50'], v['p95'], v['p99'], v['first'],
+                v['wait'], v['bytes']))
+
+class CmdRecord(baseCommand):
+
+    description = "Record the server protocol stream to a file."
+
+    defaultBinding = (('record', 6),)
+
+    commandUsage = "record [<file> | off]"
+    commandFormat = re.compile(r"^(?P<file>.*?)\s*$")
+
+    def receive(self):
+        sock = self.ioq.sock
+        name = self.parameterMatch.group('file')
+        if name:
+            if sock.recorder is not None:
+                sock.recorder.close()
+                sock.recorder = None
+            if name != 'off':
+                try:
+                    file = open(name, 'a')
+                except IOError, e:
+                    viewer.Error("Unable to open file [%s]: %s" % (name, e))
+                    return
+                sock.recorder = empQueue.SessionRecorder(file)
+        if sock.recorder is None:
+            self.out.data("Not recording.")
+        else:
+            self.out.data("Recording to %s." % sock.recorder.file.name)
+
 class CmdExec(baseCommand):
 
     description = "Run commands from a file."
@@ -776,6 +875,140 @@ class CmdForEach(baseCommand):
             for i in list:
                 self.Send(i, self.out, 1)
 
+class CmdExplain(baseCommand):
+
+    description = "Show how the client finds the items for a selector."
+
+    defaultBinding = (('explain', 7),)
+
+    commandUsage = ("explain [sect | ship | plane | land] <area>"
+                    " [?<selectors>]")
+    commandFormat = re.compile(
+        r"^(?:(?P<type>se\w*|sh\w*|pl\w*|la\w*)\s+)?(?P<sectors>\S+)"
+        r"(?:\s+\?(?P<selectors>\S+))?\s*$")
+    def receive(self):
+        mm = self.parameterMatch
+        dbname = {'se': 'SECTOR', 'sh': 'SHIPS', 'pl': 'PLANES',
+                  'la': 'LAND UNITS'}[(mm.group('type') or 'se')[:2]]
+        try:
+            expr = "owner==-1 and " + empEval.selectToExpr(
+                dbname, mm.group('sectors'), mm.group('selectors'))
+            plan = empEval.QueryPlan(dbname, expr)
+            start = time.time()
+            candidates = plan.candidates()
+            found = empEval.getSectors(expr, dbname)
+            elapsed = time.time() - start
+        except empEval.error, e:
+            viewer.Error(e)
+            return
+        total = len(empDb.megaDB[dbname].keys())
+        if candidates is None:
+            candidates = total
+        else:
+            candidates = len(candidates)
+        self.out.data("Query: " + expr)
+        for line in plan.describe():
+            self.out.data(line)
+        self.out.data("Examined %d of %d items, %d matched (%.1f ms)" % (
+            candidates, total, len(found), elapsed * 1000.0))
+
+class CmdTally(baseCommand):
+
+    description = "Sum up selectors over the items in an area."
+
+    defaultBinding = (('tally', 5),)
+
+    commandUsage = ("tally [sect | ship | plane | land] <area> [?<selectors>]"
+                    " [<field>[,<field>...]] [by <selector>]")
+    commandFormat = re.compile(
+        r"^(?:(?P<type>se\w*|sh\w*|pl\w*|la\w*)\s+)?(?P<sectors>\S+)"
+        r"(?:\s+\?(?P<selectors>\S+))?(?:\s+(?!by\s)(?P<fields>[\w,]+))?"
+        r"(?:\s+by\s+(?P<group>\w+))?\s*$")
+    selectorName = re.compile(r"^\w+")
+    def receive(self):
+        mm = self.parameterMatch
+        dbname = {'se': 'SECTOR', 'sh': 'SHIPS', 'pl': 'PLANES',
+                  'la': 'LAND UNITS'}[(mm.group('type') or 'se')[:2]]
+        fields = filter(None, string.split(mm.group('fields') or "", ","))
+        group = mm.group('group')
+        # Only owned items are included, unless the owner is asked for.
+        envio = empEval.selectors[dbname]
+        names = [group]
+        for cond in string.split(mm.group('selectors') or "", "&"):
+            mc = self.selectorName.match(cond)
+            if mc:
+                names.append(mc.group(0))
+        owner = "owner==-1 and "
+        for name in names:
+            if envio.get(name) == 'owner':
+                owner = ""
+        try:
+            expr = owner + empEval.selectToExpr(
+                dbname, mm.group('sectors'), mm.group('selectors'))
+            start = time.time()
+            result = empEval.tally(expr, fields, group, dbname)
+            elapsed = time.time() - start
+        except empEval.error, e:
+            viewer.Error(e)
+            return
+        if not result:
+            self.out.data("No items matched.")
+            return
+        values = result.keys()
+        values.sort()
+        lines = []
+        items = 0
+        for value in values:
+            if value is None:
+                lines.append(("-", result[value]))
+            else:
+                lines.append((value, result[value]))
+            items = items + result[value][0]
+        if group is not None and len(values) > 1:
+            # Add a total of all the groups.
+            total = [items, [None] * len(fields)]
+            for value in values:
+                stats = result[value][1]
+                for i in range(len(fields)):
+                    s = stats[i]
+                    t = total[1][i]
+                    if s is None:
+                        continue
+                    elif t is None:
+                        total[1][i] = s[:]
+                    else:
+                        total[1][i] = [t[0]+s[0], t[1]+s[1],
+                                       min(t[2], s[2]), max(t[3], s[3])]
+            lines.append(("total", total))
+        label = ""
+        if group is not None:
+            label = "%-8s " % group
+        if not fields:
+            self.out.data(label + "   count")
+        else:
+            self.out.data(label + "%-8s %7s %11s %9s %9s %11s" % (
+                "field", "count", "sum", "min", "max", "avg"))
+        for value, (count, stats) in lines:
+            if group is not None:
+                label = "%-8s " % (value,)
+            if not fields:
+                self.out.data(label + "%8d" % count)
+            for i in range(len(fields)):
+                s = stats[i]
+                if s is None:
+                    self.out.data(label + "%-8s %7d" % (fields[i], 0))
+                    continue
+                self.out.data(label + "%-8s %7d %11s %9s %9s %11.2f" % (
+                    fields[i], s[0], numberText(s[1]), numberText(s[2]),
+                    numberText(s[3]), float(s[1]) / s[0]))
+        self.out.data("%d items (%.1f ms)" % (items, elapsed * 1000.0))
+
+def numberText(val):
+    """Return VAL as a string - whole numbers are shown without decimals."""
+    if type(val) == types.FloatType and val != int(val):
+        return "%.2f" % val
+    return "%d" % val
+
 class CmdOut(baseCommand):
 
     description = "Debugging tool - dumps database."
@@ -1666,3 +1899,53 @@ class CmdLTest(baseCommand):
             newmob = int(unit['mob'] - mcost)
             self.out.data("Total movement cost: %d, new mob: %d" %
                           (unit['mob'] - newmob, newmob))
+
+class CmdHistory(baseCommand):
+    description = "Show the recorded history of a sector or unit field."
+
+    defaultBinding = (("history", 7),)
+
+    commandUsage = ("history [ship|plane|land] <sector or id> <field>"
+                    " [<count>]")
+    commandFormat = re.compile(
+        r"^(?:(?P<type>ship|plane|land)\s+)?(?P<key>\S+)\s+(?P<field>\S+)"
+        +r"(?:\s+(?P<count>\d+))?\s*$")
+
+    unitTypes = {'ship': 'SHIPS', 'plane': 'PLANES', 'land': 'LAND UNITS'}
+
+    def receive(self):
+        mm = self.parameterMatch
+        history = empDb.DBIO.history
+        if history is None:
+            viewer.Error("History is not being recorded."
+                         "  (Start the client with the -H flag.)")
+            return
+        try:
+            if mm.group('type'):
+                dbname = self.unitTypes[mm.group('type')]
+                key = (int(mm.group('key')),)
+            else:
+                dbname = 'SECTOR'
+                key = empParse.str2Coords(mm.group('key'))
+        except ValueError:
+            viewer.Error("Invalid sector or unit id.")
+            return
+        field = mm.group('field')
+        field = empEval.commodityTransform.get(field, field)
+        list = history.getHistory(dbname, key, field)
+        if not list:
+            viewer.Error("No history of %s for %s." % (
+                field, mm.group('key')))
+            return
+        if mm.group('count'):
+            list = list[-int(mm.group('count')):]
+        printTime = empDb.megaDB['time'].printTime
+        last = None
+        for timestamp, value in list:
+            if last is None:
+                change = ""
+            else:
+                change = "%+d" % (value - last)
+            self.out.data("%s  %6d %6s" % (printTime(timestamp), value,
+                                            change))
+            last = value
@@ -19,12 +19,12 @@
 import curses
 import termios
  
-import select
 import sys
 
 import empDb
 import empQueue
 import empCmd
+import empLoop
 
 ###########################################################################
 #############################  Curses support #############################
@@ -36,6 +36,9 @@ class Curses:
         self.login_kill = 0
         self.stayOnline = 0
         self.atPrompt = 0
+        # The handler waiting for the answer to a sub-prompt.
+        self.subPrompt = None
+        self.loop = empLoop.EventLoop()
 
         self.origState = termios.tcgetattr(sys.stdin.fileno())
         self.stdscr=curses.initscr()
@@ -64,18 +67,17 @@ class Curses:
         self.outwin.addstr("\n"+msg)
         self.atPrompt = 0
 
-##      def flush(self, msg, hdl):
-##  	"""empQueue handler: Handle a subprompt."""
-##  	if hdl is None:
-##  	    print msg
-##  	    return
-##  	try:
-##  	    cmd = raw_input(msg)
-##  	except KeyboardInterrupt:
-##  	    cmd = "ctlc"
-##  	    print
-##  	hdl(cmd)
-##  	self.atPrompt = 0
+    def flush(self, msg, hdl):
+        """empQueue handler: Handle a subprompt."""
+        if hdl is None:
+            self.data(msg)
+            return
+        # The answer is collected by HandleKey.
+        self.outwin.addstr("\n" + msg)
+        self.setprompt(msg)
+        self.cmd = ""
+        self.subPrompt = hdl
+        self.atPrompt = 0
 
     def End(self, cmd):
         """empQueue handler: Note the end of a command."""
@@ -84,7 +86,7 @@ class Curses:
         self.setprompt(p)
         self.atPrompt = 1
 
-    flush = Answer = updateDB = empQueue.doNothing
+    Answer = updateDB = empQueue.doNothing
 
     def inform(self):
         """empQueue handler: Process an asynchronous prompt update."""
@@ -148,72 +150,75 @@ class Curses:
 
     def Process(self):
         """empQueue handler: Note a lull in socket activity."""
-        pass
+        # Deliver the database changes to the subscribers (eg. the
+        # history recorder).
+        empDb.flushChanges()
+
+    def HandleKey(self):
+        """EventLoop callback: Process a keystroke."""
+        ch = self.promptwin.getch()
+        if ch < 0:
+            return
+        if ch == ord("\n"):
+            if self.subPrompt is not None:
+                hdl = self.subPrompt
+                self.subPrompt = None
+                self.outwin.addstr(self.cmd)
+                hdl(self.cmd)
+            else:
+                try:
+                    self.ioq.HistSend(self.cmd)
+                except IndexError:
+                    curses.beep()
+            self.promptwin.move(0,0)
+            self.promptwin.clrtoeol()
+            self.cmd = ""
+        elif ch > 255:
+            # Function key
+            if ch == curses.KEY_UP or ch == curses.KEY_DOWN:
+                if ch == curses.KEY_UP:
+                    offset = 1
+                else:
+                    offset = -1
+                try:
+                    self.cmd = self.ioq.HistMove(offset, self.cmd)
+                except IndexError:
+                    curses.beep()
+                else:
+                    self.promptwin.clear()
+                    self.promptwin.addstr(0, 0, empDb.GetPrompt()
+                                          + self.cmd)
+        else:
+            self.cmd = self.cmd + chr(ch)
+            self.promptwin.addstr(chr(ch))
+        self.refresh()
+
+    def HandleSock(self):
+        """EventLoop callback: Process pending socket data."""
+        self.ioq.HandleInput()
+        self.refresh()
+
+    def refresh(self):
+        """Update the screen."""
+        self.outwin.refresh()
+        self.promptwin.refresh()
 
     def main(self):
         """empire.py callback: Start the main input/output loop."""
         try:
             # Start curses
-#	    self.promptwin.nodelay(1)
-#	    curses.intrflush(1)
             curses.noecho()
             curses.cbreak()
             self.promptwin.keypad(1)
 
             self.cmd = ""
-            while self.stayOnline:
-                pending = select.select([self.ioq, sys.stdin], [], [])[0]
-                if pending and pending[0] == self.ioq:
-                    self.ioq.HandleInput()
-                    del pending[0]
-#		    self.outwin.refresh()
-                if pending and pending[0] == sys.stdin:
-##  		    cmd = self.promptwin.getstr()
-##  		    try:
-##  			self.ioq.HistSend(cmd)
-##  		    except IndexError:
-##  			print "History substitution error."
-##  		    self.promptwin.move(0,0)
-##  		    self.promptwin.clrtoeol()
-#		    buf = sys.stdin.read()
-#		    map(curses.ungetch, map(ord, buf))
-#		    while 1:
-                    ch = self.promptwin.getch()
-                    if ch < 0:
-                        break
-                    if ch == ord("\n"):
-                        try:
-                            self.ioq.HistSend(self.cmd)
-                        except IndexError:
-                            curses.beep()
-                        self.promptwin.move(0,0)
-                        self.promptwin.clrtoeol()
-                        self.cmd = ""
-                    elif ch > 255:
-                        # Function key
-                        if ch == curses.KEY_UP or ch == curses.KEY_DOWN:
-                            if ch == curses.KEY_UP:
-                                offset = 1
-                            else:
-                                offset = -1
-                            try:
-                                self.cmd = self.ioq.HistMove(offset, self.cmd)
-                            except IndexError:
-                                curses.beep()
-                            else:
-                                self.promptwin.clear()
-                                self.promptwin.addstr(0, 0, empDb.GetPrompt()
-                                                      + self.cmd)
-                    else:
-#			print 'got ' + chr(ch)
-#			self.stdscr.addstr(0, 0, cmd)
-                        self.cmd = self.cmd + chr(ch)
-                        self.promptwin.addstr(chr(ch))
-##  			self.promptwin.move(0,0)
-##  			self.promptwin.clrtoeol()
-##  			self.promptwin.addstr(0, 0, empDb.GetPrompt() + cmd)
-                self.outwin.refresh()
-                self.promptwin.refresh()
+            loop = self.loop
+            loop.addReader(self.ioq, self.HandleSock)
+            loop.addReader(sys.stdin, self.HandleKey)
+            # Timers may write to the screen too.
+            loop.addTimer(1.0, self.refresh, 1.0)
+            empLoop.addStandardTimers(loop, self.flash)
+            loop.run(lambda self=self: self.stayOnline)
         finally:
 #	    self.promptwin.nodelay(0)
             self.promptwin.keypad(0)
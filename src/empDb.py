@@ -17,11 +17,27 @@
 #    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
 import sys
+import os
 import string
 import cPickle
 import operator
+import types
+import array
 import time
 import traceback
+import new
+import struct
+try:
+    import zlib
+except ImportError:
+    # Database columns will be stored uncompressed.
+    zlib = None
+try:
+    import threading
+except ImportError:
+    # Python was built without thread support - databases are always
+    # saved in the foreground.
+    threading = None
 
 # Key Ideas:
 
@@ -81,6 +97,39 @@ import traceback
 # the updateDB when done.
 
 
+# The change feed:
+
+# The updateDB only says which items changed.  Code that needs to know
+# exactly what changed may instead subscribe to a sub-database (see
+# subscribe()).  Every change made through dictDB.updates() is recorded
+# (with the old and new value of each changed field) for the subscribers
+# whose key range and field list match, and the changes are delivered in
+# batches when the interface calls flushChanges().
+
+
+# The database journal:
+
+# Normally the whole megaDB is pickled to disk when the client exits.  When
+# journal mode is enabled (see DatabaseSaver.journalMode), every change
+# made through dictDB.updates() (and every change noted via
+# DatabaseSaver.journalSet()) is also appended to a log file that lives
+# next to the database.  Loading the database replays this log on top of
+# the last full snapshot, so a client that crashes mid-session will not
+# lose the information it gathered.  The log is periodically folded back
+# into the snapshot (compacted) once it grows larger than the snapshot
+# itself.
+
+
+# Lazy loading:
+
+# The database file is stored as a series of independent segments - one
+# per megaDB key.  When a database is loaded, the segments are read into
+# memory but are not unpickled.  A sub-database is only unpickled the
+# first time it is accessed through megaDB.  (megaDB is an instance of
+# lazyDB - it behaves like a dictionary.)  Segments that are never
+# touched during a session are written back to disk unchanged.
+
+
 ###########################################################################
 #############################  dictDB class   #############################
 class dictDB:
@@ -99,6 +148,10 @@ class dictDB:
     the secondary databases.  (EG. The plane/ship/land units use a
     secondary database that is indexed by x and y.)
 
+    Indexes by position (see spatialIndex) may also be added with
+    addSpatialIndex().  They are used by getRange() and getRadius() to find
+    the items in an area without examining every item in the database.
+
     Second, there is an automatic detection of updated items.  Any time an
     update is made to the database, an entry is filed in a special 'update'
     database.  This is used by the Tk graphics routines to ensure that only
@@ -108,6 +161,17 @@ class dictDB:
     Note: Don't manually update the dictionaries with inserts,
     modifications, or deletes.  All changes should be done through the
     updates() method.  (To delete a value, update its value to None.)
+
+    The attribute journal may be set to a function that is called with a
+    record type and value each time the database is changed.  (It is used
+    by DatabaseSaver to implement the database journal.)
+
+    The attribute subscribers is a list of Subscription instances that are
+    told the old and new value of every changed field.  (See subscribe().)
+
+    The attribute generation is incremented every time the database is
+    changed.  (It is used by DatabaseSaver to skip needless saves, and by
+    empVector to check that its copy of the database is current.)
     """
     def __getstate__(self):
         """Pickle module handler: determines what will be saved."""
@@ -131,7 +195,8 @@ class dictDB:
                 'primary_headers' : headers,
                 'primary_values': totalList,
                 'timestamp': self.timestamp,
-                'secondary_keys': self.secondary.keys()}
+                'secondary_keys': self.secondary.keys(),
+                'spatial_keys': self.spatial.keys()}
     def __setstate__(self, state):
         """Pickle module handler: restore a saved class."""
         pri_keytype = self.primary_keytype = state['primary_keytype']
@@ -139,21 +204,14 @@ class dictDB:
         self.unofficial_timestamp = state['timestamp']
         seckeys = state['secondary_keys']
 
-        headers = state['primary_headers']
-        valueList = state['primary_values']
-
         # Convert compressed header/value tuples to a dictionary
+        rows = stateRows(state)
+        count = len(rows)
+        keys = transpose(map(lambda field, rows=rows, count=count:
+                             map(operator.getitem, rows, (field,)*count),
+                             pri_keytype))
         self.primary = primary = {}
-        for valTuple in valueList:
-            pri_val = {}
-            for i in range(len(valTuple)):
-                val = valTuple[i]
-                if val is not None:
-                    pri_val[headers[i]] = val
-            pri_key = tuple(map(operator.getitem,
-                                (pri_val,)*len(pri_keytype),
-                                pri_keytype))
-            primary[pri_key] = pri_val
+        map(operator.setitem, (primary,)*count, keys, rows)
 
         # rebuild secondary indexes
         self.secondary = secondary = {}
@@ -164,9 +222,23 @@ class dictDB:
                 try: secIndex[sec_key][pri_key] = pri_val
                 except KeyError: secIndex[sec_key] = {pri_key: pri_val}
 
+        # rebuild spatial indexes
+        self.spatial = {}
+        for sec_type in state.get('spatial_keys', ()):
+            self.addSpatialIndex(sec_type)
+
         # List of items that have recently changed
         self.uDB = {}
 
+        # Count of the updates() calls that changed the database
+        self.generation = 0
+
+        # Callback for the database journal (see DatabaseSaver)
+        self.journal = None
+
+        # Consumers of the change feed (see subscribe())
+        self.subscribers = []
+
         # Initialize some handlers
         self.get = primary.get
         self.items = primary.items
@@ -200,12 +272,15 @@ class dictDB:
         lst = map(operator.getitem, lst, (1,) * len(lst))
         return lst
 
-    def updates(self, list, returnRemaining=0):
+    def updates(self, list, seen=None):
         """Update the database with the items stored in LIST.
 
         Given a list of dictionary types, extract the primary key from each
         dict, and add the item to the primary, secondary, and update
         databases.
+
+        If SEEN is a dictionary, the primary key of every item in LIST is
+        added to it.  (See unseen().)
         """
         # Python optimization - copy frequently used variables into
         # local namespace.
@@ -213,16 +288,18 @@ class dictDB:
         self__secondary__items=self.secondary.items();self__uDB=self.uDB
         operator__delitem=operator.delitem;operator__getitem=operator.getitem
         __tuple=tuple;__map=map;__len=len
+        self__journal=self.journal;self__spatial=self.spatial.values()
+        self__subscribers=self.subscribers
+        # List of all items that actually changed
+        changed = []
 
-        if returnRemaining:
-            # This flag instructs the routine to return all items in the
-            # database that were _not_ updated during this call.
-            remainingList = self__primary.copy()
         for dict in list:
             # find the key
             pri_key = __tuple(__map(operator__getitem,
                                     (dict,)*__len(self__primary_keytype),
                                     self__primary_keytype))
+            if seen is not None:
+                seen[pri_key] = None
 
             # list all items being deleted
             dict__items = dict.items()
@@ -246,13 +323,11 @@ class dictDB:
             except KeyError:
                 # New key
                 d = self__primary[pri_key] = {}
+                if self__subscribers:
+                    noteChanges(self__subscribers, pri_key, None, dict)
             else:
                 # Key already present
 
-                # Remove this item from the returnRemaining list
-                if returnRemaining:
-                    del remainingList[pri_key]
-
                 # Don't update entries if no changes are made.  Although
                 # this may be an expensive operation, the most expensive
                 # operations (by far) are screen redraws - any code that
@@ -275,6 +350,10 @@ class dictDB:
                     del sec_db[sec_key][pri_key]
                     if not sec_db[sec_key]:
                         del sec_db[sec_key]
+                for spatial in self__spatial:
+                    spatial.remove(pri_key, d)
+                if self__subscribers:
+                    noteChanges(self__subscribers, pri_key, d, dict)
 
             # Add item to the primary database
             self__primary[pri_key].update(dict)
@@ -288,16 +367,1080 @@ class dictDB:
                 sec_key = __tuple(__map(d.get, sec_type))
                 try: sec_db[sec_key][pri_key] = d
                 except KeyError: sec_db[sec_key] = {pri_key:d}
-        if returnRemaining:
-            return remainingList
+            for spatial in self__spatial:
+                spatial.add(pri_key, d)
+            changed.append(dict)
+        if changed:
+            self.generation = generation = self.generation + 1
+            for sub in self__subscribers:
+                sub.generation = generation
+            if self__journal is not None:
+                self__journal('updates', changed)
+    def unseen(self, seen):
+        """Return a dictionary of the items whose keys are not in SEEN.
+
+        This is used after a full dump to find the items that the server
+        no longer reports.
+        """
+        remaining = {}
+        for key, row in self.items():
+            if not seen.has_key(key):
+                remaining[key] = row
+        return remaining
+    def setTimestamp(self, timestamp):
+        """Set the official timestamp of the database."""
+        self.timestamp = timestamp
+        if self.journal is not None:
+            self.journal('timestamp', timestamp)
     def getSec(self, sec_type):
         """Return the secondary index (a dictionary) for SEC_TYPE."""
         return self.secondary[sec_type]
+    def addIndex(self, sec_type):
+        """Add a secondary index for SEC_TYPE to an existing database.
+
+        Nothing is done if the index already exists.  Secondary indexes on
+        a single field (eg. ('owner',)) are used by empEval to find the
+        items with a given value.
+        """
+        if self.secondary.has_key(sec_type):
+            return
+        self.secondary[sec_type] = secIndex = {}
+        for pri_key, pri_val in self.items():
+            sec_key = tuple(map(pri_val.get, sec_type))
+            try: secIndex[sec_key][pri_key] = pri_val
+            except KeyError: secIndex[sec_key] = {pri_key: pri_val}
+    def addSpatialIndex(self, sec_type=('x', 'y')):
+        """Index the database by the position stored in SEC_TYPE.
+
+        SEC_TYPE names the x and y fields of the items.  Nothing is done if
+        the index already exists.
+        """
+        if self.spatial.has_key(sec_type):
+            return
+        self.spatial[sec_type] = spatial = spatialIndex(sec_type)
+        for pri_key, pri_val in self.primary.items():
+            spatial.add(pri_key, pri_val)
+    def getRange(self, minX, maxX, minY, maxY, sec_type=('x', 'y')):
+        """Return a dictionary of the items in an area.
+
+        The area includes the items with minX <= x <= maxX and minY <= y
+        <= maxY.  As with empire realms, if a minimum is greater than its
+        maximum the area wraps around the edge of the world.  (The items
+        with x >= minX or x <= maxX are included.)
+        """
+        if self.spatial.has_key(sec_type):
+            return self.spatial[sec_type].getRange(minX, maxX, minY, maxY)
+        # No index - examine every item.
+        fx, fy = sec_type
+        dict = {}
+        for pri_key, pri_val in self.primary.items():
+            x = pri_val.get(fx)
+            y = pri_val.get(fy)
+            if (x is not None and y is not None
+                and inRange(x, minX, maxX) and inRange(y, minY, maxY)):
+                dict[pri_key] = pri_val
+        return dict
+    def getRadius(self, coord, dist, sec_type=('x', 'y')):
+        """Return a dictionary of the items within DIST sectors of COORD."""
+        # Find the items in the surrounding rectangle, and then check the
+        # exact distance of each.
+        maxx, maxy = megaDB['version']['worldsize']
+        x, y = coord
+        if 4*dist+1 >= maxx:
+            minX, maxX = -sys.maxint, sys.maxint
+        else:
+            minX, maxX = sectorWrap((x-2*dist, 0))[0], \
+                         sectorWrap((x+2*dist, 0))[0]
+        if 2*dist+1 >= maxy:
+            minY, maxY = -sys.maxint, sys.maxint
+        else:
+            minY, maxY = sectorWrap((0, y-dist))[1], \
+                         sectorWrap((0, y+dist))[1]
+        fx, fy = sec_type
+        dict = {}
+        for pri_key, pri_val in self.getRange(minX, maxX, minY, maxY,
+                                              sec_type).items():
+            if sectorDistance(coord, (pri_val[fx], pri_val[fy])) <= dist:
+                dict[pri_key] = pri_val
+        return dict
+    def snapshot(self):
+        """Return a frozen copy of the database for pickling.
+
+        The returned object pickles to the contents of the database at the
+        time of the call, even if the database is changed afterwards.  It
+        only supports pickling.  (The rows are copied, but the secondary
+        indexes are not rebuilt.)
+        """
+        primary = {}
+        for key, row in self.primary.items():
+            primary[key] = row.copy()
+        secondary = {}
+        for key in self.secondary.keys():
+            secondary[key] = None
+        spatial = {}
+        for key in self.spatial.keys():
+            spatial[key] = None
+        return new.instance(self.__class__, {
+            'primary_keytype': self.primary_keytype,
+            'primary': primary,
+            'secondary': secondary,
+            'spatial': spatial,
+            'timestamp': self.timestamp})
     def __repr__(self):
         return repr(self.primary)
     def __str__(self):
         return string.join(map(str, self.primary.items()), "\n")
 
+###########################################################################
+#############################  spatialIndex class   #######################
+
+def inRange(val, low, high):
+    """Return true if VAL is in the (possibly wrapped) range LOW..HIGH."""
+    if low <= high:
+        return val >= low and val <= high
+    return val >= low or val <= high
+
+def axisIntervals(low, high, lowest, highest):
+    """Convert a (possibly wrapped) range to a list of plain ranges.
+
+    The range LOW..HIGH is clipped to LOWEST..HIGHEST.  If LOW is greater
+    than HIGH, the range wraps around (it includes LOW..HIGHEST and
+    LOWEST..HIGH).
+    """
+    if low <= high:
+        ranges = [(low, high)]
+    else:
+        ranges = [(low, highest), (lowest, high)]
+    result = []
+    for low, high in ranges:
+        low = max(low, lowest)
+        high = min(high, highest)
+        if low <= high:
+            result.append((low, high))
+    return result
+
+class spatialIndex:
+    """Index the items of a dictDB by position.
+
+    The world is divided into square tiles of tileSize by tileSize
+    coordinates, and each item is filed under the tile that holds it.
+    Finding the items in an area only requires visiting the tiles that
+    overlap the area.
+
+    Note: This class is maintained by dictDB - see dictDB.addSpatialIndex().
+    """
+    tileSize = 4
+
+    def __init__(self, sec_type):
+        self.fields = sec_type
+        # Dictionary of tiles - each tile is a dictionary of the items in
+        # it.
+        self.tiles = {}
+        # The smallest and largest coordinates ever stored in the index.
+        self.lowest = self.highest = None
+
+    def add(self, pri_key, pri_val):
+        """File the item PRI_VAL under its position."""
+        fx, fy = self.fields
+        x = pri_val.get(fx)
+        y = pri_val.get(fy)
+        if x is None or y is None:
+            return
+        size = self.tileSize
+        tile = (x/size, y/size)
+        try: self.tiles[tile][pri_key] = pri_val
+        except KeyError: self.tiles[tile] = {pri_key: pri_val}
+        if self.lowest is None:
+            self.lowest = (x, y)
+            self.highest = (x, y)
+        else:
+            self.lowest = (min(x, self.lowest[0]), min(y, self.lowest[1]))
+            self.highest = (max(x, self.highest[0]), max(y, self.highest[1]))
+
+    def remove(self, pri_key, pri_val):
+        """Remove the item PRI_VAL (which must not have moved yet)."""
+        fx, fy = self.fields
+        x = pri_val.get(fx)
+        y = pri_val.get(fy)
+        if x is None or y is None:
+            return
+        size = self.tileSize
+        tile = (x/size, y/size)
+        dict = self.tiles[tile]
+        del dict[pri_key]
+        if not dict:
+            del self.tiles[tile]
+
+    def getRange(self, minX, maxX, minY, maxY):
+        """Return a dictionary of the items in an area.
+
+        See dictDB.getRange().
+        """
+        if self.lowest is None:
+            return {}
+        fx, fy = self.fields
+        size = self.tileSize
+        tiles = self.tiles
+        result = {}
+        for lowX, highX in axisIntervals(minX, maxX,
+                                         self.lowest[0], self.highest[0]):
+            for lowY, highY in axisIntervals(minY, maxY,
+                                             self.lowest[1], self.highest[1]):
+                for tx in range(lowX/size, highX/size + 1):
+                    # Are all the columns of the tile in the area?
+                    fullX = tx*size >= lowX and tx*size+size-1 <= highX
+                    for ty in range(lowY/size, highY/size + 1):
+                        tile = tiles.get((tx, ty))
+                        if tile is None:
+                            continue
+                        if (fullX and ty*size >= lowY
+                            and ty*size+size-1 <= highY):
+                            result.update(tile)
+                            continue
+                        for pri_key, pri_val in tile.items():
+                            x = pri_val[fx]
+                            y = pri_val[fy]
+                            if (x >= lowX and x <= highX
+                                and y >= lowY and y <= highY):
+                                result[pri_key] = pri_val
+        return result
+
+###########################################################################
+#############################  columnDB class   ###########################
+
+# Markers for values that are not present in a typed column.
+MISSING_INT = -2147483647-1
+MISSING_FLOAT = -1.7976931348623157e+308
+MISSING_CHAR = '\0'
+
+class columnRow:
+    """A dictionary-like view of one row of a columnDB.
+
+    Instances of this class are returned by columnDB in place of the
+    dictionaries returned by dictDB.  Reads and writes go directly to the
+    columns of the database.
+    """
+    def __init__(self, db, slot):
+        self.db = db
+        self.slot = slot
+    def __getitem__(self, field):
+        db = self.db
+        val = db.columns[field][self.slot]
+        if val == db.missing[field]:
+            raise KeyError, field
+        return val
+    def get(self, field, default=None):
+        db = self.db
+        try:
+            val = db.columns[field][self.slot]
+        except KeyError:
+            return default
+        if val == db.missing[field]:
+            return default
+        return val
+    def has_key(self, field):
+        return self.get(field) is not None
+    def __setitem__(self, field, val):
+        self.db.storeValue(self.slot, field, val)
+        self.db.generation = self.db.generation + 1
+    def __delitem__(self, field):
+        if not self.has_key(field):
+            raise KeyError, field
+        self.db.storeValue(self.slot, field, None)
+        self.db.generation = self.db.generation + 1
+    def update(self, dict):
+        storeValue = self.db.storeValue
+        for field, val in dict.items():
+            storeValue(self.slot, field, val)
+        self.db.generation = self.db.generation + 1
+    def copy(self):
+        """Return a real dictionary with the contents of the row."""
+        new = {}
+        slot = self.slot
+        missing = self.db.missing
+        for field, col in self.db.columns.items():
+            val = col[slot]
+            if val != missing[field]:
+                new[field] = val
+        return new
+    def keys(self):
+        return self.copy().keys()
+    def values(self):
+        return self.copy().values()
+    def items(self):
+        return self.copy().items()
+    def __len__(self):
+        return len(self.copy())
+    def __cmp__(self, other):
+        if isinstance(other, columnRow):
+            other = other.copy()
+        return cmp(self.copy(), other)
+    def __repr__(self):
+        return repr(self.copy())
+
+class columnDB(dictDB):
+    """Store a sector database in typed columns.
+
+    This class is a replacement for dictDB that is specialized for the
+    sector database.  Instead of storing a dictionary per sector, each
+    field from the dump header is stored in a single column that holds a
+    value for every sector in the world.  The position of a sector in the
+    columns (its slot) is computed directly from its coordinates and the
+    world size.  Integer, float, and single character fields are stored in
+    typed array.array columns; all other fields fall back to python lists.
+    This uses a small fraction of the memory of dictDB on large worlds,
+    and allows a whole column to be scanned without visiting every row (see
+    columnItems()).
+
+    The get, keys, values, items, has_key, getSec, and updates methods
+    behave the same as those of dictDB, except that the rows returned are
+    columnRow instances instead of dictionaries.  The class is pickled in
+    the same format as dictDB, so the two can be converted to each other
+    with __getstate__/__setstate__.
+    """
+    typeCodes = (('i', MISSING_INT), ('d', MISSING_FLOAT),
+                 ('c', MISSING_CHAR))
+
+    def __getstate__(self):
+        """Pickle module handler: determines what will be saved."""
+        # Arrange headers by frequency - see dictDB.__arrangeHeaders().
+        slots = self.slotList()
+        lst = []
+        for field, col in self.columns.items():
+            miss = self.missing[field]
+            vals = map(col.__getitem__, slots)
+            lst.append((len(vals) - vals.count(miss), field))
+        lst.sort()
+        lst.reverse()
+        headers = map(operator.getitem, lst, (1,)*len(lst))
+
+        # Convert the columns to per-row value lists.
+        columns = []
+        for field in headers:
+            col = self.columns[field]
+            miss = self.missing[field]
+            vals = map(col.__getitem__, slots)
+            if miss is not None:
+                for i in range(len(vals)):
+                    if vals[i] == miss:
+                        vals[i] = None
+            columns.append(vals)
+        if len(columns) > 1:
+            totalList = map(list, apply(map, [None] + columns))
+        elif columns:
+            totalList = map(lambda val: [val], columns[0])
+        else:
+            totalList = []
+        # Eliminate trailing None values.
+        revrng = range(len(headers)-1, 0, -1)
+        for subList in totalList:
+            for j in revrng:
+                if subList[j] is not None:
+                    break
+            del subList[j+1:]
+
+        return {'primary_keytype': self.primary_keytype,
+                'primary_headers' : headers,
+                'primary_values': totalList,
+                'timestamp': self.timestamp,
+                'secondary_keys': self.secondary.keys(),
+                'worldsize': self.worldsize}
+    def __setstate__(self, state):
+        """Pickle module handler: restore a saved class."""
+        self.primary_keytype = state['primary_keytype']
+        self.timestamp = state['timestamp']
+        self.unofficial_timestamp = state['timestamp']
+
+        # Convert the header/value tuples to columns.
+        headers, columns = stateColumns(state)
+        if headers:
+            xs = columns[headers.index('x')]
+            ys = columns[headers.index('y')]
+        else:
+            xs = ys = []
+
+        # Find the world size.  (A database converted from dictDB doesn't
+        # store one.)
+        size = state.get('worldsize')
+        if size is None:
+            try: size = megaDB['version']['worldsize']
+            except (NameError, KeyError): size = (0, 0)
+        self.knownWorldsize = None
+        self.allocate(self.fitWorldsize(size, xs, ys))
+        slots = map(lambda x, y, maxx=self.worldsize[0], halfx=self.halfx,
+                    halfy=self.halfy: (y + halfy)*maxx + x + halfx,
+                    xs, ys)
+        map(self.present.__setitem__, slots, (1,)*len(slots))
+        for field, values in map(None, headers, columns):
+            self.fillColumn(field, slots, values)
+
+        # rebuild secondary indexes
+        self.secondary = secondary = {}
+        for sec_type in state['secondary_keys']:
+            secondary[sec_type] = secIndex = {}
+            for pri_key, pri_val in self.items():
+                sec_key = tuple(map(pri_val.get, sec_type))
+                try: secIndex[sec_key][pri_key] = pri_val
+                except KeyError: secIndex[sec_key] = {pri_key: pri_val}
+
+        # List of items that have recently changed
+        self.uDB = {}
+
+        # Count of the updates() calls that changed the database
+        self.generation = 0
+
+        # Callback for the database journal (see DatabaseSaver)
+        self.journal = None
+
+        # Consumers of the change feed (see subscribe())
+        self.subscribers = []
+
+    def allocate(self, size):
+        """Create empty columns for a world of SIZE."""
+        self.worldsize = size
+        self.halfx = size[0]/2
+        self.halfy = size[1]/2
+        self.slots = size[0]*size[1]
+        self.present = array.array('b', [0]) * self.slots
+        self.columns = {}
+        self.missing = {}
+
+    def fitWorldsize(self, size, xs, ys):
+        """Return a world size large enough to hold the sectors XS, YS."""
+        maxx, maxy = size
+        if xs:
+            maxx = max(maxx, -2*min(xs), 2*max(xs)+2)
+            maxy = max(maxy, -2*min(ys), 2*max(ys)+2)
+        if (maxx, maxy) != tuple(size):
+            maxx = maxx + (maxx & 1)
+            maxy = maxy + (maxy & 1)
+        return (int(maxx), int(maxy))
+
+    def resize(self, size):
+        """Move all the rows into columns for a world of SIZE."""
+        uDB = self.uDB
+        journal = self.journal
+        subscribers = self.subscribers
+        state = self.__getstate__()
+        state['worldsize'] = size
+        self.__setstate__(state)
+        # The update database is shared with empDb.updateDB - keep it.
+        for key in uDB.keys():
+            uDB[key] = self.get(key)
+        self.uDB = uDB
+        self.journal = journal
+        self.subscribers = subscribers
+
+    def checkWorldsize(self):
+        """Note changes to the world size reported by the server."""
+        size = megaDB['version']['worldsize']
+        if size != self.knownWorldsize:
+            self.knownWorldsize = size
+            keys = self.keys()
+            size = self.fitWorldsize(size,
+                                     map(operator.getitem, keys,
+                                         (0,)*len(keys)),
+                                     map(operator.getitem, keys,
+                                         (1,)*len(keys)))
+            if size != self.worldsize:
+                self.resize(size)
+
+    def slotOf(self, key):
+        """Return the slot for the sector KEY (or None if out of range)."""
+        x = key[0] + self.halfx
+        y = key[1] + self.halfy
+        maxx = self.worldsize[0]
+        if x < 0 or x >= maxx or y < 0 or y >= self.worldsize[1]:
+            return None
+        return y*maxx + x
+
+    def snapshot(self):
+        """Return a frozen copy of the database for pickling.
+
+        See dictDB.snapshot().  Only the columns are copied.
+        """
+        columns = {}
+        for field, col in self.columns.items():
+            columns[field] = col[:]
+        secondary = {}
+        for key in self.secondary.keys():
+            secondary[key] = None
+        return new.instance(self.__class__, {
+            'primary_keytype': self.primary_keytype,
+            'timestamp': self.timestamp,
+            'secondary': secondary,
+            'worldsize': self.worldsize,
+            'slots': self.slots,
+            'present': self.present[:],
+            'columns': columns,
+            'missing': self.missing.copy()})
+    def slotList(self):
+        """Return a list of all the slots in use."""
+        return filter(self.present.__getitem__, range(self.slots))
+
+    def fits(self, miss, val):
+        """Return true if VAL can be stored in a column with marker MISS."""
+        t = type(val)
+        if miss == MISSING_INT:
+            return (t is types.IntType
+                    and val > MISSING_INT and val < -MISSING_INT)
+        if miss == MISSING_FLOAT:
+            return t is types.FloatType and val != MISSING_FLOAT
+        if miss == MISSING_CHAR:
+            return t is types.StringType and len(val) == 1 and val != miss
+        return 0
+
+    def fillColumn(self, field, slots, values):
+        """Create the column FIELD from VALUES (None marks no value).
+
+        VALUES holds one value for each slot in SLOTS.  This is a much
+        faster equivalent of calling storeValue() for each value.
+        """
+        if None in values:
+            idx = filter(lambda i, values=values: values[i] is not None,
+                         range(len(values)))
+            slots = map(slots.__getitem__, idx)
+            values = map(values.__getitem__, idx)
+        if not values:
+            return
+        # Find the most compact column type that holds all the values.
+        kinds = valueKinds(values)
+        code = miss = None
+        if kinds == [types.IntType]:
+            if min(values) > MISSING_INT and max(values) < -MISSING_INT:
+                code, miss = self.typeCodes[0]
+        elif kinds == [types.FloatType]:
+            if MISSING_FLOAT not in values:
+                code, miss = self.typeCodes[1]
+        elif kinds == [types.StringType]:
+            lens = map(len, values)
+            if min(lens) == max(lens) == 1 and MISSING_CHAR not in values:
+                code, miss = self.typeCodes[2]
+        if code is None:
+            col = [None] * self.slots
+        else:
+            col = array.array(code, [miss]) * self.slots
+        map(col.__setitem__, slots, values)
+        self.columns[field] = col
+        self.missing[field] = miss
+
+    def storeValue(self, slot, field, val):
+        """Set (or delete if VAL is None) a single value in a column."""
+        try:
+            col = self.columns[field]
+        except KeyError:
+            if val is None:
+                return
+            # Create a new column of the most compact type for VAL.
+            for code, miss in self.typeCodes:
+                if self.fits(miss, val):
+                    col = array.array(code, [miss]) * self.slots
+                    break
+            else:
+                col = [None] * self.slots
+                miss = None
+            self.columns[field] = col
+            self.missing[field] = miss
+        miss = self.missing[field]
+        if val is None:
+            col[slot] = miss
+        elif miss is None or self.fits(miss, val):
+            col[slot] = val
+        else:
+            # VAL doesn't fit in the typed column - convert it to a list.
+            lst = col.tolist()
+            for i in range(len(lst)):
+                if lst[i] == miss:
+                    lst[i] = None
+            lst[slot] = val
+            self.columns[field] = lst
+            self.missing[field] = None
+
+    def __getitem__(self, key):
+        slot = self.slotOf(key)
+        if slot is None or not self.present[slot]:
+            raise KeyError, key
+        return columnRow(self, slot)
+    def get(self, key, default=None):
+        slot = self.slotOf(key)
+        if slot is None or not self.present[slot]:
+            return default
+        return columnRow(self, slot)
+    def has_key(self, key):
+        slot = self.slotOf(key)
+        return slot is not None and self.present[slot]
+    def keys(self):
+        slots = self.slotList()
+        if not slots:
+            return []
+        return map(None, map(self.columns['x'].__getitem__, slots),
+                   map(self.columns['y'].__getitem__, slots))
+    def values(self):
+        slots = self.slotList()
+        return map(columnRow, (self,)*len(slots), slots)
+    def items(self):
+        slots = self.slotList()
+        if not slots:
+            return []
+        return map(None, map(None, map(self.columns['x'].__getitem__, slots),
+                             map(self.columns['y'].__getitem__, slots)),
+                   map(columnRow, (self,)*len(slots), slots))
+    def addSpatialIndex(self, sec_type=('x', 'y')):
+        """The columns are already arranged by position - do nothing."""
+        pass
+    def getRange(self, minX, maxX, minY, maxY, sec_type=('x', 'y')):
+        """Return a dictionary of the sectors in an area.
+
+        See dictDB.getRange().  Only the slots in the area are examined.
+        """
+        maxx = self.worldsize[0]
+        halfx = self.halfx
+        halfy = self.halfy
+        present = self.present
+        dict = {}
+        for lowX, highX in axisIntervals(minX, maxX, -halfx, maxx-halfx-1):
+            xs = range(lowX, highX+1)
+            for lowY, highY in axisIntervals(minY, maxY, -halfy,
+                                             self.worldsize[1]-halfy-1):
+                for y in range(lowY, highY+1):
+                    base = (y+halfy)*maxx + halfx
+                    for x in filter(lambda x, base=base, present=present:
+                                    present[base+x], xs):
+                        dict[(x, y)] = columnRow(self, base+x)
+        return dict
+    def columnItems(self, field):
+        """Return a list of (key, value) pairs for every value of FIELD.
+
+        This scans a single column, and is much faster than examining the
+        field of every row.
+        """
+        try:
+            col = self.columns[field]
+        except KeyError:
+            return []
+        miss = self.missing[field]
+        slots = self.slotList()
+        vals = map(col.__getitem__, slots)
+        keys = map(None, map(self.columns['x'].__getitem__, slots),
+                   map(self.columns['y'].__getitem__, slots))
+        return filter(lambda i, miss=miss: i[1] != miss, map(None, keys, vals))
+
+    def updates(self, list, seen=None):
+        """Update the database with the items stored in LIST.
+
+        See dictDB.updates() for more information.
+        """
+        self.checkWorldsize()
+        # Python optimization - copy frequently used variables into
+        # local namespace.
+        self__present=self.present;self__columns=self.columns
+        self__storeValue=self.storeValue
+        self__secondary__items=self.secondary.items();self__uDB=self.uDB
+        self__journal=self.journal;self__subscribers=self.subscribers
+        __tuple=tuple;__map=map
+        # List of all items that actually changed
+        changed = []
+
+        for dict in list:
+            pri_key = (dict['x'], dict['y'])
+            if seen is not None:
+                seen[pri_key] = None
+            slot = self.slotOf(pri_key)
+            if slot is None:
+                # Sector outside of the known world - grow the columns.
+                self.resize(self.fitWorldsize(self.worldsize, [pri_key[0]],
+                                              [pri_key[1]]))
+                self__present=self.present;self__columns=self.columns
+                self__secondary__items=self.secondary.items()
+                slot = self.slotOf(pri_key)
+            dict__items = dict.items()
+            if self__present[slot]:
+                # Key already present
+                # Don't update entries if no changes are made.  (See
+                # dictDB.updates().)
+                for key, value in dict__items:
+                    try:
+                        if self__columns[key][slot] != value:
+                            break
+                    except KeyError:
+                        break
+                else:
+                    continue
+                d = columnRow(self, slot)
+                # Remove key from the secondary indexes
+                for sec_type, sec_db in self__secondary__items:
+                    sec_key = __tuple(__map(d.get, sec_type))
+                    del sec_db[sec_key][pri_key]
+                    if not sec_db[sec_key]:
+                        del sec_db[sec_key]
+                if self__subscribers:
+                    noteChanges(self__subscribers, pri_key, d, dict)
+            else:
+                # New key
+                self__present[slot] = 1
+                d = columnRow(self, slot)
+                if self__subscribers:
+                    noteChanges(self__subscribers, pri_key, None, dict)
+
+            # Add item to the columns (a value of None deletes a field)
+            for key, value in dict__items:
+                self__storeValue(slot, key, value)
+            # Add item to the updateDB
+            self__uDB[pri_key] = d
+            # Add key to the secondary indexes
+            for sec_type, sec_db in self__secondary__items:
+                sec_key = __tuple(__map(d.get, sec_type))
+                try: sec_db[sec_key][pri_key] = d
+                except KeyError: sec_db[sec_key] = {pri_key:d}
+            changed.append(dict)
+        if changed:
+            self.generation = generation = self.generation + 1
+            for sub in self__subscribers:
+                sub.generation = generation
+            if self__journal is not None:
+                self__journal('updates', changed)
+    def __repr__(self):
+        return repr(self.items())
+    def __str__(self):
+        return string.join(map(str, self.items()), "\n")
+
+###########################################################################
+#############################  Change feed    #############################
+
+# Subscriptions to the change feed of each sub-database (see subscribe()).
+# The lists are shared with the subscribers attribute of the dictDB
+# instances, so a subscription survives the database being reloaded.
+subscriptions = {}
+# Subscriptions that have undelivered changes.
+pendingFeeds = []
+
+class Subscription:
+    """A consumer of the change feed of a sub-database.
+
+    Instances are created by subscribe().  Each time dictDB.updates()
+    changes an item that matches the subscription, the old and new value
+    of every changed field is recorded.  The changes are delivered in a
+    single batch by flushChanges() as a call to:
+
+        callback(dbname, {pri_key: {field: (old, new), ...}, ...})
+
+    A value of None means the field wasn't present.  Several changes to
+    the same item before a flush are merged into one.
+
+    The attribute keyRange may be None or a tuple with one (low, high)
+    pair for each part of the primary key - only items with keys within
+    the bounds are reported.  (A bound of None is unlimited.)  The
+    attribute fields may be None or a list of the fields of interest -
+    changes to other fields are ignored.  Both may be altered at any time.
+
+    The attribute generation is the generation of the database (see
+    dictDB.generation) after the last updates() call.  If the database has
+    a different generation, it was changed without updates() and the feed
+    has missed changes.
+    """
+    def __init__(self, dbname, callback, keyRange=None, fields=None):
+        self.dbname = dbname
+        self.callback = callback
+        self.keyRange = keyRange
+        self.fields = fields
+        self.pending = {}
+        self.generation = None
+
+    def note(self, pri_key, delta):
+        """dictDB callback: Record the changes DELTA to item PRI_KEY."""
+        if self.keyRange is not None:
+            for val, (low, high) in map(None, pri_key, self.keyRange):
+                if ((low is not None and val < low)
+                    or (high is not None and val > high)):
+                    return
+        if self.fields is not None:
+            fields = {}
+            for field in self.fields:
+                if delta.has_key(field):
+                    fields[field] = delta[field]
+            if not fields:
+                return
+            delta = fields
+        if not self.pending:
+            pendingFeeds.append(self)
+        try:
+            row = self.pending[pri_key]
+        except KeyError:
+            self.pending[pri_key] = delta.copy()
+            return
+        for field, (old, new) in delta.items():
+            if row.has_key(field):
+                old = row[field][0]
+            if old == new:
+                # The field was changed back to its original value.
+                if row.has_key(field):
+                    del row[field]
+            else:
+                row[field] = (old, new)
+        if not row:
+            del self.pending[pri_key]
+
+    def flush(self):
+        """Deliver all recorded changes to the callback."""
+        events = self.pending
+        self.pending = {}
+        if self in pendingFeeds:
+            # Flushed outside of flushChanges().
+            pendingFeeds.remove(self)
+        if events:
+            self.callback(self.dbname, events)
+
+    def cancel(self):
+        """Stop receiving changes."""
+        unsubscribe(self)
+
+def subscribe(dbname, callback, keyRange=None, fields=None):
+    """Register CALLBACK for changes to sub-database DBNAME.
+
+    See the Subscription class for the meaning of the arguments.  The
+    subscription object is returned.
+    """
+    sub = Subscription(dbname, callback, keyRange, fields)
+    subscriberList(dbname).append(sub)
+    return sub
+
+def subscriberList(dbname):
+    """Return the (shared) list of subscriptions to DBNAME."""
+    try:
+        return subscriptions[dbname]
+    except KeyError:
+        subs = subscriptions[dbname] = []
+        return subs
+
+def unsubscribe(sub):
+    """Remove the subscription SUB."""
+    subs = subscriptions.get(sub.dbname, [])
+    if sub in subs:
+        subs.remove(sub)
+    if sub in pendingFeeds:
+        pendingFeeds.remove(sub)
+    sub.pending = {}
+
+def flushChanges():
+    """Deliver the changes recorded since the last call to all subscribers.
+
+    Returns true if any changes were delivered.
+    """
+    global pendingFeeds
+    feeds = pendingFeeds
+    pendingFeeds = []
+    delivered = 0
+    for sub in feeds:
+        if sub.pending:
+            delivered = 1
+            sub.flush()
+    return delivered
+
+def noteChanges(subscribers, pri_key, old, dict):
+    """dictDB helper: Send the changes made by DICT to SUBSCRIBERS.
+
+    OLD is the item (or None for a new item) before DICT was applied.
+    """
+    delta = {}
+    if old is None:
+        for field, new in dict.items():
+            if new is not None:
+                delta[field] = (None, new)
+    else:
+        for field, new in dict.items():
+            val = old.get(field)
+            if val != new:
+                delta[field] = (val, new)
+    if delta:
+        for sub in subscribers:
+            sub.note(pri_key, delta)
+
+###########################################################################
+#############################  History        #############################
+class HistoryDB:
+    """Record the values of sector and unit fields across updates.
+
+    When history is enabled (see DatabaseSaver.historyMode) an instance of
+    this class is stored in megaDB['history'].  It subscribes to the
+    change feed of the sector and unit databases, and each time a dump is
+    processed (see record()) the new value of every changed integer field
+    is stored against the timestamp of the dump.  Only changes are stored,
+    so the history grows with the amount of activity and not with the size
+    of the world.
+
+    The values of a field are kept as a pair of integer arrays (times and
+    values).  The first element of each array is an absolute value; the
+    following elements are differences from the element before.  At most
+    retention values are kept for each field, and values older than maxAge
+    seconds (if it is non-zero) are discarded.
+
+    The attribute journal may be set to a function that is called with
+    the arguments of record() and the changes it stores.  (It is used by
+    DatabaseSaver to implement the database journal.)
+    """
+    tables = ('SECTOR', 'SHIPS', 'PLANES', 'LAND UNITS')
+    # Fields that are never recorded.
+    ignoreFields = {'x': None, 'y': None, 'id': None, 'timestamp': None}
+
+    retention = 48
+    maxAge = 0
+
+    def __getstate__(self):
+        """Pickle module handler: determines what will be saved."""
+        series = {}
+        for key, fields in self.series.items():
+            series[key] = d = {}
+            for field, (times, values, lastTime, lastValue) in fields.items():
+                d[field] = (arrayToString(times), arrayToString(values),
+                            lastTime, lastValue)
+        return {'series': series, 'retention': self.retention,
+                'maxAge': self.maxAge}
+    def __setstate__(self, state):
+        """Pickle module handler: restore a saved class."""
+        self.retention = state['retention']
+        self.maxAge = state['maxAge']
+        self.series = series = {}
+        for key, fields in state['series'].items():
+            series[key] = d = {}
+            for field, (times, values, lastTime, lastValue) in fields.items():
+                d[field] = [stringToArray('i', times),
+                            stringToArray('i', values), lastTime, lastValue]
+        # Changes not yet recorded - {dbname: {pri_key: {field: (old, new)}}}
+        self.pending = {}
+        self.feeds = []
+        # Number of calls to record() that stored changes (see
+        # DatabaseSaver.isDirty()).
+        self.changes = 0
+        # Callback for the database journal (see DatabaseSaver)
+        self.journal = None
+    def __init__(self):
+        self.__setstate__({'series': {}, 'retention': self.retention,
+                           'maxAge': self.maxAge})
+
+    def start(self):
+        """Start following the changes made to the databases."""
+        for dbname in self.tables:
+            self.feeds.append(subscribe(dbname, self.noteChanges))
+    def stop(self):
+        """Stop following the changes made to the databases."""
+        for sub in self.feeds:
+            sub.cancel()
+        self.feeds = []
+        self.pending = {}
+
+    def noteChanges(self, dbname, events):
+        """Change feed callback: Hold changes until the next record()."""
+        try:
+            pending = self.pending[dbname]
+        except KeyError:
+            self.pending[dbname] = events
+            return
+        for pri_key, delta in events.items():
+            try:
+                row = pending[pri_key]
+            except KeyError:
+                pending[pri_key] = delta
+                continue
+            for field, (old, new) in delta.items():
+                if row.has_key(field):
+                    old = row[field][0]
+                row[field] = (old, new)
+
+    def record(self, dbname, timestamp, previous=0, events=None):
+        """Store the changes made to DBNAME as of server time TIMESTAMP.
+
+        PREVIOUS is the time of the last full dump.  It is used as the time
+        of the old value of a field that has no history yet.  If EVENTS is
+        given, those changes are stored in place of the ones noted from
+        the change feed.  (This is used to replay the journal.)
+        """
+        if events is None:
+            for sub in self.feeds:
+                if sub.dbname == dbname:
+                    sub.flush()
+            try:
+                events = self.pending[dbname]
+            except KeyError:
+                return
+            del self.pending[dbname]
+            if self.journal is not None:
+                self.journal(dbname, timestamp, previous, events)
+        self.changes = self.changes + 1
+        # Python optimization - copy frequently used variables into
+        # local namespace.
+        series = self.series;ignoreFields = self.ignoreFields
+        self__append = self.append;__IntType = types.IntType;__type = type
+        if previous >= timestamp:
+            previous = 0
+        for pri_key, delta in events.items():
+            key = (dbname, pri_key)
+            try:
+                fields = series[key]
+            except KeyError:
+                fields = series[key] = {}
+            for field, (old, new) in delta.items():
+                if __type(new) is not __IntType or ignoreFields.has_key(field):
+                    continue
+                try:
+                    values = fields[field]
+                except KeyError:
+                    if previous and __type(old) is __IntType:
+                        # Start with the value the field had before.
+                        values = [array.array('i', [previous]),
+                                  array.array('i', [old]), previous, old]
+                    else:
+                        values = [array.array('i'), array.array('i'), 0, 0]
+                    fields[field] = values
+                self__append(values, timestamp, new)
+            if not fields:
+                del series[key]
+
+    def append(self, values, timestamp, val):
+        """Add VAL at TIMESTAMP to the field history VALUES."""
+        times, vals, lastTime, lastValue = values
+        if not times:
+            times.append(timestamp)
+            vals.append(val)
+        elif timestamp <= lastTime:
+            # Several dumps within the same second - keep the last value.
+            vals[-1] = vals[-1] + val - lastValue
+            timestamp = lastTime
+        else:
+            times.append(timestamp - lastTime)
+            vals.append(val - lastValue)
+        values[2] = timestamp
+        values[3] = val
+        # Enforce the retention policy.
+        drop = max(len(times) - self.retention, 0)
+        if self.maxAge:
+            limit = timestamp - self.maxAge
+            t = reduce(operator.add, times[:drop+1])
+            while drop < len(times) - 1 and t < limit:
+                drop = drop + 1
+                t = t + times[drop]
+        if drop > 0:
+            # The new first element holds an absolute value.
+            times[drop] = reduce(operator.add, times[:drop+1])
+            vals[drop] = reduce(operator.add, vals[:drop+1])
+            del times[:drop], vals[:drop]
+
+    def getFields(self, dbname, pri_key):
+        """Return the list of fields with a history for PRI_KEY."""
+        return self.series.get((dbname, pri_key), {}).keys()
+    def getHistory(self, dbname, pri_key, field):
+        """Return a list of (timestamp, value) pairs for FIELD of PRI_KEY."""
+        try:
+            times, vals = self.series[(dbname, pri_key)][field][:2]
+        except KeyError:
+            return []
+        list = []
+        t = v = 0
+        for dt, dv in map(None, times, vals):
+            t = t + dt
+            v = v + dv
+            list.append((t, v))
+        return list
+
 ###########################################################################
 #############################  Country class  #############################
 
@@ -404,11 +1547,21 @@ class Countries:
         # that should be updated with the newly found id.
         if self.unresolved.has_key(name):
             list = self.unresolved[name]
+            changes = {}
             for dbname, key in list:
-                db = megaDB[dbname][key]
+                db = megaDB[dbname]
+                item = db.get(key)
                 # HACK++
-                if db['owner'] == name:
-                    db['owner'] = id
+                if item is not None and item.get('owner') == name:
+                    # Change the owner with updates() so that the indexes
+                    # and the journal see it.
+                    change = {'owner': id}
+                    map(operator.setitem, (change,)*len(key),
+                        db.primary_keytype, key)
+                    try: changes[dbname].append(change)
+                    except KeyError: changes[dbname] = [change]
+            for dbname, changeList in changes.items():
+                megaDB[dbname].updates(changeList)
             del self.unresolved[name]
         # Update the actual database.
         self.nameList[name] = id
@@ -571,7 +1724,377 @@ def GetPrompt():
     return "[%d:%d] Command : " % (minutes, btus)
 
 ###########################################################################
-#############################  Useful functions ###########################
+#############################  Database IO    #############################
+
+class DatabaseJournal:
+    """Append-only log of changes made to the database.
+
+    Each record is a tuple that is pickled onto the end of the journal file.
+    The file is flushed after every record, so that at most a partial final
+    record can be lost if the client dies.  See DatabaseSaver for the
+    record types that are written.
+
+    Note: There is generally only one instance of this class -
+    empDb.DBIO.journal.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = None
+        self.size = 0
+
+    def replay(self, callback):
+        """Call CALLBACK with every record stored in the journal.
+
+        Returns the number of records found.  A truncated or corrupted
+        final record (as left by a crash) is silently ignored.
+        """
+        try:
+            fl = open(self.filename, "rb")
+        except IOError:
+            return 0
+        count = 0
+        while 1:
+            try:
+                record = cPickle.load(fl)
+            except (EOFError, cPickle.UnpicklingError,
+                    ValueError, IndexError, KeyError):
+                break
+            callback(record)
+            count = count + 1
+        self.size = fl.tell()
+        fl.close()
+        return count
+
+    def append(self, record):
+        """Add RECORD to the end of the journal."""
+        if self.file is None:
+            self.file = open(self.filename, "ab")
+            self.file.seek(0, 2)
+        cPickle.dump(record, self.file, 1)
+        self.file.flush()
+        self.size = self.file.tell()
+
+    def truncate(self):
+        """Discard all records in the journal."""
+        self.close()
+        self.file = open(self.filename, "wb")
+        self.size = 0
+
+    def close(self):
+        """Close the journal file."""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+def transpose(lists):
+    """Return the columns of LISTS as a list of tuples.
+
+    Shorter lists are padded with None.
+    """
+    if len(lists) == 1:
+        return map(lambda val: (val,), lists[0])
+    if lists:
+        return apply(map, [None] + list(lists))
+    return []
+
+def stateColumns(state):
+    """Return (headers, columns) from a dictDB pickle state.
+
+    Each column is a sequence with one value per row - None marks rows
+    that don't have the field.  The state may contain either per-row
+    value lists (primary_values, as written by dictDB.__getstate__) or
+    per-column value lists (primary_columns, as read by decodeTable).
+    """
+    headers = state['primary_headers']
+    if not state.has_key('primary_columns'):
+        columns = transpose(state['primary_values'])
+        count = len(state['primary_values'])
+        return (headers, columns
+                + [(None,)*count] * (len(headers) - len(columns)))
+    count = state['primary_count']
+    columns = []
+    for values, missing in state['primary_columns']:
+        if values is None:
+            values = (None,)*count
+        elif missing:
+            values = list(values)
+            for i in missing:
+                values[i] = None
+        columns.append(values)
+    return (headers, columns)
+
+def stateRows(state):
+    """Return the rows stored in a dictDB pickle state.
+
+    The rows are returned as a list of dictionaries.  See stateColumns().
+    """
+    headers = state['primary_headers']
+    if state.has_key('primary_columns'):
+        valueList = transpose(stateColumns(state)[1])
+    else:
+        valueList = state['primary_values']
+    rows = []
+    for valTuple in valueList:
+        row = {}
+        for i in range(len(valTuple)):
+            val = valTuple[i]
+            if val is not None:
+                row[headers[i]] = val
+        rows.append(row)
+    return rows
+
+# The binary table format:
+
+# The dictDB and columnDB sub-databases are stored on disk in a compact
+# binary format instead of as pickles.  A table starts with tableMagic,
+# followed by the length of a pickled header, the header, and then the
+# data for each column.  Each column is stored as an array of fixed size
+# values (in little endian order) followed by an array of the rows that
+# have no value for the column.  The column types are:
+#     'n' - No row has a value.  (No data is stored.)
+#     'i' - Integers.  The header notes the array type code used.
+#     'd' - Floats.
+#     's' - Strings.  The header holds a table of the distinct strings, and
+#             the column holds indexes into it.
+#     'p' - Anything else.  The column is a pickled list.
+# Columns larger than tableZipSize are compressed with zlib when it is
+# available.
+
+tableMagic = "PTkEI table 1\n"
+tableZipSize = 256
+tableClasses = {'dictDB': dictDB, 'columnDB': columnDB}
+# True if arrays must be byte swapped to/from little endian order.
+tableSwap = (struct.pack('=h', 1) != struct.pack('<h', 1))
+
+def arrayToString(arr):
+    """Return the little endian contents of array ARR."""
+    if tableSwap:
+        arr = arr[:]
+        arr.byteswap()
+    return arr.tostring()
+
+def stringToArray(typecode, data):
+    """Return an array of TYPECODE from little endian string DATA."""
+    arr = array.array(typecode)
+    arr.fromstring(data)
+    if tableSwap:
+        arr.byteswap()
+    return arr
+
+def valueKinds(values):
+    """Return a list of the distinct types in VALUES."""
+    kinds = {}
+    valueTypes = map(type, values)
+    map(operator.setitem, (kinds,)*len(values), valueTypes, valueTypes)
+    return kinds.keys()
+
+def intTypecode(low, high):
+    """Return the smallest array type code that holds LOW through HIGH."""
+    for typecode in 'bhi':
+        bits = array.array(typecode).itemsize * 8 - 1
+        if low >= -(1 << bits) and high < (1 << bits):
+            return typecode
+    return None
+
+def encodeColumn(values):
+    """Return (type, info, data, missing count) for the column VALUES.
+
+    VALUES is a sequence with None for each row that has no value.
+    """
+    count = len(values)
+    missing = []
+    present = values
+    if None in values:
+        missing = filter(lambda i, values=values: values[i] is None,
+                         range(count))
+        if len(missing) == count:
+            return ('n', None, '', 0)
+        present = filter(lambda v: v is not None, values)
+    kinds = valueKinds(present)
+    typecode = None
+    if kinds == [types.IntType]:
+        code, fill = 'i', 0
+        typecode = info = intTypecode(min(present), max(present))
+    elif kinds == [types.FloatType]:
+        code, fill = 'd', 0.0
+        typecode = info = 'd'
+    elif kinds == [types.StringType]:
+        # Replace each string with its index in a table of strings.
+        table = {}
+        map(operator.setitem, (table,)*len(present), present, present)
+        table = table.keys()
+        table.sort()
+        index = {}
+        map(operator.setitem, (index,)*len(table), table, range(len(table)))
+        values = map(index.get, values)
+        code, fill = 's', 0
+        typecode = intTypecode(0, len(table))
+        info = (typecode, table)
+    if typecode is None:
+        # Mixed types or large numbers - just pickle the values.
+        code, info = 'p', None
+        data = cPickle.dumps(list(values), 1)
+    else:
+        if missing:
+            values = list(values)
+            for i in missing:
+                values[i] = fill
+        data = arrayToString(array.array(typecode, values))
+    if missing:
+        data = data + arrayToString(array.array('i', missing))
+    return (code, info, data, len(missing))
+
+def decodeColumn(code, info, data, missing):
+    """Return (values, missing rows) for a column made by encodeColumn."""
+    if code == 'n':
+        return (None, None)
+    if missing:
+        split = len(data) - missing * array.array('i').itemsize
+        missing = stringToArray('i', data[split:]).tolist()
+        data = data[:split]
+    else:
+        missing = []
+    if code == 'p':
+        values = cPickle.loads(data)
+    elif code == 's':
+        typecode, table = info
+        values = map(table.__getitem__, stringToArray(typecode, data))
+    else:
+        values = stringToArray(info, data).tolist()
+    return (values, missing)
+
+def encodeTable(db):
+    """Return DB (a dictDB or columnDB) in the binary table format."""
+    state = db.__getstate__()
+    count = len(state['primary_values'])
+    headers, columns = stateColumns(state)
+    info = []
+    data = []
+    for column in columns:
+        code, colinfo, coldata, missing = encodeColumn(column)
+        zipped = 0
+        if zlib is not None and len(coldata) > tableZipSize:
+            packed = zlib.compress(coldata)
+            if len(packed) < len(coldata):
+                coldata = packed
+                zipped = 1
+        info.append((code, colinfo, len(coldata), missing, zipped))
+        data.append(coldata)
+
+    del state['primary_values']
+    state['class'] = db.__class__.__name__
+    state['primary_count'] = count
+    state['columns'] = info
+    header = cPickle.dumps(state, 1)
+    return string.join([tableMagic, struct.pack('<i', len(header)), header]
+                       + data, '')
+
+def decodeTable(data):
+    """Return a new dictDB or columnDB from a string made by encodeTable."""
+    pos = len(tableMagic)
+    size = struct.unpack('<i', data[pos:pos+4])[0]
+    pos = pos + 4
+    state = cPickle.loads(data[pos:pos+size])
+    pos = pos + size
+    columns = []
+    for code, info, size, missing, zipped in state['columns']:
+        coldata = data[pos:pos+size]
+        pos = pos + size
+        if zipped:
+            if zlib is None:
+                raise DatabaseSaver.dbError, (
+                    "PTkEI: The zlib module is needed to read the database.")
+            coldata = zlib.decompress(coldata)
+        columns.append(decodeColumn(code, info, coldata, missing))
+    state['primary_columns'] = columns
+    db = new.instance(tableClasses[state['class']], {})
+    db.__setstate__(state)
+    return db
+
+class lazyDB:
+    """A dictionary whose values are unpickled on first access.
+
+    This class implements megaDB.  Values that have not been accessed yet
+    are kept as pickled strings in the pending dictionary.  When such a
+    value is first requested it is unpickled (with the decode function),
+    moved to the data
+    dictionary, and the loadHook function (if any) is called with the key
+    and the new value.
+
+    Methods that return all the values of the dictionary (values, items,
+    repr) load every pending value.  Use loadedItems() to avoid this.
+    """
+    def __init__(self, data=None, pending=None, loadHook=None,
+                 decode=cPickle.loads):
+        if data is None:
+            data = {}
+        if pending is None:
+            pending = {}
+        self.data = data
+        self.pending = pending
+        self.loadHook = loadHook
+        self.decode = decode
+    def __getitem__(self, key):
+        try:
+            return self.data[key]
+        except KeyError:
+            return self.loadSegment(key)
+    def __setitem__(self, key, value):
+        if self.pending.has_key(key):
+            del self.pending[key]
+        self.data[key] = value
+    def __delitem__(self, key):
+        if self.pending.has_key(key):
+            del self.pending[key]
+        else:
+            del self.data[key]
+    def __len__(self):
+        return len(self.data) + len(self.pending)
+    def __repr__(self):
+        return repr(self.copy())
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+    def has_key(self, key):
+        return self.data.has_key(key) or self.pending.has_key(key)
+    def keys(self):
+        return self.data.keys() + self.pending.keys()
+    def values(self):
+        return self.copy().values()
+    def items(self):
+        return self.copy().items()
+    def update(self, dict):
+        for key, value in dict.items():
+            self[key] = value
+    def copy(self):
+        """Return a real dictionary with all values loaded."""
+        map(self.loadSegment, self.pending.keys())
+        return self.data.copy()
+
+    def isLoaded(self, key):
+        """Return true if KEY doesn't have a pending (pickled) value."""
+        return not self.pending.has_key(key)
+    def loadedItems(self):
+        """Return the (key, value) pairs that have already been loaded."""
+        return self.data.items()
+    def loadSegment(self, key):
+        """Unpickle the pending value of KEY and return it."""
+        value = self.decode(self.pending[key])
+        del self.pending[key]
+        self.data[key] = value
+        if self.loadHook is not None:
+            self.loadHook(key, value)
+            # The hook may have replaced the value.
+            value = self.data[key]
+        return value
+    def getSegment(self, key):
+        """Return the pickled string for KEY."""
+        try:
+            return self.pending[key]
+        except KeyError:
+            return cPickle.dumps(self.data[key], 1)
 
 class DatabaseSaver:
     """Wrapper class for database IO.
@@ -580,21 +2103,91 @@ class DatabaseSaver:
     disk.  It isn't used when accessing the database - calls to megaDB hit
     the database directly.  This class is used only for disk IO.
 
-    This class has three public attributes:
+    This class has seven public attributes:
         filename - the name of the file that stores the database.
         newDatabase - Boolean flag determines if this is a new database.
         needSave - Boolean flag that determines if the database should be
-                saved upon exiting the client.
+                saved upon exiting the client.  (Even then, the database
+                is only written if it changed since the last save.)
+        journalMode - Boolean flag that enables the database journal.  It
+                must be set before load() is called.
+        sectorClass - The class used to store the sector database (either
+                dictDB or columnDB).  It must be set before load() is
+                called.
+        autoSaveInterval - The number of seconds between background saves
+                started by checkAutoSave().  (Zero disables them.)
+        historyMode - Boolean flag that enables recording the history of
+                the sector and unit databases (see HistoryDB).  It must be
+                set before load() is called.
 
     The attributes newDatabase and needSave are both set externally from
     this class.  They are reset in the empQueue module when a connection is
     made to an empire server.
 
+    In journal mode, the following records are written to the journal:
+        ('updates', dbname, list) - a dictDB.updates() call.
+        ('timestamp', dbname, ts) - a dictDB.setTimestamp() call.
+        ('set', dbname, key, value) - a journalSet() call.
+        ('state', dict) - the contents of sub-databases that are not
+                dictDB or HistoryDB instances.
+        ('messages', dbname, list, last) - new telegrams or announcements.
+        ('history', dbname, ts, previous, changes) - a HistoryDB.record()
+                call.
+        ('reset',) - a reset() call.
+    The sub-databases that are not dictDB or HistoryDB instances are
+    checked for changes by journalState(), which is called when the client
+    exits and every autoSaveInterval seconds by checkAutoSave().  (New
+    telegrams and announcements are checked for every time checkAutoSave()
+    is called.)  The full database is written only when the journal grows
+    larger than the last full snapshot.
+
     Note: There is generally only one instance of this class - empDb.DBIO.
     """
     dbError = "Error saving/loading the database."
     DBVersion = 32.3
 
+    journalMode = 0
+    journal = None
+    # Signatures of the sub-databases as last journaled - see
+    # journalState().
+    journaled = {}
+    sectorClass = dictDB
+    # Don't bother compacting journals smaller than this many bytes.
+    journalMinSize = 1024*1024
+    # Marker at the start of a segmented database file.
+    fileMagic = "PTkEI database"
+    # Sub-databases that are never journaled.  (The prompt is sent again
+    # by the server after every command.)
+    transientState = ('DB_Version', 'prompt')
+    # Sub-databases with a growing 'list' of messages - only the new
+    # messages are journaled.
+    messageDatabases = ('announcements', 'telegrams')
+    # Sub-databases whose update dictionary is the uDB attribute of the
+    # sub-database itself.
+    linkedUpdates = ('SECTOR', 'SHIPS', 'PLANES', 'LAND UNITS', 'NUKES',
+                     'LOST ITEMS', 'countries', 'time')
+    # Sub-databases that are indexed by position (see spatialIndex).
+    spatialIndexes = ('SECTOR', 'SHIPS', 'PLANES', 'LAND UNITS', 'NUKES')
+    # Fields of the sub-databases that have value indexes.
+    valueIndexes = {'SECTOR': ('owner', 'des', 'sdes'),
+                    'SHIPS': ('owner', 'type'),
+                    'PLANES': ('owner', 'type'),
+                    'LAND UNITS': ('owner', 'type'),
+                    'NUKES': ('type',)}
+
+    historyMode = 0
+    history = None
+
+    # Seconds between automatic background saves (0 disables them).
+    autoSaveInterval = 300
+    lastSave = 0
+    saveThread = None
+    saveError = None
+    # The filename and sub-database signatures as of the last successful
+    # save (see isDirty()), and as of the snapshot being written.
+    saved = None
+    pendingSave = None
+
     def reset(self):
         """Reset the main database to an initial state.
 
@@ -604,9 +2197,9 @@ class DatabaseSaver:
         information.
         """
         global megaDB
-        megaDB = {
+        megaDB = lazyDB({
             'DB_Version': self.DBVersion,
-            'SECTOR': dictDB(('x', 'y')),
+            'SECTOR': self.sectorClass(('x', 'y')),
             'SHIPS': dictDB(('id',), ('x', 'y')),
             'PLANES': dictDB(('id',), ('x', 'y')),
             'LAND UNITS': dictDB(('id',), ('x', 'y')),
@@ -644,21 +2237,29 @@ class DatabaseSaver:
             'countries': Countries(),
             'prompt': {'minutes':0, 'BTU':0, 'inform':""},
             'time': EmpTime(),
-            }
+            }, loadHook=self.segmentLoaded)
+        for name in self.spatialIndexes:
+            megaDB[name].addSpatialIndex()
+        for name, fields in self.valueIndexes.items():
+            for field in fields:
+                megaDB[name].addIndex((field,))
+        for name, db in megaDB.loadedItems():
+            if isinstance(db, dictDB):
+                db.subscribers = subscriberList(name)
         self.resetUpdate()
+        self.startHistory()
         self.newDatabase = 1
         self.needSave = 0
+        self.saved = None
+        if self.journal is not None:
+            self.checkJournal()
+            self.attachJournal()
+            self.journal.append(('reset',))
 
     def resetUpdate(self):
         """Reset the update database."""
         global updateDB
         updateDB = {
-            'SECTOR': megaDB['SECTOR'].uDB,
-            'SHIPS': megaDB['SHIPS'].uDB,
-            'PLANES': megaDB['PLANES'].uDB,
-            'LAND UNITS': megaDB['LAND UNITS'].uDB,
-            'NUKES': megaDB['NUKES'].uDB,
-            'LOST ITEMS': megaDB['LOST ITEMS'].uDB,
             'sectortype': {' ': {}},
             'planetype' : {},
             'shiptype' : {},
@@ -668,46 +2269,451 @@ class DatabaseSaver:
             'realm': {},
             'announcements': {},
             'telegrams': {},
-            'countries': megaDB['countries'].uDB,
             'prompt': {},
-            'time': megaDB['time'].uDB
             }
+        for name in self.linkedUpdates:
+            if megaDB.isLoaded(name):
+                updateDB[name] = megaDB[name].uDB
+            else:
+                # The segment will be linked to this dictionary when it is
+                # loaded - see segmentLoaded().
+                updateDB[name] = {}
 
     def load(self, filename):
         """Load database from FILE.
 
-        If the file doesn't exist, create a default database.
+        If the file doesn't exist, create a default database.  The
+        sub-databases are not unpickled until they are first accessed -
+        see lazyDB.
 
         This function should only be used when off-line.
         """
+        self.waitSave()
         self.filename = filename
+        self.lastSave = time.time()
+        self.saved = None
+        if self.journal is not None:
+            # Stop journaling changes to the previous database.
+            self.journal.close()
+            self.journal = None
         global megaDB
         try:
             fl = open(filename, "rb")
         except IOError:
             self.reset()
         else:
-            megaDB = cPickle.load(fl)
-            if megaDB['DB_Version'] != self.DBVersion:
+            header = cPickle.load(fl)
+            if type(header) == types.DictType:
+                # Database from an older version - a single pickled
+                # dictionary.
+                version = header['DB_Version']
+                megaDB = lazyDB(header, loadHook=self.segmentLoaded)
+            else:
+                magic, version, index = header
+                if magic != self.fileMagic:
+                    raise self.dbError, (
+                        "PTkEI: File is not a PTkEI database.")
+                pending = {}
+                for name, size in index:
+                    pending[name] = fl.read(size)
+                megaDB = lazyDB({'DB_Version': version}, pending,
+                                self.segmentLoaded, self.decodeSegment)
+            fl.close()
+            if version != self.DBVersion:
                 raise self.dbError, (
                     "PTkEI: Database has an incorrect version number.")
-            fl.close()
             self.newDatabase = 0
             self.needSave = 0
             self.resetUpdate()
+            for name, db in megaDB.loadedItems():
+                self.segmentLoaded(name, db)
         if not megaDB.has_key('planetype'):
             megaDB['planetype'] = {}
             megaDB['shiptype'] = {}
             megaDB['landtype'] = {}
+        if self.journalMode:
+            self.loadJournal()
+        self.startHistory()
+        if not self.newDatabase:
+            # The file on disk matches the database.
+            self.saved = (self.filename, self.currentState())
+
+    def startHistory(self):
+        """Follow the changes of the current database if history is on."""
+        if self.history is not None:
+            self.history.stop()
+            self.history = None
+        if self.historyMode:
+            if not megaDB.has_key('history'):
+                megaDB['history'] = HistoryDB()
+            self.history = megaDB['history']
+            self.history.start()
+            if self.journal is not None:
+                self.history.journal = self.journalHistory
+
+    def recordHistory(self, dbname, timestamp, previous=0):
+        """Note that a dump of DBNAME was made at server time TIMESTAMP."""
+        if self.history is not None:
+            self.history.record(dbname, timestamp, previous)
+
+    def decodeSegment(self, data):
+        """lazyDB callback: Convert a segment from the file to a value."""
+        if data[:len(tableMagic)] == tableMagic:
+            return decodeTable(data)
+        return cPickle.loads(data)
+
+    def segmentLoaded(self, name, db):
+        """lazyDB callback: Prepare a sub-database that was just loaded."""
+        if name == 'SECTOR' and db.__class__ is not self.sectorClass:
+            # Convert the sector database to the requested storage class.
+            new = self.sectorClass(('x', 'y'))
+            new.__setstate__(db.__getstate__())
+            db = megaDB.data['SECTOR'] = new
+        if name in self.spatialIndexes:
+            db.addSpatialIndex()
+        for field in self.valueIndexes.get(name, ()):
+            db.addIndex((field,))
+        if name in self.linkedUpdates:
+            db.uDB = updateDB[name]
+        if isinstance(db, dictDB):
+            db.subscribers = subscriberList(name)
+        if self.journal is not None and isinstance(db, dictDB):
+            self.attachJournal(name, db)
+        # The segment still matches the copy on disk.
+        for saved in (self.saved, self.pendingSave):
+            if saved is not None and not saved[1].has_key(name):
+                saved[1][name] = self.stateSignature(name, db)
+
+    def loadJournal(self):
+        """Replay the database journal and start journaling changes."""
+        journal = DatabaseJournal(self.filename + ".jnl")
+        if journal.replay(self.replayRecord):
+            self.newDatabase = 0
+            # Replayed changes are not new to the viewers.
+            self.resetUpdate()
+            for i in updateDB.values():
+                i.clear()
+        self.journal = journal
+        self.noteJournaled()
+        try:
+            self.snapshotSize = os.path.getsize(self.filename)
+        except os.error:
+            self.snapshotSize = 0
+        self.attachJournal()
+
+    def replayRecord(self, record):
+        """DatabaseJournal callback: Apply a journal record to megaDB."""
+        type = record[0]
+        if type == 'updates':
+            megaDB[record[1]].updates(record[2])
+        elif type == 'timestamp':
+            db = megaDB[record[1]]
+            db.timestamp = db.unofficial_timestamp = record[2]
+        elif type == 'set':
+            megaDB[record[1]][record[2]] = record[3]
+        elif type == 'state':
+            megaDB.update(record[1])
+        elif type == 'messages':
+            db = megaDB[record[1]]
+            db['list'].extend(record[2])
+            db['last'] = record[3]
+        elif type == 'history':
+            if not megaDB.has_key('history'):
+                megaDB['history'] = HistoryDB()
+            apply(megaDB['history'].record, record[1:])
+        elif type == 'reset':
+            self.reset()
+
+    def checkJournal(self):
+        """Make sure the journal belongs to the current database file.
+
+        Returns true if a new (empty) journal had to be started.
+        """
+        name = self.filename + ".jnl"
+        if self.journal.filename == name:
+            return 0
+        self.journal.close()
+        self.journal = DatabaseJournal(name)
+        self.journal.truncate()
+        self.snapshotSize = 0
+        self.journaled = {}
+        return 1
+
+    def attachJournal(self, name=None, db=None):
+        """Register the journal callbacks with the dictDB databases.
+
+        If NAME and DB are given, only register the callback for DB.
+        Sub-databases that haven't been loaded yet are registered when
+        they are loaded.
+        """
+        if db is None:
+            for name, db in megaDB.loadedItems():
+                if isinstance(db, dictDB):
+                    self.attachJournal(name, db)
+            if self.history is not None:
+                self.history.journal = self.journalHistory
+            return
+        db.journal = (lambda type, value, name=name, self=self:
+                      self.journalAppend((type, name, value)))
+
+    def journalAppend(self, record):
+        """Add a record to the journal; compact the journal if needed."""
+        journal = self.journal
+        journal.append(record)
+        if journal.size > max(self.snapshotSize, self.journalMinSize):
+            self.compact()
+
+    def journalHistory(self, dbname, timestamp, previous, events):
+        """HistoryDB callback: Journal the changes stored by record()."""
+        if self.journal is not None:
+            self.journalAppend(('history', dbname, timestamp, previous,
+                                events))
+
+    def journalSet(self, dbname, key, value):
+        """Note that megaDB[DBNAME][KEY] has been set to VALUE."""
+        if self.journal is not None:
+            self.journalAppend(('set', dbname, key, value))
+
+    def compact(self):
+        """Fold the journal into a new full snapshot of the database."""
+        self.writeSnapshot()
+        self.journal.truncate()
+        self.noteJournaled()
+
+    def stateSignature(self, name, db):
+        """Return a value that changes whenever sub-database DB changes.
+
+        See journalState().
+        """
+        if name in self.messageDatabases:
+            lst = db.get('list', [])
+            last = None
+            if lst:
+                last = lst[-1]
+            return (id(lst), len(lst), last, db.get('last'))
+        if isinstance(db, dictDB):
+            return (id(db), db.generation, db.timestamp)
+        if isinstance(db, HistoryDB):
+            return db.changes
+        return cPickle.dumps(db, 1)
+
+    def currentState(self):
+        """Return the signatures of all the loaded sub-databases."""
+        state = {}
+        for name, db in megaDB.loadedItems():
+            if name not in self.transientState:
+                state[name] = self.stateSignature(name, db)
+        return state
+
+    def isDirty(self):
+        """Return true if the database changed since it was last saved."""
+        if self.saved is None:
+            return 1
+        filename, state = self.saved
+        return filename != self.filename or state != self.currentState()
+
+    def noteSaved(self):
+        """Note that the last snapshot was written successfully."""
+        self.saved = self.pendingSave
+        self.pendingSave = None
+
+    def noteJournaled(self):
+        """Note that the journal holds the current state of the database."""
+        self.journaled = {}
+        for name, db in megaDB.loadedItems():
+            if self.isStateJournaled(name, db):
+                self.journaled[name] = self.stateSignature(name, db)
+
+    def isStateJournaled(self, name, db):
+        """Return true if DB is journaled by journalState().
+
+        The dictDB and HistoryDB sub-databases journal each change as it is
+        made instead.
+        """
+        return (not isinstance(db, dictDB) and not isinstance(db, HistoryDB)
+                and name not in self.transientState)
+
+    def journalState(self, full=1):
+        """Journal the sub-databases that aren't dictDB instances.
+
+        Each of these sub-databases that changed since it was last
+        journaled is written to the journal.  When messages have only been
+        added to the end of a telegram or announcement list, just the new
+        messages are written.  If FULL is false only the telegrams and
+        announcements are checked - the other sub-databases are pickled to
+        find their changes, which is too slow to do often.
+        """
+        if self.journal is None:
+            return
+        state = {}
+        for name, db in megaDB.loadedItems():
+            if not self.isStateJournaled(name, db):
+                continue
+            if not full and name not in self.messageDatabases:
+                continue
+            new = self.stateSignature(name, db)
+            old = self.journaled.get(name)
+            if old == new:
+                continue
+            self.journaled[name] = new
+            if (name in self.messageDatabases and old is not None
+                and old[0] == new[0] and old[1] < new[1]
+                and (not old[1] or db['list'][old[1]-1] is old[2])):
+                self.journalAppend(('messages', name, db['list'][old[1]:],
+                                    db.get('last')))
+            else:
+                state[name] = db
+        if state:
+            self.journalAppend(('state', state))
+
+    def writeSnapshot(self):
+        """Write a full copy of the database to disk."""
+        self.writeDatabase(self.takeSnapshot())
+        self.noteSaved()
+        self.snapshotSize = os.path.getsize(self.filename)
 
     def save(self):
         """Write the database back to disk."""
+        # Let any background save finish first.
+        self.waitSave()
         if not self.needSave:
             # No need to save anything
             return
+        if self.journal is not None:
+            if self.checkJournal():
+                # The database is being saved under a new name.
+                print "PTkEI: Saving DB to '%s'.." % self.filename
+                self.writeSnapshot()
+                return
+            # Only the changes that aren't journaled yet need saving.
+            self.journalState()
+            self.journal.close()
+            return
+        if not self.isDirty():
+            # Nothing changed since the last save.
+            return
         print "PTkEI: Saving DB to '%s'.." % self.filename
-        fl = open(self.filename, 'wb')
-        cPickle.dump(megaDB, fl, 1)
+        self.writeDatabase(self.takeSnapshot())
+        self.noteSaved()
+        self.lastSave = time.time()
+
+    def saveAsync(self):
+        """Write the database to disk on a background thread.
+
+        A consistent snapshot of the database is taken immediately; the
+        snapshot is then pickled and written by a worker thread.  Returns
+        true if a save was started.  Use waitSave() to wait for the save
+        to complete.  No save is started if one is already running, if the
+        database hasn't changed since the last save, or if the journal is
+        enabled.  (The journal already keeps the file on disk up to date.)
+        """
+        if (not self.needSave or self.journal is not None
+            or self.saveThread is not None):
+            return 0
+        self.lastSave = time.time()
+        if not self.isDirty():
+            return 0
+        snapshot = self.takeSnapshot()
+        if threading is None:
+            self.writeDatabase(snapshot)
+            self.noteSaved()
+            return 1
+        self.saveThread = threading.Thread(target=self.saveWorker,
+                                           args=(snapshot,))
+        self.saveThread.start()
+        return 1
+
+    def saveWorker(self, snapshot):
+        """Thread function: Write SNAPSHOT and note any errors."""
+        try:
+            self.writeDatabase(snapshot)
+        except:
+            self.saveError = sys.exc_info()
+
+    def waitSave(self):
+        """Wait for a background save to complete.
+
+        If the background save failed, its exception is raised here.
+        """
+        if self.saveThread is None:
+            return
+        self.saveThread.join()
+        self.saveThread = None
+        error = self.saveError
+        if error is not None:
+            self.saveError = None
+            self.pendingSave = None
+            raise error[0], error[1], error[2]
+        self.noteSaved()
+
+    def checkAutoSave(self):
+        """Timer callback: Start a background save when one is due.
+
+        This should be called periodically by the viewer.  Errors from a
+        completed background save are raised from this method.
+        """
+        if self.journal is not None:
+            now = time.time()
+            full = (self.autoSaveInterval
+                    and now - self.lastSave >= self.autoSaveInterval)
+            if full:
+                self.lastSave = now
+            self.journalState(full)
+            return
+        if self.saveThread is not None:
+            if self.saveThread.isAlive():
+                return
+            self.waitSave()
+        if (self.autoSaveInterval
+            and time.time() - self.lastSave >= self.autoSaveInterval):
+            self.saveAsync()
+
+    def takeSnapshot(self):
+        """Return a consistent copy of megaDB for writeDatabase().
+
+        The dictDB sub-databases are copied with dictDB.snapshot(); the
+        remaining (small) sub-databases are pickled immediately.
+        Sub-databases that were never loaded are used as is.
+        """
+        self.pendingSave = (self.filename, self.currentState())
+        names = megaDB.keys()
+        names.remove('DB_Version')
+        names.sort()
+        segments = []
+        for name in names:
+            if megaDB.isLoaded(name) and isinstance(megaDB[name], dictDB):
+                segments.append(megaDB[name].snapshot())
+            else:
+                segments.append(megaDB.getSegment(name))
+        return (self.filename, megaDB['DB_Version'], names, segments)
+
+    def writeDatabase(self, snapshot):
+        """Write SNAPSHOT to disk as a series of segments.
+
+        The file is written to a temporary file first, synced, and then
+        renamed over the old database, so that a crash while saving can
+        never destroy the previous database.  The dictDB sub-databases are
+        stored in the binary table format (see encodeTable).
+        """
+        filename, version, names, segments = snapshot
+        for i in range(len(segments)):
+            if type(segments[i]) != types.StringType:
+                segments[i] = encodeTable(segments[i])
+        index = map(None, names, map(len, segments))
+
+        tmpname = filename + ".new"
+        fl = open(tmpname, 'wb')
+        cPickle.dump((self.fileMagic, version, index), fl, 1)
+        map(fl.write, segments)
+        fl.flush()
+        if hasattr(os, 'fsync'):
+            os.fsync(fl.fileno())
         fl.close()
+        try:
+            os.rename(tmpname, filename)
+        except os.error:
+            # Non-posix systems won't rename over an existing file.
+            os.remove(filename)
+            os.rename(tmpname, filename)
 
 DBIO = DatabaseSaver()
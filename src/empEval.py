@@ -20,9 +20,12 @@ import string
 import re
 import operator
 import sys
+import tokenize
+import StringIO
 
 import empDb
 import empParse
+import empVector
 
 
 # Key Ideas:
@@ -44,94 +47,84 @@ import empParse
 # string result.  The function foreach() is a combination of getSectors()
 # and evalString() - given an arbitrary python test-expression and an
 # arbitrary python string-expression, for every element in a database that
-# tests true it returns an evaluation of the string.
+# tests true it returns an evaluation of the string.  The function tally()
+# finds the count, sum, minimum, and maximum of selectors over the items
+# that test true, optionally grouped by the value of another selector.
 
 
 # How the evaluation occurs:
 
-# For performance reasons, the method used to achieve these evaluations is
-# rather cumbersome.  For each database that can be queried, an instance of
-# the class delayedBinding is created.  The delayedBinding class basically
-# defines all the operator-overloading methods supported by python
-# (__add__, __mul__, etc.).  When one of these class methods is invoked,
-# the actual variable reference is extracted from a class variable
-# (delayedValue).  (The variable delayedValue is essentially a global
-# variable - this class is not multi-threaded safe.)  The instance then
-# simulates the requested operation with this extracted variable. By
-# delaying the binding of delayedValue until the actual time of the desired
-# operation, the class can get away with delaying or avoiding the cost of
-# an entire database conversion.  This leads to a significant improvement
-# in performance; however, the methods used are questionable at best - it
-# may be replaced sometime in the future.
+# Every database that can be queried has a table (see initializeSelectors())
+# that maps the empire selector names and their abbreviations onto the
+# fields of the local database.  Before an expression is evaluated,
+# compileExpr() rewrites each selector name it contains into a direct
+# lookup on the current item - 'civ>100 and mob<50' becomes
+# "__row['civ']>100 and __row['mob']<50".  Computed identifiers (such as
+# 'sect', 'dist', and 'newdes') become calls to helper functions that are
+# given the item, and the functions 'distance()', '__area()', and
+# '__circle()' are passed the item as an extra first argument.  The
+# rewritten expression is then compiled into a plain function that loops
+# over the database.  An item that doesn't have one of the referenced
+# fields (a KeyError) or that uses an unknown name (a NameError) is
+# skipped.
+
+
+# Query planning:
+
+# Area selections (realms, ranges, and circles) are converted by
+# selectToExpr() into calls to the internal functions __area() and
+# __circle().  Before a database is scanned, a QueryPlan is made for the
+# condition.  The top level terms of the condition are classified by
+# parseTerms(): area and circle tests can be answered by the spatial index
+# of the database, and tests of the form 'field==value' (eg. 'owner==-1'
+# or "des=='g'") by its value indexes (see dictDB.addIndex()).  If NumPy
+# is installed, the simple terms of a sector query may also be answered
+# together by the vector engine (see empVector.py).  The access path
+# expected to return the fewest items is used to select the candidates,
+# and only the remaining (residual) terms are tested on those items.  The
+# 'explain' command shows the plan chosen for a selector.
+
+
+# Compiled queries:
+
+# Every query is compiled into a small python function by execCodeblock().
+# Aliases and scripts tend to issue the same queries over and over, so the
+# compiled functions are kept in queryCache.  The cache is keyed on the
+# database name and the condition and output expressions, and holds the
+# most recently used entries.
 
 ###########################################################################
-#############################  Evaluate Class   ###########################
+#############################  Row functions    ###########################
 
-class delayedBinding:
-    """Delays a binding of a variable until runtime.
+class rowFunction:
+    """A selector that is called like a function.
 
-    This is a total hack!
+    FUNC is called with the current item followed by the arguments given
+    in the expression.  (Eg. 'distance(3,5)' calls FUNC(item, 3, 5).)
     """
-    delayedValue = None
-    operator = operator
-    for i, j in [
-        ('__add__', 'self.operator.add'), ('__sub__', 'self.operator.sub'),
-        ('__mul__', 'self.operator.mul'), ('__div__', 'self.operator.div'),
-        ('__mod__', 'self.operator.mod'),
-        ('__lshift__', 'self.operator.lshift'),
-        ('__rshift__', 'self.operator.__rshift__'),
-        ('__and__', 'self.operator.__and__'),
-        ('__or__', 'self.operator.__or__'), ('__xor__', 'self.operator.xor'),
-        ('__concat__', 'self.operator.concat'),
-        ('__repeat__', 'self.operator.repeat'),
-        ('__cmp__', 'cmp'), #('__coerce__', 'coerce'),
-        ]:
-        exec ("def "+i+"(self, other):\n"
-              +" return "+j+"(self.convertField(), other)\n")
-    for i, j in [
-        ('__radd__', 'self.operator.add'), ('__rsub__', 'self.operator.sub'),
-        ('__rmul__', 'self.operator.mul'), ('__rdiv__', 'self.operator.div'),
-        ('__rmod__', 'self.operator.mod'),
-        ('__rlshift__', 'self.operator.lshift'),
-        ('__rrshift__', 'self.operator.__rshift__'),
-        ('__rand__', 'self.operator.__and__'),
-        ('__ror__', 'self.operator.__or__'), ('__rxor__', 'self.operator.xor'),
-        ]:
-        exec ("def "+i+"(self, other):\n"
-              +" return "+j+"(other, self.convertField())\n")
-    for i, j in [
-        ('__neg__', 'self.operator.neg'), ('__pos__', 'self.operator.pos'),
-        ('__abs__', 'self.operator.abs'), ('__invert__', 'self.operator.inv'),
-        ('__not__', 'self.operator.__not__'),
-        ('__int__', 'int'), ('__long__', 'long'), ('__float__', 'float'),
-        ('__oct__', 'oct'), ('__hex__', 'hex'),
-        ('__nonzero__', 'self.operator.truth'),
-        ('__hash__', 'hash'), ('__str__', 'str'), ('__repr__', 'repr')
-        ]:
-        exec ("def "+i+"(self):\n"
-              +" return "+j+"(self.convertField())\n")
-    def __init__(self, name):
-        self.name = name
-    def __call__(self, *args, **kw):
-        return apply(self.convertField(), args, kw)
-    def convertField(self):
-        try:
-            if callable(self.name):
-                val = self.name(self.delayedValue)
-            else:
-                val = self.delayedValue[self.name]
-        except KeyError, e:
-            raise NameError, e
-##  	try:
-##  	    val = empDb.fixedAtoI(val)
-##  	except ValueError:
-##  	    try:
-##  		val = float(val)
-##  	    except ValueError:
-##  		pass
-##  	except TypeError:
-##  	    pass
-        return val
+    def __init__(self, func):
+        self.func = func
+    def bind(self, row):
+        """Return a function that calls FUNC on ROW."""
+        return boundRowFunction(self.func, row)
+
+class boundRowFunction:
+    """A rowFunction that has been given its item."""
+    def __init__(self, func, row):
+        self.func = func
+        self.row = row
+    def __call__(self, *args):
+        return apply(self.func, (self.row,)+args)
+
+def rowDistance(row, x, y):
+    return empDb.sectorDistance((row['x'], row['y']), (x, y))
+
+def rowArea(row, minX, maxX, minY, maxY):
+    return (empDb.inRange(row['x'], minX, maxX)
+            and empDb.inRange(row['y'], minY, maxY))
+
+def rowCircle(row, x, y, dist):
+    return empDb.sectorDistance((row['x'], row['y']), (x, y)) <= dist
 
 ###########################################################################
 #############################  Empire Selectors ###########################
@@ -147,9 +140,11 @@ def initializeSelectors():
         ('sect', 3, (lambda ldb:
                      ("%s,%s" % (ldb['x'], ldb['y'])))),
         # Function that reports sector distance -- distance(x,y)
-        ('distance', 8, (lambda ldb:
-                         (lambda x, y, __fromx=ldb['x'], __fromy=ldb['y']:
-                          (empDb.sectorDistance((__fromx, __fromy), (x, y))))))
+        ('distance', 8, rowFunction(rowDistance)),
+
+        # Internal area tests generated by selectToExpr()
+        ('__area', 6, rowFunction(rowArea)),
+        ('__circle', 8, rowFunction(rowCircle)),
         ]
 
     commodityConversion = [
@@ -253,12 +248,12 @@ def initializeSelectors():
                 val = i[0]
             else:
                 val = i[2]
-            delayedVar = delayedBinding(val)
             for j in range(i[1], len(i[0])+1):
-                dict[i[0][:j]] = delayedVar
+                dict[i[0][:j]] = val
         return dict
 
-    # Initialize the execution eviornments for database evaluations.
+    # Initialize the selector tables.  Each maps a selector name to either
+    # a field name, a function of the item, or a rowFunction.
     global selectors
     selectors = {
         'SECTOR': createConversionDB(sectorConversion),
@@ -304,10 +299,10 @@ conditionsFormat = re.compile(
 def selectToExpr(dbname, range, cond):
     """Convert a standard empire range/selectors to a python expression.
 
-    This takes a range of the form 'x1:x2,y1:y2', 'x,y', '#?', or '*' (all
-    the possible empire ranges) and a cond of the form 'var[#=<>]var&...',
-    and converts it to a valid python expression.  (IE. 'xl>=x1 and xl<=x2
-    and yl>=y1 and yl<=y2 and var==var and ...').  The result of this can
+    This takes a range of the form 'x1:x2,y1:y2', 'x,y', '#?', '@x,y:d',
+    or '*' (all the possible empire ranges) and a cond of the form
+    'var[#=<>]var&...', and converts it to a valid python expression.
+    (IE. '__area(x1,x2,y1,y2) and var==var and ...').  The result of this can
     then be passed to getSectors or foreach to return a list of db items
     that apply.
 
@@ -328,44 +323,19 @@ def selectToExpr(dbname, range, cond):
         try: val = empDb.megaDB['realm'][rm]
         except KeyError:
             raise error, "Realm not in database."
-        minX, maxX, minY, maxY = val
-        if minX < maxX: 
-            conditions = map(operator.add, ("xl>=", "xl<="),
-                             map(str, (minX, maxX)))
-        elif minX > maxX:
-            conditions = ["(xl >= %d or xl <= %d)" % (minX, maxX)]
-        else:
-            conditions = ["xl==%d" % (minX)]
-        if minY < maxY: 
-            conditions = conditions + map(operator.add, ("yl>=", "yl<="),
-                                          map(str, (minY, maxY)))
-        elif minY > maxY:
-            conditions.append("(yl >= %d or yl <= %d)" % (minY, maxY))
-        else:
-            conditions.append("yl==%d" % (minY))
+        conditions = ["__area(%d,%d,%d,%d)" % tuple(val)]
     elif mc.group('minX'):
         # Range
+        minX = maxX = int(mc.group('minX'))
         if mc.group('maxX'):
-            minX, maxX = map(int, mc.group('minX', 'maxX'))
-            if minX < maxX: 
-                conditions = map(operator.add, ("xl>=", "xl<="),
-                                 mc.group('minX', 'maxX'))
-            elif minX > maxX:
-                conditions = ["(xl >= %s or xl <= %s)" % mc.group('minX', 'maxX')]
-        else:
-            conditions = ["xl==" + mc.group('minX')]
+            maxX = int(mc.group('maxX'))
+        minY = maxY = int(mc.group('minY'))
         if mc.group('maxY'):
-            minY, maxY = map(int, mc.group('minY', 'maxY'))
-            if minY < maxY: 
-                conditions = conditions + map(operator.add, ("yl>=", "yl<="),
-                                 mc.group('minY', 'maxY'))
-            elif minY > maxY:
-                conditions.append("(yl >= %s or yl <= %s)" % mc.group('minY', 'maxY'))
-        else:
-            conditions.append("yl==" + mc.group('minY'))
+            maxY = int(mc.group('maxY'))
+        conditions = ["__area(%d,%d,%d,%d)" % (minX, maxX, minY, maxY)]
     elif mc.group('cirX'):
         # Circular area
-        conditions = ["distance(%s,%s)<=%s" % mc.group('cirX', 'cirY', 'cirD')]
+        conditions = ["__circle(%s,%s,%s)" % mc.group('cirX', 'cirY', 'cirD')]
     else:
         # All ('*') selection
         conditions = []
@@ -422,41 +392,417 @@ def estrToExpr(txt):
 ###########################################################################
 #############################  Eval functions   ###########################
 
+def compileExpr(dbname, expr):
+    """Rewrite EXPR so that its selectors read from the local '__row'.
+
+    Returns a tuple containing the new expression and a dictionary of the
+    helper functions it needs.  (See 'How the evaluation occurs' above.)
+    """
+    envio = selectors[dbname]
+    tokens = []
+    try:
+        tokenize.tokenize(StringIO.StringIO(expr).readline,
+                          lambda type, token, start, end, line, tokens=tokens:
+                          tokens.append((type, token, start, end)))
+    except tokenize.TokenError:
+        # Let the compiler report the error.
+        return expr, {}
+    # Offsets of the start of each line of EXPR.
+    offsets = [0, 0]
+    for line in string.split(expr, "\n"):
+        offsets.append(offsets[-1] + len(line) + 1)
+    helpers = {}
+    out = []
+    pos = 0
+    last = None
+    for i in range(len(tokens)):
+        kind, token, start, end = tokens[i]
+        if (kind != tokenize.NAME or not envio.has_key(token)
+            or last == '.'):
+            last = token
+            continue
+        last = token
+        next = None
+        if i + 1 < len(tokens):
+            next = tokens[i+1]
+            if next[1] == '=':
+                # Keyword argument
+                continue
+        target = envio[token]
+        begin = offsets[start[0]] + start[1]
+        finish = offsets[end[0]] + end[1]
+        if type(target) == type(""):
+            code = "__row[%s]" % `target`
+        elif isinstance(target, rowFunction):
+            if next is not None and next[1] == '(':
+                name = "__call_" + token
+                helpers[name] = target.func
+                code = name + "(__row,"
+                finish = offsets[next[3][0]] + next[3][1]
+            else:
+                name = "__bind_" + token
+                helpers[name] = target.bind
+                code = name + "(__row)"
+        else:
+            name = "__get_" + token
+            helpers[name] = target
+            code = name + "(__row)"
+        out.append(expr[pos:begin])
+        out.append(code)
+        pos = finish
+    out.append(expr[pos:])
+    return string.join(out, ""), helpers
+
 def evalString(expr, dbname, db):
     """Evaluate an expression and return the result."""
-    envio = selectors[dbname]
-    delayedBinding.delayedValue = db
     try:
-        return eval(expr, envio)
+        f = queryCache.get((dbname, expr))
+        if f is None:
+            code, envio = compileExpr(dbname, expr)
+            f = eval("lambda __row: (%s)" % code, envio)
+            queryCache.add((dbname, expr), f)
+        return f(db)
     except:
         raise error, (
             'Evaluate error!\n"%s" raised %s with detail:\n"%s".'
             % ((expr,)+tuple(sys.exc_info()[:2])))
 
-def execCodeblock(dbname, execStr):
-    """Execute a string for every item in a database.
+def splitConjuncts(expr):
+    """Split the python expression EXPR at its top level 'and' operators.
+
+    Returns a list of the sub-expressions, or None if EXPR isn't a simple
+    conjunction.  (IE. it has a top level 'or'.)
+    """
+    tokens = []
+    try:
+        tokenize.tokenize(StringIO.StringIO(expr).readline,
+                          lambda type, token, start, end, line, tokens=tokens:
+                          tokens.append((type, token, start, end)))
+    except tokenize.TokenError:
+        return None
+    depth = 0
+    begin = 0
+    terms = []
+    for type, token, start, end in tokens:
+        if type == tokenize.NEWLINE or start[0] != 1:
+            # Only single line expressions are understood.
+            if type in (tokenize.NEWLINE, tokenize.ENDMARKER):
+                continue
+            return None
+        if type == tokenize.OP:
+            if token in '([{':
+                depth = depth + 1
+            elif token in ')]}':
+                depth = depth - 1
+        elif type == tokenize.NAME and depth == 0:
+            if token == 'and':
+                terms.append(string.strip(expr[begin:start[1]]))
+                begin = end[1]
+            elif token in ('or', 'lambda', 'if', 'else'):
+                return None
+    terms.append(string.strip(expr[begin:]))
+    return terms
+
+def findValue(db, field, value):
+    """Return the items of DB with FIELD equal to VALUE.
+
+    Returns None if DB doesn't have an index that can answer this.
+    """
+    if db.secondary.has_key((field,)):
+        return db.getSec((field,)).get((value,), {})
+    if field == 'newdes':
+        # newdes is sdes, unless sdes is '_' - then it is des.
+        byDes = findValue(db, 'des', value)
+        bySdes = findValue(db, 'sdes', value)
+        if byDes is None or bySdes is None:
+            return None
+        found = intersectItems([byDes, findValue(db, 'sdes', '_')])
+        found.update(bySdes)
+        return found
+    return None
+
+def intersectItems(dicts):
+    """Return a new dictionary of the items found in every one of DICTS."""
+    dicts = map(None, map(len, dicts), dicts)
+    dicts.sort()
+    result = dicts[0][1].copy()
+    for size, dict in dicts[1:]:
+        for key in result.keys():
+            if not dict.has_key(key):
+                del result[key]
+    return result
+
+areaFormat = re.compile(r"^__area\((-?\d+),(-?\d+),(-?\d+),(-?\d+)\)$")
+circleFormat = re.compile(r"^__circle\((-?\d+),(-?\d+),(\d+)\)$")
+valueFormat = re.compile(
+    r"^(?P<var>[a-z_][a-z0-9_]*)==(?P<val>-?\d+|'[^'\\]*'|\"[^\"\\]*\")$")
+class QueryCache:
+    """Cache of the most recently used compiled query functions."""
+    size = 64
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        """Forget all compiled functions and reset the counters."""
+        self.funcs = {}
+        # Keys in order of use - the least recently used is first.
+        self.order = []
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        """Return the function stored under KEY, or None."""
+        func = self.funcs.get(key)
+        if func is None:
+            self.misses = self.misses + 1
+            return None
+        self.hits = self.hits + 1
+        order = self.order
+        if order[-1] != key:
+            order.remove(key)
+            order.append(key)
+        return func
+
+    def add(self, key, func):
+        """Store FUNC under KEY, discarding the oldest entry if full."""
+        if len(self.order) >= self.size:
+            del self.funcs[self.order[0]]
+            del self.order[0]
+        self.funcs[key] = func
+        self.order.append(key)
+
+queryCache = QueryCache()
+
+def axisSpan(low, high, size):
+    """Return the number of coordinates in the (possibly wrapped) range."""
+    if low <= high:
+        return min(high - low + 1, size)
+    return max(size - (low - high) + 1, 0)
+
+class QueryPlan:
+    """The way the items that may match an expression are found.
+
+    The top level terms of the expression are classified (see
+    parseTerms()), and each term that can be answered by an index becomes
+    a possible access path.  The path expected to return the fewest items
+    is chosen; every other term is residual and is only tested against the
+    items returned by the access path.  If no path applies, the whole
+    database is scanned.
+
+    The plan has the following attributes:
+        terms - the classified terms of the expression, or None if the
+                expression isn't a simple conjunction.
+        paths - a list of (estimate, description, function, terms,
+                keysFunction) tuples.  function() returns the dictionary
+                of candidate items, and terms is the list of the terms
+                answered by the path.  keysFunction() returns the sorted
+                keys of the candidates (it may be None).
+        access - the chosen path (or None for a full scan).
+        residual - the text of the terms not answered by the access path.
+    """
+    def __init__(self, dbname, expr):
+        self.dbname = dbname
+        self.expr = expr
+        self.paths = []
+        self.access = None
+        self.terms = parseTerms(dbname, expr)
+        if self.terms is None:
+            self.residual = [expr]
+            return
+        db = empDb.megaDB[dbname]
+        if isinstance(db, empDb.dictDB):
+            for term in self.terms:
+                path = self.accessPath(db, term)
+                if path is not None:
+                    self.paths.append(path + ([term], None))
+            if empVector.usable(dbname, db):
+                path = empVector.vectorPath(dbname, self.terms,
+                                            selectors[dbname])
+                if path is not None:
+                    self.paths.append(path)
+        self.paths.sort()
+        residual = []
+        if self.paths:
+            self.access = self.paths[0]
+        for term in self.terms:
+            if self.access is None or not isUsed(term, self.access[3]):
+                residual.append(term[-1])
+        self.residual = residual
+
+    def accessPath(self, db, term):
+        """Return an (estimate, description, function) tuple for TERM.
+
+        None is returned if TERM can't be answered by an index.
+        """
+        kind = term[0]
+        if kind == 'area':
+            minX, maxX, minY, maxY = term[1:5]
+            worldX, worldY = empDb.megaDB['version']['worldsize']
+            # Only every other coordinate holds a sector.
+            count = (axisSpan(minX, maxX, worldX)
+                     * axisSpan(minY, maxY, worldY) + 1) / 2
+            return (count, "box %d:%d,%d:%d" % (minX, maxX, minY, maxY),
+                    lambda db=db, args=(minX, maxX, minY, maxY):
+                    apply(db.getRange, args))
+        elif kind == 'circle':
+            x, y, dist = term[1:4]
+            return (3*dist*(dist+1) + 1,
+                    "circle @%d,%d:%d" % (x, y, dist),
+                    lambda db=db, coord=(x, y), dist=dist:
+                    db.getRadius(coord, dist))
+        elif kind == 'value':
+            field, value = term[1:3]
+            items = findValue(db, field, value)
+            if items is None:
+                return None
+            return (len(items), "index %s==%s" % (field, `value`),
+                    lambda items=items: items)
+        elif kind == 'newdes':
+            value = term[1]
+            byDes = findValue(db, 'des', value)
+            bySdes = findValue(db, 'sdes', value)
+            if byDes is None or bySdes is None:
+                return None
+            # Combining the des and sdes indexes is expensive - prefer any
+            # other index.
+            return (2 * (len(byDes) + len(bySdes)) + 1,
+                    "index newdes==%s" % `value`,
+                    lambda db=db, value=value: findValue(db, 'newdes', value))
+        return None
+
+    def candidates(self):
+        """Return the dictionary of candidate items, or None for a scan."""
+        if self.access is None:
+            return None
+        return self.access[2]()
+
+    def keys(self):
+        """Return the sorted keys of the candidates, or None for a scan."""
+        if self.access is None:
+            return None
+        if self.access[4] is not None:
+            return self.access[4]()
+        keys = self.candidates().keys()
+        keys.sort()
+        return keys
+
+    def describe(self):
+        """Return a list of lines that describe the plan."""
+        lines = []
+        if self.access is None:
+            lines.append("Access path: full scan")
+        else:
+            lines.append("Access path: %s (about %d items)"
+                         % (self.access[1], self.access[0]))
+            for path in self.paths[1:]:
+                lines.append("  Not used: %s (about %d items)"
+                             % (path[1], path[0]))
+        if self.terms is None:
+            lines.append("Residual: %s  (not a simple conjunction)"
+                         % self.expr)
+        elif self.residual:
+            lines.append("Residual: " + string.join(self.residual, " and "))
+        return lines
+
+def isUsed(term, terms):
+    """Return true if TERM is one of the list TERMS."""
+    for i in terms:
+        if i is term:
+            return 1
+    return 0
+
+termCache = QueryCache()
+def parseTerms(dbname, expr):
+    """Classify the top level terms of EXPR.
+
+    Returns a list with one tuple per term, or None if EXPR isn't a simple
+    conjunction.  The last element of each tuple is the text of the term.
+    The tuples are one of:
+        ('area', minX, maxX, minY, maxY, text)
+        ('circle', x, y, dist, text)
+        ('value', field, value, text) - a test of field==value.
+        ('newdes', value, text)
+        ('other', text)
+    """
+    terms = termCache.get((dbname, expr))
+    if terms is not None:
+        return terms[0]
+    envio = selectors[dbname]
+    texts = splitConjuncts(expr)
+    terms = None
+    if texts is not None:
+        terms = []
+        for text in texts:
+            mc = areaFormat.match(text)
+            if mc:
+                terms.append(('area',) + tuple(map(int, mc.groups()))
+                             + (text,))
+                continue
+            mc = circleFormat.match(text)
+            if mc:
+                terms.append(('circle',) + tuple(map(int, mc.groups()))
+                             + (text,))
+                continue
+            mc = valueFormat.match(text)
+            if mc and envio.has_key(mc.group('var')):
+                field = envio[mc.group('var')]
+                value = eval(mc.group('val'), {})
+                if type(field) == type(""):
+                    terms.append(('value', field, value, text))
+                    continue
+                elif field is envio.get('newdes'):
+                    terms.append(('newdes', value, text))
+                    continue
+            terms.append(('other', text))
+    termCache.add((dbname, expr), (terms,))
+    return terms
+
+def planQuery(dbname, expr):
+    """Return the items of a database that could match EXPR.
+
+    A dictionary of candidate items is returned, or None if every item in
+    the database needs to be tested.
+    """
+    return QueryPlan(dbname, expr).candidates()
+
+
+def execCodeblock(dbname, cond, output):
+    """Evaluate OUTPUT for every item in a database that matches COND.
 
     This is an internal function that is called by several functions below.
-    This is really just useful for code consolidation.  The execStr
-    parameter is very specific to the code block found within this
-    function.
+    A list of the OUTPUT values is returned.  Within both expressions,
+    '__db' is the (key, item) pair being examined.  COND is also used to
+    limit the items that are examined - see QueryPlan.
     """
+    plan = QueryPlan(dbname, cond)
+    if plan.access is None:
+        db = empDb.megaDB[dbname]
+    else:
+        # Only the terms not answered by the access path need testing.
+        cond = string.join(plan.residual, " and ") or "1"
+        if cond == "1" and output == "__db[0]":
+            return plan.keys()
+        db = plan.candidates()
     # Find every sector that applies
-    envio = selectors[dbname]
-    exec("def __func(__db, __class):\n"
-         +" __list = []\n"
-         +" __db = __db.items()\n"
-         +" __db.sort()\n"
-         +" for __db in __db:\n"
-         +"  __class.delayedValue = __db[1]\n"
-         +"  try:\n"
-         +execStr
-         +"  except NameError, e:\n"
-         +"   pass\n"
-         +" return __list\n", envio)
-    f = envio['__func']
-    del envio['__func']
-    return f(empDb.megaDB[dbname], delayedBinding)
+    f = queryCache.get((dbname, cond, output))
+    if f is None:
+        condCode, envio = compileExpr(dbname, cond)
+        outputCode, more = compileExpr(dbname, output)
+        envio.update(more)
+        exec("def __func(__db):\n"
+             +" __list = []\n"
+             +" __db = __db.items()\n"
+             +" __db.sort()\n"
+             +" for __db in __db:\n"
+             +"  __row = __db[1]\n"
+             +"  try:\n"
+             +"   if ("+condCode+"): __list.append(("+outputCode+"))\n"
+             +"  except (NameError, KeyError):\n"
+             +"   pass\n"
+             +" return __list\n", envio)
+        f = envio['__func']
+        queryCache.add((dbname, cond, output), f)
+    return f(db)
 
 def getSectors(expr, dbname):
     """Given a python expression, return all db keys that apply.
@@ -466,9 +812,7 @@ def getSectors(expr, dbname):
     keys that tested true.
     """
     try:
-        return execCodeblock(
-            dbname,
-            "   if ("+expr+"): __list.append(__db[0])\n")
+        return execCodeblock(dbname, expr, "__db[0]")
     except:
         raise error, (
             'GetSectors error in "%s"!\nException %s with detail:\n"%s".'
@@ -482,9 +826,7 @@ def getSectorDBs(expr, dbname):
     all the sector key/value pairs that tested true for the expression.
     """
     try:
-        list = execCodeblock(
-            dbname,
-            "   if (%s): __list.append(__db)\n" % expr)
+        list = execCodeblock(dbname, expr, "__db")
     except:
         raise error, (
             'GetSectorDBs error in "%s"!\nException %s with detail:\n"%s".'
@@ -528,10 +870,87 @@ def getSectorDBs(expr, dbname):
 def foreach(cond_expr, txt_expr, dbname):
     """Combination of getSectors and evalString."""
     try:
-        return execCodeblock(
-            dbname,
-            "   if ("+cond_expr+"): __list.append(("+txt_expr+"))\n")
+        return execCodeblock(dbname, cond_expr, txt_expr)
     except:
         raise error, (
             'Foreach error in "%s"/"%s"!\nException %s with detail:\n"%s".'
             % ((cond_expr, txt_expr) + tuple(sys.exc_info()[:2])))
+
+def selectorGetter(target):
+    """Return a function that reads the selector TARGET from an item.
+
+    The function returns None if the item doesn't have the value.
+    """
+    if type(target) == type(""):
+        return lambda row, field=target: row.get(field)
+    def getter(row, func=target):
+        try:
+            return func(row)
+        except KeyError:
+            return None
+    return getter
+
+def tally(expr, fields, group, dbname):
+    """Summarize the selectors FIELDS over every item that matches EXPR.
+
+    FIELDS is a list of selector names, and GROUP is a selector name (or
+    None).  The matching items are split by their value of GROUP, and a
+    dictionary is returned that maps each value (None if GROUP isn't given
+    or an item doesn't have it) to a list [count, stats].  Count is the
+    number of items, and stats has a [count, sum, min, max] list for each
+    field - or None if none of the items had a numeric value for it.
+
+    The vector engine is used if it can handle the whole query (see
+    empVector.tally()); otherwise the items are found with the query
+    planner and summed in a single pass.
+    """
+    envio = selectors[dbname]
+    names = fields[:]
+    if group is not None:
+        names.append(group)
+    for name in names:
+        if not envio.has_key(name) or isinstance(envio[name], rowFunction):
+            raise error, 'Unknown selector "%s".' % name
+    try:
+        db = empDb.megaDB[dbname]
+        if empVector.usable(dbname, db):
+            result = empVector.tally(dbname, parseTerms(dbname, expr),
+                                     envio, fields, group)
+            if result is not None:
+                return result
+        rows = execCodeblock(dbname, expr, "__db[1]")
+    except:
+        raise error, (
+            'Tally error in "%s"!\nException %s with detail:\n"%s".'
+            % ((expr,) + tuple(sys.exc_info()[:2])))
+    getters = map(lambda name, envio=envio: selectorGetter(envio[name]),
+                  fields)
+    if group is None:
+        getGroup = lambda row: None
+    else:
+        getGroup = selectorGetter(envio[group])
+    numbers = (type(0), type(0L), type(0.0))
+    result = {}
+    for row in rows:
+        value = getGroup(row)
+        try:
+            entry = result[value]
+        except KeyError:
+            entry = result[value] = [0, [None] * len(fields)]
+        entry[0] = entry[0] + 1
+        stats = entry[1]
+        for i in range(len(getters)):
+            val = getters[i](row)
+            if type(val) not in numbers:
+                continue
+            s = stats[i]
+            if s is None:
+                stats[i] = [1, val, val, val]
+            else:
+                s[0] = s[0] + 1
+                s[1] = s[1] + val
+                if val < s[2]:
+                    s[2] = val
+                elif val > s[3]:
+                    s[3] = val
+    return result
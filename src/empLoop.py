@@ -0,0 +1,241 @@
+"""Event loop for the text and curses interfaces."""
+
+#    Copyright (C) 1998-1999 Kevin O'Connor
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import os
+import select
+import time
+import bisect
+import string
+import errno
+
+import empDb
+import empQueue
+
+# Key Ideas:
+
+# The Tk interface gets its event loop for free - Tk watches the socket
+# with createfilehandler() and runs timers with createtimerhandler().  The
+# text interfaces used to block in select() waiting for the socket or a
+# line of input, and then block again in raw_input() whenever the server
+# asked a sub-prompt.  While blocked in raw_input() no server data was
+# read at all.
+#
+# EventLoop is a small replacement for the Tk loop.  Any number of files
+# (anything with a fileno() method) may be watched for input, and any
+# number of timers may be scheduled.  Sub-prompts are no longer answered
+# with raw_input(); instead the viewer notes the handler passed to
+# flush(), and the next line read from the keyboard is given to it.  The
+# socket is serviced the whole time.
+#
+# Commands and scripts may add their own readers and timers to
+# viewer.loop; they run alongside the socket and the keyboard.
+
+
+# What is contained within this file:
+
+# EventLoop - the loop itself.
+# LineReader - splits the input from a file into lines.
+# UpdateWarning - a timer that announces upcoming updates.
+
+
+###########################################################################
+#############################  Event loop     #############################
+class EventLoop:
+    """A select() based loop that dispatches file input and timers."""
+
+    def __init__(self):
+        # List of [file, callback] pairs.
+        self.readers = []
+        # Sorted list of [when, sequence, callback, interval] timers.
+        self.timers = []
+        self.sequence = 0
+        self.running = 0
+
+    def addReader(self, file, callback):
+        """Call CALLBACK() whenever FILE has data available.
+
+        FILE may be any object with a fileno() method.  If its fileno()
+        returns None the file is ignored until it returns a descriptor
+        again.  (The empire socket does this while disconnected.)
+        """
+        self.removeReader(file)
+        self.readers.append([file, callback])
+
+    def removeReader(self, file):
+        """Stop watching FILE."""
+        for i in range(len(self.readers)):
+            if self.readers[i][0] is file:
+                del self.readers[i]
+                return
+
+    def addTimer(self, delay, callback, interval=None):
+        """Call CALLBACK() in DELAY seconds and return a timer handle.
+
+        If INTERVAL is given, the timer is repeated every INTERVAL seconds
+        until it is cancelled.
+        """
+        self.sequence = self.sequence + 1
+        timer = [time.time() + delay, self.sequence, callback, interval]
+        bisect.insort(self.timers, timer)
+        return timer
+
+    def cancelTimer(self, timer):
+        """Cancel a timer returned by addTimer()."""
+        if timer in self.timers:
+            self.timers.remove(timer)
+
+    def addTask(self, callback):
+        """Call CALLBACK() from the loop as soon as possible."""
+        return self.addTimer(0, callback)
+
+    def runTimers(self):
+        """Call every timer that is due."""
+        now = time.time()
+        timers = self.timers
+        while timers and timers[0][0] <= now:
+            timer = timers[0]
+            del timers[0]
+            if timer[3] is not None:
+                # Reschedule repeating timers before calling them, so
+                # that they may cancel themselves.
+                timer[0] = max(timer[0] + timer[3], now)
+                bisect.insort(timers, timer)
+            try: timer[2]()
+            except (KeyboardInterrupt, SystemExit): raise
+            except: empQueue.flashException()
+
+    def runOnce(self, timeout=None):
+        """Wait for and dispatch one round of events.
+
+        TIMEOUT is the longest time (in seconds) to wait if nothing
+        happens; None waits until a file is ready or a timer is due.
+        """
+        self.runTimers()
+        if self.timers:
+            delay = max(self.timers[0][0] - time.time(), 0)
+            if timeout is None or delay < timeout:
+                timeout = delay
+        files = []
+        for file, callback in self.readers:
+            if file.fileno() is not None:
+                files.append(file)
+        try:
+            if timeout is None:
+                pending = select.select(files, [], [])[0]
+            else:
+                pending = select.select(files, [], [], timeout)[0]
+        except select.error, e:
+            if e[0] == errno.EINTR:
+                return
+            raise
+        for file in pending:
+            for reader in self.readers[:]:
+                if reader[0] is file:
+                    try: reader[1]()
+                    except (KeyboardInterrupt, SystemExit): raise
+                    except: empQueue.flashException()
+                    break
+        self.runTimers()
+
+    def run(self, condition=None):
+        """Dispatch events until stop() is called.
+
+        If CONDITION is given, the loop also ends as soon as CONDITION()
+        returns false.
+        """
+        self.running = 1
+        while self.running and (condition is None or condition()):
+            self.runOnce()
+
+    def stop(self):
+        """Make run() return after the current round of events."""
+        self.running = 0
+
+class LineReader:
+    """Read lines from a file without blocking.
+
+    Data is read with os.read(), so only the data that is available is
+    consumed.  CALLBACK(line) is called for every complete line, and
+    EOFCALLBACK() is called once the file reaches end of file.
+    """
+    def __init__(self, file, callback, eofCallback):
+        self.file = file
+        self.callback = callback
+        self.eofCallback = eofCallback
+        self.buffer = ""
+        self.eof = 0
+
+    def fileno(self):
+        if self.eof:
+            return None
+        return self.file.fileno()
+
+    def read(self):
+        """EventLoop callback: Read available data from the file."""
+        try:
+            data = os.read(self.file.fileno(), 4096)
+        except OSError, e:
+            if e[0] in (errno.EINTR, errno.EAGAIN):
+                return
+            raise
+        if not data:
+            self.eof = 1
+            if self.buffer:
+                line = self.buffer
+                self.buffer = ""
+                self.callback(line)
+            self.eofCallback()
+            return
+        lines = string.split(self.buffer + data, "\n")
+        self.buffer = lines[-1]
+        for line in lines[:-1]:
+            self.callback(line)
+
+class UpdateWarning:
+    """Timer that calls OUTPUT(msg) shortly before each update."""
+
+    # Minutes before an update at which a warning is given (ascending).
+    warnings = (1, 5, 15)
+
+    def __init__(self, output):
+        self.output = output
+        self.last = None
+
+    def check(self):
+        """EventLoop timer callback: Warn of an upcoming update."""
+        hours, minutes, seconds = empDb.megaDB['time'].getCountDown()
+        if hours is None or hours:
+            self.last = None
+            return
+        for i in self.warnings:
+            if minutes < i and (self.last is None or self.last >= i):
+                if i == 1:
+                    self.output("PTkEI: Update in less than 1 minute.")
+                else:
+                    self.output("PTkEI: Update in less than %d minutes." % i)
+                break
+        self.last = minutes
+
+def addStandardTimers(loop, output):
+    """Add the timers every interface runs to LOOP.
+
+    This includes the background database saver and the update warning.
+    OUTPUT(msg) is used to display the warnings.
+    """
+    loop.addTimer(1.0, empDb.DBIO.checkAutoSave, 1.0)
+    loop.addTimer(1.0, UpdateWarning(output).check, 10.0)
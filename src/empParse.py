@@ -473,23 +473,91 @@ map(operator.setitem,
 s_sectorName = (r"(?P<sectorName>"+
                 string.join(sectorDesignationConvert.values(), '|')+")")
 
+def convertValue(val):
+    """Convert a string to a native type (if possible)."""
+    if '.' in val:
+        try:
+            return float(val)
+        except ValueError:
+            return val
+    try:
+        return int(val)
+    except OverflowError:
+        return long(val)
+    except ValueError:
+        return val
+
 def convertList(dlist):
     """Convert a list of strings to native types."""
-    for i in range(len(dlist)):
-        val = dlist[i]
-        if '.' in val:
-            try:
-                val = float(val)
-            except ValueError:
-                continue
+    dlist[:] = map(convertValue, dlist)
+
+# Dump fields that always contain text, indexed by the dump name.  (The
+# delivery fields - those ending in '_del' - are also treated as text if
+# they aren't numbers.)  The type of a LOST ITEMS entry is a number.
+stringFields = {
+    'SECTOR': {'des': None, 'sdes': None},
+    'SHIPS': {'type': None, 'flt': None, 'name': None},
+    'PLANES': {'type': None, 'wing': None},
+    'LAND UNITS': {'type': None, 'army': None},
+    'NUKES': {'type': None},
+    }
+
+# Compiled row decoders indexed by header and column types.
+rowDecoders = {}
+
+def rowDecoder(headers, sample, oldownerHack=(), textFields={}):
+    """Return a function that converts a split dump line to a dictionary.
+
+    HEADERS is the list of field names and SAMPLE is the first line of the
+    dump.  Each column is converted with int() if the sample value is an
+    integer, and with the full conversion of convertList() otherwise.
+    Fields in TEXTFIELDS (a dictionary - see stringFields) and non-numeric
+    delivery directions are left as text, and the columns listed in
+    OLDOWNERHACK are translated to CN_OWNED/CN_ENEMY.  The returned
+    function raises ValueError if a line doesn't fit the sample (the
+    caller should then fall back to convertList()).
+    """
+    kinds = []
+    for field, pos, val in map(None, headers, range(len(headers)), sample):
+        if pos in oldownerHack:
+            kinds.append('o')
+        elif textFields.has_key(field):
+            kinds.append('s')
         else:
             try:
-                val = int(val)
-            except OverflowError:
-                val = long(val)
-            except ValueError:
-                continue
-        dlist[i] = val
+                int(val)
+                kinds.append('i')
+            except (ValueError, OverflowError):
+                if field[-4:] == '_del':
+                    kinds.append('s')
+                else:
+                    kinds.append('c')
+    key = (tuple(headers), tuple(kinds))
+    try:
+        return rowDecoders[key]
+    except KeyError:
+        pass
+    # Build the source of a function that converts the line in one step.
+    items = []
+    if 'owner' not in headers:
+        items.append("'owner': CN_OWNED")
+    for field, pos, kind in map(None, headers, range(len(headers)), kinds):
+        val = "l[%d]" % pos
+        if kind == 'i':
+            val = "__int(%s)" % val
+        elif kind == 'c':
+            val = "convertValue(%s)" % val
+        elif kind == 'o':
+            val = "(%s == '.' and CN_OWNED or CN_ENEMY)" % val
+        items.append("%s: %s" % (repr(field), val))
+    code = ("def decode(l, __int=int, convertValue=convertValue,\n"
+            "           CN_OWNED=CN_OWNED, CN_ENEMY=CN_ENEMY):\n"
+            "    return {%s}\n" % string.join(items, ",\n            "))
+    d = {'convertValue': convertValue, 'CN_OWNED': CN_OWNED,
+         'CN_ENEMY': CN_ENEMY}
+    exec code in d
+    decoder = rowDecoders[key] = d['decode']
+    return decoder
 
 ###########################################################################
 #############################  Parse classes  #############################
@@ -503,6 +571,8 @@ class ParseDump(baseDisp):
     attach = (('dump', -2), ('pdump', -2), ('ldump', -2),
               ('sdump', -2), ('ndump', -2), ('lost', 3))
     altersDB = ""
+    # Number of dump lines to collect before applying them to the database.
+    chunkSize = 256
 
     dumpcommand = re.compile(r"^\s*\S+\s+(\S+)(?:\s+(\S+)\s*)?$")
 ##     timestamp = re.compile(r"^(?:\?timestamp>(\d+))?$")
@@ -514,6 +584,8 @@ class ParseDump(baseDisp):
         self.updateList = []
         self.sett = self.full = 0
         self.DB = None
+        # Keys of the items reported by a full dump (see dictDB.unseen())
+        self.seen = None
 
         # Determine if the timestamp should be set for this dump
         mm = self.dumpcommand.match(cmd)
@@ -522,6 +594,7 @@ class ParseDump(baseDisp):
                 # This is a total dump
                 self.full = 1
                 self.sett = 1
+                self.seen = {}
             elif mm.group(2)[:3] == '?ti':
                 # This is a timestamp dump
                 self.sett = 1
@@ -547,7 +620,8 @@ class ParseDump(baseDisp):
                 tp = mtch.group('dumpName')
                 self.lost = (tp == 'LOST ITEMS')
                 self.DB = empDb.megaDB[tp]
-                ts = int(mtch.group('timeStamp'))
+                self.dbname = tp
+                ts = self.dumptime = int(mtch.group('timeStamp'))
 ##                 empDb.megaDB['time'].noteTimestamp(self.ctime, float(ts))
                 if self.sett:
                     # It is possible for the server to process a command
@@ -570,6 +644,8 @@ class ParseDump(baseDisp):
             elif self.getheader == 1:
                 self.Hlist = string.split(msg)
                 self.getheader = 0
+                # The row decoder is built from the first line of data.
+                self.decoder = None
                 # HACK! Check for the existence of "difficult" fields
                 self.oldownerHack = []
                 self.nameHack = []
@@ -607,25 +683,47 @@ class ParseDump(baseDisp):
                 l = l - (end-start)
         if l == len(self.Hlist):
             # Normal line
-
-            # Convert string listing to native format
-            convertList(Dlist)
-
-            DDict = {'owner':CN_OWNED}
-            map(operator.setitem, [DDict]*l, self.Hlist, Dlist)
-            # HACK! Fix annoying '*' field
-            if self.oldownerHack:
-                if DDict['oldown'] == '.':
-                    DDict['oldown'] = CN_OWNED
-                else:
-                    DDict['oldown'] = CN_ENEMY
+            decoder = self.decoder
+            if decoder is None:
+                decoder = self.decoder = rowDecoder(
+                    self.Hlist, Dlist, self.oldownerHack,
+                    stringFields.get(self.dbname, {}))
+            try:
+                DDict = decoder(Dlist)
+            except (ValueError, OverflowError):
+                # This line doesn't look like the first one.
+                DDict = self.convertRow(Dlist)
 
 ##          self.updateList.append(Dlist)
             self.updateList.append(DDict)
+            if len(self.updateList) >= self.chunkSize:
+                # Apply the lines received so far - this keeps the memory
+                # needed for large dumps down, and allows the displays to
+                # be updated before the dump completes.
+                self.DB.updates(self.updateList, self.seen)
+                self.updateList = []
         else:
             # End of dump
             self.Hlist = None
 
+    def convertRow(self, Dlist):
+        """Convert a split dump line to a dictionary (the slow way)."""
+        # Convert string listing to native format
+        textFields = stringFields.get(self.dbname, {})
+        for i in range(len(Dlist)):
+            if not textFields.has_key(self.Hlist[i]):
+                Dlist[i] = convertValue(Dlist[i])
+
+        DDict = {'owner':CN_OWNED}
+        map(operator.setitem, [DDict]*len(Dlist), self.Hlist, Dlist)
+        # HACK! Fix annoying '*' field
+        if self.oldownerHack:
+            if DDict['oldown'] == '.':
+                DDict['oldown'] = CN_OWNED
+            else:
+                DDict['oldown'] = CN_ENEMY
+        return DDict
+
     def End(self, cmd):
         self.out.End(cmd)
         if self.DB is None:
@@ -633,14 +731,12 @@ class ParseDump(baseDisp):
             return
 
         # Update the database
-        if not self.full:
-            # simple update
-            self.DB.updates(self.updateList)
-##          self.DB.updates(listDict)
-        else:
-            # A full dump
-            others = self.DB.updates(self.updateList, 1)
-##          others = self.DB.updates(listDict, 1)
+        self.DB.updates(self.updateList, self.seen)
+        self.updateList = []
+        if self.full:
+            # A full dump - items that weren't reported are no longer owned.
+            others = self.DB.unseen(self.seen)
+            self.seen = None
             list = []
             for i in others.values():
                 if i.get('owner') == CN_OWNED:
@@ -665,9 +761,13 @@ class ParseDump(baseDisp):
                     empDb.megaDB[subDB[0]].updates([d])
             empDb.updateDB['LOST ITEMS'].clear()
 
+        # Note the new values in the history (if it is being recorded).
+        empDb.DBIO.recordHistory(self.dbname, self.dumptime,
+                                 self.DB.timestamp)
+
         # Update the official timestamp.  (The timestamp stored on disk.)
         if self.sett:
-            self.DB.timestamp = self.timestamp
+            self.DB.setTimestamp(self.timestamp)
 
 class ParseMap(baseDisp):
     """Parse output from various map commands."""
@@ -2114,3 +2214,4 @@ def checkUpdated(dbname, item, val):
     megaDB = empDb.megaDB
     if megaDB[dbname].get(item) != val:
         megaDB[dbname][item] = empDb.updateDB[dbname][item] = val
+        empDb.DBIO.journalSet(dbname, item, val)
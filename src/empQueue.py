@@ -22,6 +22,8 @@ import errno
 import select
 import string
 import re
+import time
+import types
 import traceback
 
 import empDb
@@ -137,6 +139,21 @@ import empParse
 # be ideal to have a command following 'foreach xxx' pop in front of the
 # foreach commands due to QU_SYNC's behavior.)
 
+# Pipelining is an extension of QU_SYNC.  Some server commands are known
+# to never create a sub-prompt (see pipelineCommands).  While only such
+# commands are waiting for their prompts, QU_SYNC commands may be sent
+# without waiting - up to EmpIOQueue.pipelineDepth commands may be
+# outstanding.  As soon as a command that might prompt is sent, the queue
+# waits for its prompt as usual.
+
+# Coalescing removes redundant commands before they are sent.  When a
+# command listed in coalesceCommands is added to the end of the queue, and
+# the unsent command just before it is a duplicate, the earlier command is
+# dropped.  (For example, of two queued "thr food 3,5 50" commands only
+# the last needs to be sent.)  Commands are never merged across another
+# command, since it might change what they report or do.  A queued
+# command with QU_FULLSYNC flags is never dropped.
+
 
 # Empire Protocol IDs
 C_CMDOK	 = "0"
@@ -172,12 +189,351 @@ QU_OFFLINE = 72
 
 QU_BURSTS = (QU_BURST, QU_FORCEBURST)
 
+# Server commands that never create a sub-prompt.  (Most commands only
+# prompt when arguments are missing, so the patterns require them.)  Use
+# registerPipelined() to add to this list.
+pipelineCommands = [
+    r"[spln]?dump\s+\S+.*",
+    r"lost(?:\s.*)?",
+    r"cen(?:s|su|sus)?\s+\S+.*",
+    r"comm(?:o|od|odi|odit|odity)?\s+\S+.*",
+    r"reso(?:u|ur|urc|urce)?\s+\S+.*",
+    r"nat(?:i|io|ion)?",
+    r"ver(?:s|si|sio|sion)?",
+    r"thr(?:e|es|esh|esho|eshol|eshold)?\s+\S+\s+\S+\s+\S+",
+    r"des(?:i|ig|ign|igna|ignat|ignate)?\s+\S+\s+\S+",
+    r"mov(?:e)?\s+\S+\s+\S+\s+\S+\s+(?:-?\d+,-?\d+|[yugjbn]*h)",
+    ]
+pipelineFormat = None
+
+def registerPipelined(pattern):
+    """Note that commands matching the regular expression PATTERN never
+    create a sub-prompt."""
+    global pipelineFormat
+    pipelineCommands.append(pattern)
+    pipelineFormat = None
+
+def isPipelined(command):
+    """Return true if the server command COMMAND can't create a sub-prompt."""
+    global pipelineFormat
+    if pipelineFormat is None:
+        pipelineFormat = re.compile(
+            r"^\s*(?:" + string.join(pipelineCommands, "|") + r")\s*$")
+    return pipelineFormat.match(command) is not None
+
+# Server commands that are idempotent.  Each entry is a regular expression
+# and a flag that is set if the command only reports information.  Two
+# commands are duplicates when they match the same pattern with the same
+# groups.  Use registerCoalesced() to add to this list.
+coalesceCommands = [
+    (r"(nat)(?:i|io|ion)?", 1),
+    (r"(ver)(?:s|si|sio|sion)?", 1),
+    (r"(cen)(?:s|su|sus)?\s+(\S+.*)", 1),
+    (r"(comm)(?:o|od|odi|odit|odity)?\s+(\S+.*)", 1),
+    (r"(reso)(?:u|ur|urc|urce)?\s+(\S+.*)", 1),
+    (r"(thr)(?:e|es|esh|esho|eshol|eshold)?\s+(\S+)\s+(\S+)\s+\S+", 0),
+    (r"(des)(?:i|ig|ign|igna|ignat|ignate)?\s+(\S+)\s+\S+", 0),
+    ]
+coalesceFormats = None
+
+def registerCoalesced(pattern, query=0):
+    """Note that commands matching the regular expression PATTERN may be
+    coalesced.  The pattern's groups identify duplicate commands; QUERY
+    should be set if the command doesn't change the server state."""
+    global coalesceFormats
+    coalesceCommands.append((pattern, query))
+    coalesceFormats = None
+
+def coalesceKey(command):
+    """Return a (key, query) tuple for the server command COMMAND.
+
+    Commands with equal keys are duplicates.  None is returned if the
+    command can not be coalesced.
+    """
+    global coalesceFormats
+    if coalesceFormats is None:
+        coalesceFormats = map(lambda i: (re.compile(r"^(?:%s)$" % i[0]),
+                                         i[1]),
+                              coalesceCommands)
+    command = string.join(string.split(command))
+    for i in range(len(coalesceFormats)):
+        format, query = coalesceFormats[i]
+        mm = format.match(command)
+        if mm is not None:
+            return ((i,) + mm.groups(), query)
+    return None
+
+# Limits on the size of a single socket read.  The read size grows while
+# reads fill the whole buffer (EG. during a large dump), and shrinks again
+# when the server output slows down.
+READ_MIN = 4096
+READ_MAX = 256*1024
+
+class CommandQueue:
+    """A list of commands with fast removal from the front.
+
+    This class acts like a list for the operations EmpIOQueue uses
+    (indexing, slicing, len(), insert(), and del).  Completed commands are
+    removed from the front of the queue, which normally requires the whole
+    list to be shifted.  Here, the front of the queue is just an offset
+    (head) into the list, and the list is only compacted once more than
+    half of it is unused.  Commands are normally added at the end, so
+    insert() is also cheap.
+    """
+    def __init__(self):
+        self.items = []
+        self.head = 0
+
+    def __len__(self):
+        return len(self.items) - self.head
+    def __getitem__(self, i):
+        if i < 0:
+            i = i + len(self)
+            if i < 0:
+                raise IndexError, "queue index out of range"
+        return self.items[self.head + i]
+    def __delitem__(self, i):
+        if i < 0:
+            i = i + len(self)
+        if i == 0 and len(self):
+            # Remove the first item by moving the front of the queue.
+            self.items[self.head] = None
+            self.head = self.head + 1
+            self.compact()
+        else:
+            del self.items[self.head + i]
+    def __getslice__(self, i, j):
+        j = min(j, len(self))
+        return self.items[self.head + i:self.head + j]
+    def __delslice__(self, i, j):
+        j = min(j, len(self))
+        if i == 0 and j > 0:
+            head = self.head
+            self.items[head:head + j] = [None] * j
+            self.head = head + j
+            self.compact()
+        else:
+            del self.items[self.head + i:self.head + j]
+    def __setslice__(self, i, j, seq):
+        head = self.head
+        if i == j == 0 and len(seq) <= head:
+            # Prepend in the unused space at the front.
+            self.head = head = head - len(seq)
+            self.items[head:head + len(seq)] = list(seq)
+        else:
+            self.items[head + i:head + j] = list(seq)
+
+    def insert(self, pos, item):
+        self.items.insert(self.head + pos, item)
+
+    def compact(self):
+        """Release the unused space at the front of the queue."""
+        head = self.head
+        if head == len(self.items):
+            self.items = []
+            self.head = 0
+        elif head > 64 and head * 2 > len(self.items):
+            del self.items[:head]
+            self.head = 0
+
+class SampleRing:
+    """A fixed-size list that keeps only the most recent samples."""
+    def __init__(self, size):
+        self.size = size
+        self.items = []
+        self.pos = 0
+
+    def add(self, item):
+        if len(self.items) < self.size:
+            self.items.append(item)
+        else:
+            self.items[self.pos] = item
+            self.pos = (self.pos + 1) % self.size
+
+    def list(self):
+        """Return the samples from oldest to newest."""
+        return self.items[self.pos:] + self.items[:self.pos]
+
+def percentile(list, fraction):
+    """Return the FRACTION percentile of the sorted list LIST."""
+    return list[int(round(fraction * (len(list) - 1)))]
+
+def jsonEncode(value):
+    """Return VALUE (a dictionary, list, string, or number) as JSON text."""
+    t = type(value)
+    if t is types.DictType:
+        keys = value.keys()
+        keys.sort()
+        return "{" + string.join(map(
+            lambda k, v=value: jsonEncode(str(k)) + ": " + jsonEncode(v[k]),
+            keys), ", ") + "}"
+    elif t in (types.ListType, types.TupleType):
+        return "[" + string.join(map(jsonEncode, value), ", ") + "]"
+    elif t is types.StringType:
+        for i, j in (("\\", "\\\\"), ('"', '\\"'), ("\n", "\\n"),
+                     ("\t", "\\t")):
+            value = string.replace(value, i, j)
+        return '"' + value + '"'
+    elif t is types.FloatType:
+        return "%.6f" % value
+    elif value is None:
+        return "null"
+    return str(value)
+
+class QueueStats:
+    """Latency and throughput statistics for the command queue.
+
+    Every NormalHandler is stamped with the time it was queued, sent,
+    received its first line, and received its prompt, along with the number
+    of bytes and lines it received.  When the command completes, these are
+    added here.  Only the most recent samples are kept, so the statistics
+    use a fixed amount of memory however long the session runs.
+    """
+    # The number of recent commands kept for each verb and overall.
+    sampleSize = 256
+    # The number of verbs tracked separately; the rest are added to 'other'.
+    maxVerbs = 64
+    # The queue depth is sampled (as a maximum) over this many seconds.
+    depthInterval = 1.0
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Discard all statistics."""
+        self.startTime = time.time()
+        self.commands = self.bytes = self.lines = 0
+        # verb -> [count, bytes, SampleRing of (wait, first, latency)]
+        self.verbs = {}
+        # (prompt time, bytes) of the last commands completed
+        self.recent = SampleRing(self.sampleSize)
+        # (time, maximum depth) of the queue depth over time
+        self.depths = SampleRing(self.sampleSize)
+        self.depthTime = self.startTime
+        self.depthMax = 0
+
+    def noteDepth(self, depth):
+        """Note the current length of the command queue."""
+        if depth > self.depthMax:
+            self.depthMax = depth
+        now = time.time()
+        if now - self.depthTime >= self.depthInterval:
+            self.depths.add((self.depthTime, self.depthMax))
+            self.depthTime = now
+            self.depthMax = depth
+
+    def complete(self, handler, depth):
+        """Add the times stamped on the NormalHandler HANDLER."""
+        sent = handler.sendTime
+        if sent is None:
+            return
+        done = handler.promptTime
+        first = handler.firstTime
+        if first is None:
+            first = done
+        lst = string.split(handler.command)
+        if lst:
+            verb = string.lower(lst[0])
+        else:
+            verb = ""
+        verbs = self.verbs
+        if not verbs.has_key(verb):
+            if len(verbs) >= self.maxVerbs:
+                verb = 'other'
+            if not verbs.has_key(verb):
+                verbs[verb] = [0, 0, SampleRing(self.sampleSize)]
+        info = verbs[verb]
+        info[0] = info[0] + 1
+        info[1] = info[1] + handler.bytes
+        info[2].add((sent - handler.queueTime, first - sent, done - sent))
+        self.commands = self.commands + 1
+        self.bytes = self.bytes + handler.bytes
+        self.lines = self.lines + handler.lines
+        self.recent.add((done, handler.bytes))
+        self.noteDepth(depth)
+
+    def summary(self, depth):
+        """Return a dictionary of the current statistics.
+
+        DEPTH is the current length of the command queue.  Times are given
+        in milliseconds; rates are computed over the most recently
+        completed commands.
+        """
+        now = time.time()
+        recent = self.recent.list()
+        cmdRate = byteRate = 0.0
+        if len(recent) > 1:
+            span = recent[-1][0] - recent[0][0]
+            if span > 0:
+                cmdRate = (len(recent) - 1) / span
+                byteRate = reduce(lambda a, b: a + b[1], recent[1:], 0) / span
+        verbs = {}
+        for verb, (count, bytes, ring) in self.verbs.items():
+            samples = ring.list()
+            latency = map(lambda s: s[2] * 1000.0, samples)
+            latency.sort()
+            first = map(lambda s: s[1] * 1000.0, samples)
+            first.sort()
+            wait = reduce(lambda a, s: a + s[0], samples, 0.0) / len(samples)
+            verbs[verb] = {
+                'count': count, 'bytes': bytes,
+                'p50': percentile(latency, 0.50),
+                'p95': percentile(latency, 0.95),
+                'p99': percentile(latency, 0.99),
+                'first': percentile(first, 0.50),
+                'wait': wait * 1000.0}
+        depths = self.depths.list() + [(self.depthTime, self.depthMax)]
+        return {'time': now, 'elapsed': now - self.startTime,
+                'commands': self.commands, 'bytes': self.bytes,
+                'lines': self.lines, 'cmdRate': cmdRate,
+                'byteRate': byteRate, 'depth': depth,
+                'depths': map(lambda d: [d[0], d[1]], depths),
+                'verbs': verbs}
+
+class SessionRecorder:
+    """Copy the raw protocol stream to a capture file.
+
+    Each line of the capture holds the time it was sent or received, a
+    direction ('<' for server data, '>' for commands sent), and the raw
+    line.  Passwords are not recorded.  empReplay.py can feed a capture
+    back through the parsers without a server.
+    """
+    def __init__(self, file):
+        self.file = file
+        # Partial line from the last read
+        self.InpBuf = ""
+        file.write("# PTkEI session capture\n")
+
+    def received(self, data):
+        """Note a block of data read from the socket."""
+        now = time.time()
+        lines = string.split(self.InpBuf + data, "\n")
+        self.InpBuf = lines[-1]
+        write = self.file.write
+        for i in lines[:-1]:
+            write("%.6f < %s\n" % (now, i))
+
+    def sent(self, cmd):
+        """Note a command sent to the server."""
+        if cmd[:5] == "pass ":
+            cmd = "pass *"
+        self.file.write("%.6f > %s\n" % (time.time(), cmd))
+
+    def close(self):
+        self.file.close()
+
 class EmpIOQueue:
     """Broker all input and output to/from server.
 
     This class generally has only one instance associated with it.  It is
     used mainly as a code/data container.
     """
+    # The maximum number of sub-prompt free commands that may wait for
+    # their prompts at the same time.  (1 disables pipelining.)
+    pipelineDepth = 4
+    # Set if redundant commands should be removed from the queue (see
+    # coalesceHandler).
+    coalesce = 1
 
     def __init__(self, async, login):
         global empQueue
@@ -188,6 +544,8 @@ class EmpIOQueue:
         # stored somewhere until the next read reveals the trailing
         # information.
         self.InpBuf = ""
+        # Number of bytes to request on the next socket read.
+        self.readSize = READ_MIN
 
         # Storage for the command queue.  Each command is queued by
         # associating it with a "data manager" class (eg, NormalHandler),
@@ -195,8 +553,8 @@ class EmpIOQueue:
         # FLWaitLev and FLSentLev are indexes into this queue.
         # FuncList[FLWaitLev] points to the command that is currently
         # receiving data.  FuncList[FLSentLev] points to the next command
-        # that needs to be sent to the server.
-        self.FuncList = []
+        # that needs to be sent to the server.  (See CommandQueue.)
+        self.FuncList = CommandQueue()
         self.FLWaitLev = self.FLSentLev = 0
 
         # Special data manager classes.  defParser (which is associated
@@ -210,6 +568,11 @@ class EmpIOQueue:
 
         self.flags = QU_OFFLINE
 
+        # Latency and throughput statistics (see QueueStats).
+        self.stats = QueueStats()
+        # Capture of the protocol stream (see SessionRecorder).
+        self.recorder = None
+
     def SendNow(self, cmd):
         """Immediately send CMD to socket."""
         # Paranoia check
@@ -218,6 +581,8 @@ class EmpIOQueue:
             viewer.Error("Send error - embedded newline: " + `cmd`)
             cmd = cmd[:string.find(cmd, "\n")]
 ##  	self.debug(cmd, 'send')
+        if self.recorder is not None:
+            self.recorder.sent(cmd)
         try:
             self.socket.send(cmd+"\n")
         except socket.error, e:
@@ -264,6 +629,7 @@ class EmpIOQueue:
                 self.FLWaitLev = self.FLWaitLev + 1
             else:
                 self.SendNow(cmd)
+                qElem.sendTime = time.time()
             self.FLSentLev = self.FLSentLev + 1
             # HACK++
             if (cmd is not None
@@ -277,10 +643,35 @@ class EmpIOQueue:
                 self.FuncList[0].out.Answer(cmd)
             # Update flags
             self.doFlags()
-            if (self.flags not in QU_BURSTS
-                or self.FLSentLev >= len(self.FuncList)):
+            if (self.FLSentLev >= len(self.FuncList)
+                or (self.flags not in QU_BURSTS
+                    and (cmd is None or not self.readyToSend()))):
                 break
 
+    def readyToSend(self):
+        """Return true if the next command may be sent immediately.
+
+        In QU_SYNC mode, the next command is sent when every sent command
+        has received its prompt, or when all the commands still waiting
+        are sub-prompt free and there are fewer than pipelineDepth of
+        them.
+        """
+        flags = self.flags
+        if flags in QU_BURSTS:
+            return 1
+        if flags != QU_SYNC:
+            return 0
+        waitLev = self.FLWaitLev
+        sentLev = self.FLSentLev
+        if sentLev - waitLev <= 0:
+            return 1
+        if sentLev - waitLev >= self.pipelineDepth:
+            return 0
+        for i in self.FuncList[waitLev:sentLev]:
+            if not getattr(i, 'pipelined', 0):
+                return 0
+        return 1
+
     def beginParser(self):
         while 1:
             if (self.FLSentLev == 0 and self.flags <= QU_FULLSYNC):
@@ -336,9 +727,7 @@ class EmpIOQueue:
         if pos == self.FLSentLev:
             self.doFlags()
             if (self.FLSentLev < len(self.FuncList)
-                and (self.flags in QU_BURSTS
-                     or (self.flags == QU_SYNC
-                         and self.FLWaitLev == self.FLSentLev))):
+                and self.readyToSend()):
                 self.sendCommand()
 
     def AddHandler(self, handler, pos=None):
@@ -348,6 +737,8 @@ class EmpIOQueue:
         However, it is possible to customize the location for the command
         via the pos argument.
         """
+        if pos is None and self.coalesce:
+            self.coalesceHandler(handler)
         l = len(self.FuncList)
         FLSentLev = self.FLSentLev
         if pos is None or pos > l:
@@ -355,14 +746,13 @@ class EmpIOQueue:
         elif pos < FLSentLev:
             pos = FLSentLev
         self.FuncList.insert(pos, handler)
+        self.stats.noteDepth(l + 1)
 ##  	self.debug("Add '%s'" % handler.command)
         if pos == self.FLSentLev:
             self.doFlags()
             if (self.flags == QU_OFFLINE):
                 self.offlineSendCommand()
-            elif (self.flags in QU_BURSTS
-                  or (self.flags == QU_SYNC
-                      and self.FLWaitLev == self.FLSentLev)):
+            elif self.readyToSend():
 ##  		self.debug("Force send")
                 self.sendCommand()
                 if not pos:
@@ -372,6 +762,27 @@ class EmpIOQueue:
                         try: self.defParser.lull()
                         except: flashException()
 
+    def coalesceHandler(self, handler):
+        """Drop the unsent command just before HANDLER if it is a duplicate.
+
+        Only adjacent commands are merged - any other command between two
+        duplicates keeps both of them.  Commands with QU_FULLSYNC flags
+        are never dropped.
+        """
+        info = getattr(handler, 'coalesceKey', None)
+        if info is None or QU_FULLSYNC in (handler.preFlags,
+                                           handler.postFlags):
+            return
+        i = len(self.FuncList) - 1
+        if i < self.FLSentLev:
+            return
+        elem = self.FuncList[i]
+        if (getattr(elem, 'coalesceKey', None) == info
+            and elem.out is handler.out
+            and QU_FULLSYNC not in (elem.preFlags, elem.postFlags)):
+##  	    self.debug("Coalesce '%s'" % elem.command)
+            self.popHandler(i)
+
     def HandleInput(self):
         """Parse input from socket; send all data to function list.
 
@@ -384,7 +795,9 @@ class EmpIOQueue:
         heterogeneous mixture of command priorities.  Tracking of
         FLWaitLev, and FLSentLev is an arduous task.
         """
+        # Lines that have been read but not yet processed are cache[pos:].
         cache = []
+        pos = 0
         error = ""
         # HACK!  Obscure python optimization - make local copies of global
         # variables.
@@ -423,14 +836,15 @@ class EmpIOQueue:
                     raise StopRead
                 if not sts[0]:
                     # Nothing left to read
-                    if not cache:
+                    if pos >= __len(cache):
                         # cache is empty - break from main loop and return.
                         break
                     # There is info on the cache, process it first.
                     raise StopRead
                 # Socket is Ok to read - now read a large block.
+                readSize = self.readSize
                 try:
-                    tmp = self__socket__recv(4096)
+                    tmp = self__socket__recv(readSize)
                 except socket.error, e:
                     error = "Socket read exception: " + str(e)
                     self.loginParser.Disconnect()
@@ -440,6 +854,8 @@ class EmpIOQueue:
                     error = "Zero read on socket!"
                     self.loginParser.Disconnect()
                     raise StopRead
+                if self.recorder is not None:
+                    self.recorder.received(tmp)
                 # If a prompt is encountered anywhere in the buffered data,
                 # send the next command immediately in QU_SYNC mode.
                 cnt = string__count(tmp, "\n"+__C_PROMPT)
@@ -447,10 +863,20 @@ class EmpIOQueue:
                     cnt = cnt + 1
                 self.FLWaitLev = self.FLWaitLev + cnt
                 if (self.flags == __QU_SYNC
-                    and self.FLWaitLev == self.FLSentLev):
+                    and self.readyToSend()):
 ##  		    self.debug("Pre-send")
                     self__sendCommand()
+                # Adjust the read size to the rate the server is sending.
+                if __len(tmp) == readSize:
+                    if readSize < READ_MAX:
+                        self.readSize = readSize * 2
+                elif readSize > READ_MIN and __len(tmp) < readSize / 4:
+                    self.readSize = readSize / 2
                 # Convert input to line cache
+                if pos:
+                    # Discard the lines that have already been processed.
+                    del cache[:pos]
+                    pos = 0
                 l = __len(cache)
                 cache[l:] = string__split(tmp, "\n")
                 cache[l] = self__InpBuf + cache[l]
@@ -463,9 +889,9 @@ class EmpIOQueue:
                 # next loop, because the queue flags are checked there.)
                 pass
 
-            while cache:
-                data = cache[0]
-                del cache[0]
+            while pos < __len(cache):
+                data = cache[pos]
+                pos = pos + 1
 ##                 self.debug(data, 'get')
 
                 if not self__FuncList:
@@ -545,9 +971,7 @@ class EmpIOQueue:
                 self.flags = QU_BURST
                 self.doFlags()
                 if (self.FLSentLev < len(self.FuncList)
-                    and (self.flags in QU_BURSTS
-                         or (self.flags == QU_SYNC
-                             and self.FLWaitLev == self.FLSentLev))):
+                    and self.readyToSend()):
                     self.sendCommand()
                     if not self.FLSentLev:
                         self.beginParser()
@@ -792,6 +1216,14 @@ class NormalHandler:
             post = pre
         self.postFlags = post
         self.atSubPrompt = 0
+        # Set if the command can't create a sub-prompt (see readyToSend)
+        self.pipelined = isPipelined(command)
+        # Identifies duplicate commands (see EmpIOQueue.coalesceHandler)
+        self.coalesceKey = coalesceKey(command)
+        # Statistics (see QueueStats)
+        self.queueTime = time.time()
+        self.sendTime = self.firstTime = self.promptTime = None
+        self.bytes = self.lines = 0
 
     def start(self):
         """EmpIOQueue Handler: Previous command completed; start this one."""
@@ -810,6 +1242,11 @@ class NormalHandler:
         proto = line[:1]
         msg = line[2:]
 
+        if self.firstTime is None:
+            self.firstTime = time.time()
+        self.lines = self.lines + 1
+        self.bytes = self.bytes + len(line) + 1
+
         if proto not in (C_DATA, C_PROMPT, C_FLUSH):
             # Can't handle the proto - send to async class.
             empQueue.defParser.line(line)
@@ -837,6 +1274,8 @@ class NormalHandler:
             del self.msgqueue[:]
             ndb = empDb.megaDB['prompt']
             ndb['minutes'], ndb['BTU'] = map(int, string.split(msg))
+            self.promptTime = time.time()
+            empQueue.stats.complete(self, len(empQueue.FuncList) - 1)
             self.out.End(self.command)
 ##	elif msg[0] == C_REDIR:
 ##	    print "PE: Server Redirect requested:", msg[2:]
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+"""Replay a recorded server session through the client parsers."""
+
+#    Copyright (C) 1998-1999 Kevin O'Connor
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import sys
+import os
+import getopt
+import string
+import time
+
+import empDb
+import empQueue
+
+# Key Ideas:
+
+
+# What is contained within this file:
+
+# The 'record' command (see empCmd.CmdRecord and empQueue.SessionRecorder)
+# copies every line sent to and received from the server into a capture
+# file.  This file contains the code to feed such a capture back through
+# the same NormalHandler -> parser -> megaDB path that live server data
+# takes.  No socket and no display are used, and the data is replayed as
+# fast as it can be parsed.  This gives repeatable timings for the parsers
+# and the database code.
+#
+# The file may be run directly:
+#
+#     python src/empReplay.py [-n <count>] [-j] [-v] <capture> [<database>]
+#
+# The database is loaded before the replay (a new database is used if none
+# is given), but it is never saved.
+
+
+# Global variables:
+
+# viewer : During a replay, this is an instance of NullViewer.
+
+
+###########################################################################
+#############################  Replay         #############################
+class NullViewer:
+    """A viewer that discards all output."""
+    def __init__(self, verbose=0):
+        self.verbose = verbose
+        self.errors = 0
+        self.loginCallback = self
+        self.ioq = self
+
+    Begin = data = End = flush = Answer = Process = empQueue.doNothing
+    inform = flash = Send = empQueue.doNothing
+
+    def Error(self, msg):
+        self.errors = self.errors + 1
+        if self.verbose:
+            print msg
+
+def readCapture(filename):
+    """Return the (direction, line) pairs stored in a capture file."""
+    list = []
+    for line in open(filename).readlines():
+        if line[:1] == '#':
+            continue
+        pos = string.find(line, " ")
+        list.append((line[pos+1], line[pos+3:-1]))
+    return list
+
+class Replay:
+    """Feed a capture through an EmpIOQueue that has no socket.
+
+    Each recorded command is placed on the queue as if it had just been
+    sent, and each recorded line of server data is given to the queue's
+    handlers the same way EmpIOQueue.HandleInput would.  Logins found in
+    the capture are skipped.
+    """
+    def __init__(self, viewer):
+        self.viewer = viewer
+        self.queue = empQueue.EmpIOQueue(empQueue.AsyncHandler(), self)
+        # Nothing is ever sent from the queue itself.
+        self.queue.flags = empQueue.QU_PAUSED
+        # Set to 1 while logging in, and 2 once the 'play' command is seen.
+        self.login = 0
+
+    def Disconnect(self):
+        """EmpIOQueue login handler: Note a server exit."""
+        pass
+
+    def sent(self, cmd):
+        """Note a command that was sent to the server."""
+        q = self.queue
+        FuncList = q.FuncList
+        if cmd[:5] == "user ":
+            # The client reconnected - forget commands in progress.
+            del FuncList[:]
+            q.FLSentLev = q.FLWaitLev = 0
+            self.login = 1
+            return
+        if self.login:
+            if cmd == "play":
+                self.login = 2
+            return
+        if (FuncList and FuncList[0].__class__ is empQueue.NormalHandler
+            and FuncList[0].atSubPrompt):
+            # The command answers a sub-prompt.
+            FuncList[0].atSubPrompt = 0
+            FuncList[0].out.Answer(cmd)
+            return
+        hdlr = empQueue.NormalHandler(cmd, self.viewer)
+        hdlr.sendTime = time.time()
+        FuncList.insert(len(FuncList), hdlr)
+        q.FLSentLev = q.FLSentLev + 1
+        if len(FuncList) == 1:
+            q.beginParser()
+
+    def received(self, line):
+        """Note a line of data that was received from the server."""
+        if self.login:
+            if self.login == 2 and line[:1] == empQueue.C_INIT:
+                self.login = 0
+            return
+        q = self.queue
+        FuncList = q.FuncList
+        if not FuncList:
+            # Asynchronous line of data
+            try: q.defParser.line(line)
+            except: empQueue.flashException()
+            return
+        try: FuncList[0].line(line)
+        except: empQueue.flashException()
+        if line[:1] == empQueue.C_PROMPT:
+            del FuncList[0]
+            q.FLSentLev = q.FLSentLev - 1
+            if FuncList:
+                q.beginParser()
+
+    def run(self, capture):
+        """Replay the (direction, line) pairs of CAPTURE."""
+        sent = self.sent
+        received = self.received
+        for direction, line in capture:
+            if direction == '<':
+                received(line)
+            else:
+                sent(line)
+        # Let the parsers finish up.
+        q = self.queue
+        try:
+            if q.FuncList:
+                q.FuncList[0].lull()
+            else:
+                q.defParser.lull()
+        except:
+            empQueue.flashException()
+
+def main():
+    global viewer
+    usage = ("Usage:\n" + str(sys.argv[0])
+             + " [-n <count>] [-j] [-v] <capture> [<database>]")
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'n:jv')
+    except getopt.error:
+        print usage
+        sys.exit(1)
+    if len(args) not in (1, 2):
+        print usage
+        sys.exit(1)
+    count = 1
+    json = verbose = 0
+    for i, j in opts:
+        if i == '-n':
+            count = int(j)
+        elif i == '-j':
+            json = 1
+        elif i == '-v':
+            verbose = 1
+
+    viewer = empDb.viewer = empQueue.viewer = NullViewer(verbose)
+    capture = readCapture(args[0])
+    if len(args) == 2:
+        empDb.DBIO.load(args[1])
+    else:
+        empDb.DBIO.reset()
+
+    lines = len(filter(lambda i: i[0] == '<', capture))
+    times = []
+    for i in range(count):
+        replay = Replay(viewer)
+        start = time.time()
+        replay.run(capture)
+        times.append(time.time() - start)
+    best = min(times)
+    stats = replay.queue.stats
+    if json:
+        info = stats.summary(0)
+        info['capture'] = args[0]
+        info['elapsed'] = best
+        info['runs'] = times
+        info['errors'] = viewer.errors
+        print empQueue.jsonEncode(info)
+        return
+    print "Replayed %d lines (%d commands) in %.3fs (best of %d)" % (
+        lines, stats.commands, best, count)
+    if best > 0:
+        print "%.0f lines/s, %.1f commands/s" % (lines / best,
+                                                  stats.commands / best)
+    if viewer.errors:
+        print "%d errors reported" % viewer.errors
+
+if __name__=='__main__':
+    main()
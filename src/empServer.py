@@ -0,0 +1,648 @@
+#!/usr/bin/env python
+"""A small stand-in Empire server for load and latency testing."""
+
+#    Copyright (C) 1998-1999 Kevin O'Connor
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import sys
+import socket
+import select
+import errno
+import getopt
+import string
+import random
+import time
+
+import empParse
+
+# Key Ideas:
+
+
+# What is contained within this file:
+
+# This file contains a mock server that speaks enough of the Empire
+# protocol (C_INIT, C_CMDOK, C_DATA, C_PROMPT, C_FLUSH, C_FLASH, C_INFORM,
+# and C_EXIT) for the client to log in and run commands against it.  The
+# server holds a synthetic world (class World) of a configurable size, and
+# answers the dump, sdump, pdump, ldump, map, nation, and version commands
+# from it.  The threshold, designate, and move commands are accepted, and
+# prompt for any missing arguments with a sub-prompt, just like the real
+# server does.  Latency, bandwidth limits, and asynchronous flash/inform
+# messages can be added to exercise the client's command queue.
+#
+# The server only listens on the loopback interface.  It may be run
+# directly:
+#
+#     python src/empServer.py [-p <port>] [-s <width>x<height>] ...
+#
+# (Run with -h for the full list of options), or it may be created and
+# polled from another program - see MockServer.
+
+
+# Empire protocol IDs (see empQueue)
+C_CMDOK	 = "0"
+C_DATA	 = "1"
+C_INIT	 = "2"
+C_EXIT	 = "3"
+C_FLUSH	 = "4"
+C_PROMPT = "6"
+C_CMDERR = "a"
+C_FLASH	 = "d"
+C_INFORM = "e"
+
+###########################################################################
+#############################  Synthetic world ############################
+
+# The fields reported by the dump commands.
+sectorFields = string.split(
+    "x y des sdes eff mob * off min gold fert ocontent uran work avail"
+    " terr civ mil uw food shell gun pet iron dust bar oil lcm hcm rad"
+    " u_del f_del g_del p_del i_del d_del b_del o_del l_del h_del r_del"
+    " u_cut f_cut g_cut p_cut i_cut d_cut b_cut o_cut l_cut h_cut r_cut"
+    " dist_x dist_y c_dist m_dist u_dist f_dist s_dist g_dist p_dist"
+    " i_dist d_dist b_dist o_dist l_dist h_dist r_dist road rail defense"
+    " fallout coast")
+shipFields = string.split(
+    "id type x y flt eff civ mil uw food pln he xl land mob fuel tech"
+    " shell gun petrol iron dust bar oil lcm hcm rad def spd vis rng fir"
+    " name")
+planeFields = string.split(
+    "id type x y wing eff mob tech att def acc react range load fly hard"
+    " ship land laun orb nuke grd")
+landFields = string.split(
+    "id type x y army eff mob tech retr react xl nland land ship rad"
+    " harden civ mil uw food shell gun petrol iron dust bar oil lcm hcm")
+
+sectorTypes = "cmgah+*ofbpjkiwe%dtlur!"
+unitTypes = {'SHIPS': ('pt', 'dd', 'cs', 'fb', 'bb', 'sb'),
+             'PLANES': ('f1', 'f2', 'lb', 'hb', 'tr', 'sp'),
+             'LAND UNITS': ('inf', 'cav', 'art', 'eng', 'spy', 'lat')}
+unitGroups = "~abcdefgh"
+
+def randomValue(field, x, y):
+    """Return a plausible string value for a dump FIELD."""
+    if field == 'x':
+        return str(x)
+    elif field == 'y':
+        return str(y)
+    elif field == 'des':
+        return random.choice(sectorTypes)
+    elif field == 'sdes':
+        return '_'
+    elif field == '*':
+        return random.choice('..*')
+    elif field[-4:] == '_del':
+        return random.choice('.....ugjbyn')
+    elif field == 'name':
+        return '"%s"' % random.choice(("", "Sea Dog", "x", "Big Boat"))
+    elif field in ('flt', 'wing', 'army'):
+        return random.choice(unitGroups)
+    elif field in ('eff', 'work', 'avail', 'fert', 'ocontent', 'min',
+                   'gold', 'uran'):
+        return str(random.randint(0, 100))
+    elif field in ('mob', 'off', 'terr', 'coast', 'road', 'rail',
+                   'defense', 'fallout'):
+        return str(random.randint(0, 127))
+    return str(random.randint(0, 999))
+
+class World:
+    """A synthetic game world.
+
+    Items are stored as lists of strings (one per dump field) along with
+    the time they last changed, so that dumps with a ?timestamp selector
+    only report the changed items.
+    """
+    def __init__(self, width=64, height=32, ships=200, planes=200,
+                 lands=200, seed=1):
+        random.seed(seed)
+        self.width = width
+        self.height = height
+        self.now = int(time.time())
+        # dbname -> [fields, {key: [timestamp, values]}]
+        self.tables = {}
+        sectors = {}
+        coords = []
+        for y in range(-height/2, height - height/2):
+            for x in range(-width/2, width - width/2):
+                if (x + y) & 1:
+                    continue
+                sectors[(x, y)] = [self.now, map(
+                    randomValue, sectorFields, [x]*len(sectorFields),
+                    [y]*len(sectorFields))]
+                coords.append((x, y))
+        self.coords = coords
+        self.tables['SECTOR'] = [sectorFields, sectors]
+        for dbname, fields, count in (('SHIPS', shipFields, ships),
+                                      ('PLANES', planeFields, planes),
+                                      ('LAND UNITS', landFields, lands)):
+            units = {}
+            types = unitTypes[dbname]
+            for i in range(count):
+                x, y = random.choice(coords)
+                values = map(randomValue, fields, [x]*len(fields),
+                             [y]*len(fields))
+                values[0] = str(i)
+                values[1] = random.choice(types)
+                units[(i,)] = [self.now, values]
+            self.tables[dbname] = [fields, units]
+
+    def tick(self):
+        """Advance the world clock to the current time."""
+        self.now = max(self.now, int(time.time()))
+
+    def churn(self, count):
+        """Randomly change COUNT sectors."""
+        fields, sectors = self.tables['SECTOR']
+        mob = fields.index('mob')
+        civ = fields.index('civ')
+        for i in range(count):
+            item = sectors[random.choice(self.coords)]
+            item[0] = self.now
+            item[1][mob] = str(random.randint(0, 127))
+            item[1][civ] = str(random.randint(0, 999))
+
+    def setField(self, dbname, key, field, value):
+        """Change one field of an item."""
+        fields, items = self.tables[dbname]
+        if items.has_key(key):
+            item = items[key]
+            item[0] = self.now
+            item[1][fields.index(field)] = value
+
+    def dump(self, dbname, since=None, fields=None):
+        """Return the lines of a dump of DBNAME.
+
+        Only items changed after SINCE are reported, and only the named
+        FIELDS (plus the item's key) are included when FIELDS is given.
+        """
+        allFields, items = self.tables[dbname]
+        if fields:
+            if dbname == 'SECTOR':
+                key = ['x', 'y']
+            else:
+                key = ['id']
+            fields = key + filter(lambda f, k=key: f not in k, fields)
+            cols = []
+            for f in fields:
+                if f not in allFields:
+                    return ["%s: no such field" % f]
+                cols.append(allFields.index(f))
+        else:
+            fields = allFields
+            cols = None
+        lines = [serverTime(self.now),
+                 "DUMP %s %d" % (dbname, self.now),
+                 string.join(fields)]
+        keys = items.keys()
+        keys.sort()
+        count = 0
+        for k in keys:
+            ts, values = items[k]
+            if since is not None and ts <= since:
+                continue
+            if cols is not None:
+                values = map(lambda c, v=values: v[c], cols)
+            lines.append(string.join(values))
+            count = count + 1
+        name = {'SECTOR': 'sector', 'SHIPS': 'ship', 'PLANES': 'plane',
+                'LAND UNITS': 'unit'}[dbname]
+        if count == 1:
+            lines.append("1 %s" % name)
+        else:
+            lines.append("%d %ss" % (count, name))
+        return lines
+
+    def map(self):
+        """Return the lines of a map of the whole world."""
+        fields, sectors = self.tables['SECTOR']
+        des = fields.index('des')
+        xlist = range(-self.width/2, self.width - self.width/2)
+        digits = len(str(max(map(abs, xlist))))
+        header = []
+        for i in range(digits):
+            div = 10 ** (digits - i - 1)
+            header.append("     " + string.join(map(
+                lambda x, d=div: str(abs(x) / d % 10), xlist), ""))
+        lines = header[:]
+        for y in range(-self.height/2, self.height - self.height/2):
+            row = []
+            for x in xlist:
+                if sectors.has_key((x, y)):
+                    row.append(sectors[(x, y)][1][des])
+                else:
+                    row.append(" ")
+            lines.append("%4d %s %d" % (y, string.join(row, ""), y))
+        return lines + header
+
+    def nation(self):
+        """Return the lines of a nation report."""
+        return ["",
+                "(#1) Mock Nation Report\t%s" % serverTime(self.now, 1),
+                "Nation status is ACTIVE     Bureaucratic Time Units: 640",
+                "100% eff capital at 0,0 has 805 civilians & 5 military",
+                " The treasury has $35703.00     Military reserves: 2769",
+                "Education.......... 78.35       Happiness.......  0.00",
+                "Technology.........251.80       Research........  0.00",
+                "Technology factor : 66.80%     Plague factor :   0.00%",
+                "",
+                "Max population : 999",
+                "Max safe population for civs/uws: 805/891",
+                "Happiness needed is 31.410360"]
+
+    def sectorStats(self):
+        """Return the lines of a 'show sect stats' report."""
+        lines = ["",
+                 "                        --- Sector Statistics ---",
+                 "                    mcost off def mil  uw civ bar"
+                 " other   max"]
+        for des in sectorTypes:
+            name = empParse.sectorDesignationConvert.get(des, "unknown")
+            mcost, bonus = 0.4, (1, 1, 1, 1, 1)
+            if des in "+%":
+                mcost = 0.2
+            elif des == 'w':
+                bonus = (1, 10, 10, 10, 10)
+            elif des == 'h':
+                bonus = (1, 1, 1, 1, 10)
+            elif des == 'b':
+                bonus = (1, 1, 1, 4, 1)
+            lines.append("%s %-18s %5.1f %3d %3d %3d %3d %3d %3d %5d %5d" % (
+                (des, name, mcost, 1, 1) + bonus + (999,)))
+        return lines
+
+    def version(self):
+        """Return the lines of the version report."""
+        return ["Empire 4.2.12 (mock server)",
+                "",
+                "World size is %d by %d." % (self.width, self.height),
+                "There can be up to 99 countries.",
+                "",
+                "An Empire time unit is 60 seconds long.",
+                "The current time is %s." % serverTime(self.now),
+                "An update consists of 48 empire time units.",
+                "Each country is allowed to be logged in 1440 minutes a day.",
+                "It takes 8.33 civilians to produce a BTU in one time unit.",
+                "",
+                "A non-aggi, 100 fertility sector can grow 6.00 food per etu.",
+                "1000 civilians will harvest 1.3 food per etu.",
+                "1000 civilians will give birth to 5.0 babies per etu.",
+                "1000 uncompensated workers will give birth to 2.5 babies.",
+                "In one time unit, 1000 people eat 0.5 units of food.",
+                "1000 babies eat 6.0 units of food becoming adults.",
+                "",
+                "Banks pay $250.00 in interest per 1000 gold bars per etu.",
+                "1000 civilians generate $8.33, uncompensated workers"
+                " $1.78 each time unit.",
+                "1000 active military cost $83.33, reserves cost $8.33.",
+                "Happiness p.e. requires 1 happy stroller per 5000 civ.",
+                "Education p.e. requires 1 class of graduates per 4000 civ.",
+                "Happiness is averaged over 48 time units.",
+                "Education is averaged over 192 time units.",
+                "The technology/research boost you get from the world"
+                " is 50.00%.",
+                "Nation levels (tech etc.) decline 1% every 96 time units.",
+                "Tech Buildup is limited to logarithmic growth (base 2.00)"
+                " after 1.00.",
+                "",
+                "\t\t\t\tsect\tship\tplane\tland",
+                "Maximum mobility\t\t127\t127\t127\t127",
+                "Max mob gain per update\t\t48\t72\t48\t48",
+                "Max eff gain per update\t\t--\t100\t96\t96",
+                "",
+                "Fire ranges are scaled by 1.00",
+                "",
+                "Options enabled in this game:",
+                "        BLITZ, FALLOUT, NEW_STARVE, NEW_WORK, RES_POP",
+                "",
+                "Options disabled in this game:",
+                "        MOB_ACCESS, NO_PLAGUE, SAIL, TECH_POP",
+                ""]
+
+def serverTime(t, year=0):
+    """Return the time T in the format the server uses."""
+    if year:
+        return time.strftime("%a %b %d %H:%M:%S %Y", time.localtime(t))
+    return time.strftime("%a %b %d %H:%M:%S", time.localtime(t))
+
+###########################################################################
+#############################  Server         #############################
+
+# Arguments of the interactive commands, and the sub-prompts used to ask
+# for them when they are missing.
+commandPrompts = {
+    'thr': ("Item type? ", "Sector(s)? ", "Threshold? "),
+    'des': ("Sector(s)? ", "Designation? "),
+    'mov': ("Item type? ", "From sector? ", "Number? ", "Path? "),
+    }
+
+class Connection:
+    """One client connection to the mock server."""
+    def __init__(self, server, sock):
+        self.server = server
+        self.socket = sock
+        sock.setblocking(0)
+        self.InpBuf = ""
+        # Output waiting to be sent: [(release time, data), ...]
+        self.pending = []
+        # Set once 'play' has been received
+        self.playing = 0
+        # The command waiting on a sub-prompt and the arguments so far
+        self.command = None
+        self.args = []
+        self.nextAsync = time.time() + server.asyncInterval
+        self.asyncCount = 0
+        self.send(C_INIT, "Empire server ready")
+
+    def send(self, proto, msg):
+        """Queue a line of output (after the configured latency)."""
+        self.queue("%s %s\n" % (proto, msg))
+
+    def queue(self, data):
+        when = time.time() + self.server.latency
+        if self.pending and self.pending[-1][0] >= when:
+            when, old = self.pending[-1]
+            self.pending[-1] = (when, old + data)
+        else:
+            self.pending.append((when, data))
+
+    def prompt(self):
+        self.send(C_PROMPT, "640 640")
+
+    def output(self, lines):
+        """Queue the lines of a command's output followed by a prompt."""
+        self.queue(string.join(map(lambda l: C_DATA + " " + l + "\n",
+                                   lines), ""))
+        self.prompt()
+
+    def readable(self):
+        """Read commands from the socket."""
+        try:
+            data = self.socket.recv(4096)
+        except socket.error, e:
+            if e[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = ""
+        if not data:
+            self.close()
+            return
+        lines = string.split(self.InpBuf + data, "\n")
+        self.InpBuf = lines[-1]
+        for line in lines[:-1]:
+            self.line(string.strip(line))
+
+    def writable(self, budget):
+        """Send output that is due; send at most BUDGET bytes."""
+        now = time.time()
+        sent = 0
+        while self.pending and self.pending[0][0] <= now and sent < budget:
+            when, data = self.pending[0]
+            try:
+                count = self.socket.send(data[:budget - sent])
+            except socket.error, e:
+                if e[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                self.close()
+                return sent
+            sent = sent + count
+            if count < len(data):
+                self.pending[0] = (when, data[count:])
+                break
+            del self.pending[0]
+        return sent
+
+    def close(self):
+        self.socket.close()
+        self.server.remove(self)
+
+    def line(self, line):
+        """Process one line from the client."""
+        if not self.playing:
+            self.login(line)
+            return
+        if self.command is not None:
+            # Answer to a sub-prompt
+            self.args.append(line)
+            self.runCommand()
+            return
+        words = string.split(line)
+        if not words:
+            self.prompt()
+            return
+        self.command = words[0]
+        self.args = words[1:]
+        self.runCommand()
+
+    def login(self, line):
+        words = string.split(line)
+        verb = (words + [""])[0]
+        if verb in ('user', 'coun', 'pass'):
+            self.send(C_CMDOK, "%s ok" % verb)
+        elif verb == 'kill':
+            self.send(C_EXIT, "closed socket of offending job")
+        elif verb == 'play':
+            self.playing = 1
+            self.send(C_INIT, "2")
+            self.prompt()
+        else:
+            self.send(C_CMDERR, "Command %s not found" % verb)
+
+    def runCommand(self):
+        """Run the current command once all its arguments are known."""
+        world = self.server.world
+        cmd = self.command
+        args = self.args
+        verb = cmd[:3]
+        if commandPrompts.has_key(verb):
+            prompts = commandPrompts[verb]
+            if len(args) < len(prompts):
+                self.send(C_FLUSH, prompts[len(args)])
+                return
+        self.command = None
+        world.tick()
+        if cmd in ('quit', 'exit'):
+            self.send(C_EXIT, "so long...")
+            return
+        lines = []
+        if cmd[-4:] == 'dump':
+            dbname = {'dump': 'SECTOR', 'sdump': 'SHIPS', 'pdump': 'PLANES',
+                      'ldump': 'LAND UNITS'}.get(cmd)
+            if dbname is None or not args:
+                lines = ["Usage: %s <area> [?timestamp>N] [<fields>]" % cmd]
+            else:
+                since = None
+                fields = []
+                for i in args[1:]:
+                    if i[:11] == "?timestamp>":
+                        since = int(i[11:])
+                    else:
+                        fields.append(i)
+                lines = world.dump(dbname, since, fields)
+        elif cmd[:3] == 'map':
+            lines = world.map()
+        elif cmd[:3] == 'nat':
+            lines = world.nation()
+        elif cmd[:3] == 'ver':
+            lines = world.version()
+        elif (verb == 'sho' and args[:1] == ['sect']
+              and args[1:] and args[1][:4] == 'stat'):
+            lines = world.sectorStats()
+        elif verb == 'des':
+            for sect in string.split(args[0], "/"):
+                try:
+                    x, y = map(int, string.split(sect, ","))
+                except ValueError:
+                    continue
+                world.setField('SECTOR', (x, y), 'des', args[1][:1])
+        elif verb == 'thr':
+            lines = ["%s threshold set to %s" % (args[0], args[2])]
+        elif verb == 'mov':
+            lines = ["Total movement cost = 0"]
+        else:
+            lines = ["%s: Command not found" % cmd]
+        if self.server.churn:
+            world.churn(self.server.churn)
+        self.output(lines)
+
+    def checkAsync(self, now):
+        """Send a flash or inform message if one is due."""
+        if not self.playing or now < self.nextAsync:
+            return
+        self.nextAsync = now + self.server.asyncInterval
+        self.asyncCount = self.asyncCount + 1
+        if self.asyncCount & 1:
+            self.send(C_FLASH, "Mock (#2): message %d" % self.asyncCount)
+        else:
+            self.send(C_INFORM, "%d new telegrams" % (self.asyncCount/2))
+
+class MockServer:
+    """Listen for clients on the loopback interface and serve a World.
+
+    latency - seconds to delay each line of output.
+    bandwidth - maximum bytes per second sent to each client (0 = none).
+    asyncInterval - seconds between asynchronous messages (0 = none).
+    churn - number of sectors changed by each command.
+    """
+    def __init__(self, world, port=0, latency=0.0, bandwidth=0,
+                 asyncInterval=0, churn=0):
+        self.world = world
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.asyncInterval = asyncInterval
+        self.churn = churn
+        self.connections = []
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(('127.0.0.1', port))
+        self.socket.listen(5)
+        self.port = self.socket.getsockname()[1]
+        self.lastSend = time.time()
+
+    def remove(self, conn):
+        if conn in self.connections:
+            self.connections.remove(conn)
+
+    def poll(self, timeout=0.1):
+        """Handle socket activity for up to TIMEOUT seconds."""
+        now = time.time()
+        readers = [self.socket] + map(lambda c: c.socket, self.connections)
+        writers = []
+        for conn in self.connections:
+            if self.asyncInterval:
+                conn.checkAsync(now)
+            if conn.pending:
+                due = conn.pending[0][0]
+                if due <= now:
+                    writers.append(conn.socket)
+                else:
+                    timeout = min(timeout, due - now)
+            if self.asyncInterval:
+                timeout = min(timeout, max(conn.nextAsync - now, 0))
+        if self.bandwidth and writers:
+            # Wait until at least a little bandwidth is available.
+            timeout = min(timeout, 0.01)
+        try:
+            r, w, e = select.select(readers, writers, [], max(timeout, 0))
+        except select.error, e:
+            if e[0] == errno.EINTR:
+                return
+            raise
+        if self.socket in r:
+            sock, addr = self.socket.accept()
+            self.connections.append(Connection(self, sock))
+        for conn in self.connections[:]:
+            if conn.socket in r:
+                conn.readable()
+        if w:
+            now = time.time()
+            if self.bandwidth:
+                budget = max(int((now - self.lastSend) * self.bandwidth), 1)
+            else:
+                budget = 1 << 30
+            self.lastSend = now
+            for conn in self.connections[:]:
+                if conn.socket in w:
+                    conn.writable(budget)
+
+    def serve(self):
+        """Serve clients forever."""
+        while 1:
+            self.poll(1.0)
+
+def main():
+    usage = ("Usage:\n" + str(sys.argv[0])
+             + " [-p <port>] [-s <width>x<height>] [-u <units>]"
+             + " [-l <latency ms>] [-b <bytes/s>] [-a <async secs>]"
+             + " [-k <churn>] [-r <seed>]")
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'p:s:u:l:b:a:k:r:h?')
+    except getopt.error:
+        print usage
+        sys.exit(1)
+    port = 6665
+    width, height = 64, 32
+    units = 200
+    latency = 0.0
+    bandwidth = asyncInterval = churn = 0
+    seed = 1
+    for i, j in opts:
+        if i == '-p':
+            port = int(j)
+        elif i == '-s':
+            width, height = map(int, string.split(j, 'x'))
+        elif i == '-u':
+            units = int(j)
+        elif i == '-l':
+            latency = float(j) / 1000.0
+        elif i == '-b':
+            bandwidth = int(j)
+        elif i == '-a':
+            asyncInterval = float(j)
+        elif i == '-k':
+            churn = int(j)
+        elif i == '-r':
+            seed = int(j)
+        else:
+            print usage
+            sys.exit(0)
+    world = World(width, height, units, units, units, seed)
+    server = MockServer(world, port, latency, bandwidth, asyncInterval,
+                        churn)
+    print "Mock server (%dx%d world) listening on 127.0.0.1:%d" % (
+        width, height, server.port)
+    server.serve()
+
+if __name__=='__main__':
+    main()
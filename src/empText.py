@@ -16,7 +16,6 @@
 #    along with this program; if not, write to the Free Software
 #    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
-import select
 import sys
 import string
 # Readline is not practical because there is no way to interleave terminal
@@ -26,9 +25,14 @@ import string
 import empDb
 import empQueue
 import empCmd
+import empLoop
 
 # Key Ideas:
 
+# The text viewer runs on an empLoop.EventLoop.  The socket, the keyboard
+# and the timers are all serviced by the loop, so the socket continues to
+# be read while the user types an answer to a sub-prompt.
+
 # What is contained within this file:
 
 # This file contains the simple text viewer interface.  The text viewer is
@@ -52,6 +56,11 @@ class SText:
         self.login_kill = 0
         self.stayOnline = 0
         self.atPrompt = 0
+        # The handler waiting for the answer to a sub-prompt.
+        self.subPrompt = None
+        self.loop = empLoop.EventLoop()
+        self.stdin = empLoop.LineReader(sys.stdin, self.HandleLine,
+                                        self.HandleEOF)
 
     def Begin(self, cmd):
         """empQueue handler: Note the beginning of a command."""
@@ -70,12 +79,10 @@ class SText:
         if hdl is None:
             print msg
             return
-        try:
-            cmd = raw_input(msg)
-        except KeyboardInterrupt:
-            cmd = "ctlc"
-            print
-        hdl(cmd)
+        # The answer is read by HandleLine.
+        sys.stdout.write(msg)
+        sys.stdout.flush()
+        self.subPrompt = hdl
         self.atPrompt = 0
 
     def End(self, cmd):
@@ -86,7 +93,13 @@ class SText:
         sys.stdout.flush()
         self.atPrompt = 1
 
-    Answer = Process = empQueue.doNothing
+    Answer = empQueue.doNothing
+
+    def Process(self):
+        """empQueue handler: Note a lull in socket activity."""
+        # Deliver the database changes to the subscribers (eg. the
+        # history recorder).
+        empDb.flushChanges()
 
     def inform(self):
         """empQueue handler: Process an asynchronous prompt update."""
@@ -151,32 +164,49 @@ class SText:
         """empQueue/login handler: Note a server disconnect."""
         self.stayOnline = 0
 
+    def HandleLine(self, cmd):
+        """LineReader callback: Process a line of keyboard input."""
+        if self.subPrompt is not None:
+            hdl = self.subPrompt
+            self.subPrompt = None
+            hdl(cmd)
+            return
+        if self.atPrompt:
+            sys.stdout.write("")
+            self.atPrompt = 0
+        try:
+            self.ioq.HistSend(cmd)
+        except IndexError:
+            print "History substitution error."
+        if not self.stayOnline:
+            sys.stdout.write("Off-line: ")
+            sys.stdout.flush()
+
+    def HandleEOF(self):
+        """LineReader callback: Note the end of keyboard input."""
+        print
+        self.HandleLine("ctld")
+        if not self.stayOnline:
+            self.loop.stop()
+
     def main(self):
         """empire.py callback: Start the main input/output loop."""
+        loop = self.loop
+        loop.addReader(self.ioq, self.ioq.HandleInput)
+        loop.addReader(self.stdin, self.stdin.read)
+        empLoop.addStandardTimers(loop, self.flash)
         # Hack!  Wait for the connect before continuing.
-        while not self.stayOnline:
-            cmd = raw_input("Off-line: ")
+        if not self.stayOnline:
+            sys.stdout.write("Off-line: ")
+            sys.stdout.flush()
+        while 1:
             try:
-                self.ioq.HistSend(cmd)
-            except IndexError:
-                print "History substitution error."
-        # Ok, we are online now.
-        while self.stayOnline:
-            pending = select.select([self.ioq, sys.stdin], [], [])[0]
-            if pending and pending[0] == self.ioq:
-                self.ioq.HandleInput()
-                del pending[0]
-            if pending and pending[0] == sys.stdin:
-                try:
-                    cmd = raw_input()
-                except EOFError:
-                    cmd = "ctld"
-                    print
-                if self.atPrompt:
-                    sys.stdout.write("")
-                    self.atPrompt = 0
-                try:
-                    self.ioq.HistSend(cmd)
-                except IndexError:
-                    print "History substitution error."
-                del pending[0]
+                loop.run(lambda self=self: not self.stayOnline)
+                # Ok, we are online now.
+                loop.run(lambda self=self: self.stayOnline)
+                break
+            except KeyboardInterrupt:
+                if self.subPrompt is None:
+                    raise
+                print
+                self.HandleLine("ctlc")
@@ -412,7 +412,8 @@ class mainWin:
             self.displayMsgs()
 
         # Update the graphical displays.
-        if filter(None, empDb.updateDB.values()):
+        changed = empDb.flushChanges()
+        if changed or filter(None, empDb.updateDB.values()):
             self.redraw()
 
     def inform(self):
@@ -0,0 +1,432 @@
+"""Vectorized evaluation of sector selections."""
+
+#    Copyright (C) 1998-1999 Kevin O'Connor
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import string
+import re
+import types
+
+import empDb
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Key Ideas:
+
+# Selecting sectors with the row engine (see empEval.execCodeblock())
+# costs a python function call per sector.  On large worlds, with tens of
+# thousands of sectors, this is the bulk of the time taken by commands
+# like 'foreach' and 'mmove'.
+#
+# If the NumPy extension is installed, this file keeps a copy of the
+# sector database in columns - one array per field, in the order of the
+# sorted sector keys.  Simple terms of a condition ('civ>100',
+# "des=='m'", 'newdes!=des', area and circle tests) are turned into
+# boolean arrays, and combined with a single array operation.  The
+# sectors that remain are handed back to empEval as the candidates of a
+# query plan (see empEval.QueryPlan); any term that can't be converted
+# is still tested by the row engine, but only on those candidates.
+#
+# The columns are built the first time a field is used.  After that they
+# are kept up to date from the change feed of the database (see
+# empDb.subscribe()), so only the values that changed are stored again.
+# A new sector, or a new database (see DBIO.load()), causes the columns to
+# be rebuilt.  So does a change that the feed didn't see: the generation
+# of the database (see dictDB.generation) is checked before each query.
+#
+# Without NumPy nothing here is used, and the row engine handles every
+# query.
+
+
+# What is contained within this file:
+
+# ColumnSnapshot - the columns of a sub-database.
+# vectorPath - the entry point used by empEval.QueryPlan.
+# tally - sums and ranges of fields (see empEval.tally()).
+
+
+# Global variables:
+
+# enabled : Set to 0 to always use the row engine.
+enabled = 1
+
+# minItems : Databases with fewer items are always examined row by row -
+# building the arrays doesn't pay off on small worlds.
+minItems = 2000
+
+# databases : The sub-databases that may be vectorized.  (Area and circle
+# tests need the 'x' and 'y' fields of the items.)
+databases = ('SECTOR',)
+
+# snapshots : The ColumnSnapshot of each database that has been queried.
+snapshots = {}
+
+
+###########################################################################
+#############################  Column snapshot  ###########################
+class ColumnSnapshot:
+    """The fields of every item of a sub-database, stored in arrays.
+
+    Each column is a tuple (kind, values, present).  KIND is 'n' for
+    numbers (VALUES is an array of floats) or 's' for strings (VALUES is
+    a NumPy string array).  PRESENT is a boolean array that is false where
+    an item doesn't have the field.  A field with any other type of value
+    has the column None, and can't be vectorized.
+    """
+    def __init__(self, dbname):
+        self.dbname = dbname
+        self.db = None
+        # Sorted list of the keys of the items.
+        self.keys = []
+        # Position of each key in the columns.
+        self.index = {}
+        self.columns = {}
+        self.stale = 1
+        self.feed = empDb.subscribe(dbname, self.noteChanges)
+
+    def noteChanges(self, dbname, events):
+        """empDb change feed callback: Store the new values."""
+        if self.stale:
+            return
+        index = self.index
+        columns = self.columns
+        for key, fields in events.items():
+            pos = index.get(key)
+            if pos is None:
+                # A new item - start over.
+                self.stale = 1
+                return
+            for field, (old, new) in fields.items():
+                if not columns.has_key(field):
+                    continue
+                column = columns[field]
+                if column is None or not storeValue(column, pos, new):
+                    # The value doesn't fit the column - rebuild it.
+                    del columns[field]
+
+    def sync(self):
+        """Bring the columns up to date with the database."""
+        db = empDb.megaDB[self.dbname]
+        if db is not self.db:
+            self.db = db
+            self.stale = 1
+        self.feed.flush()
+        if self.feed.generation != db.generation:
+            # The database was changed without updates() (eg. through a
+            # columnRow) - the change feed doesn't have every change.
+            self.stale = 1
+        if self.stale:
+            self.keys = db.keys()
+            self.keys.sort()
+            index = self.index = {}
+            for i in range(len(self.keys)):
+                index[self.keys[i]] = i
+            self.columns = {}
+            self.feed.generation = db.generation
+            self.stale = 0
+
+    def column(self, field):
+        """Return the column of FIELD (building it if needed)."""
+        try:
+            return self.columns[field]
+        except KeyError:
+            pass
+        db = self.db
+        if hasattr(db, 'columnItems'):
+            values = [None] * len(self.keys)
+            index = self.index
+            for key, val in db.columnItems(field):
+                values[index[key]] = val
+        else:
+            values = map(lambda row, field=field: row.get(field),
+                         map(db.primary.get, self.keys))
+        column = self.columns[field] = makeColumn(values)
+        return column
+
+    def newdes(self):
+        """Return a column of the 'newdes' of every item.
+
+        newdes is sdes, unless sdes is '_' - then it is des.
+        """
+        des = self.column('des')
+        sdes = self.column('sdes')
+        if (des is None or sdes is None
+            or des[0] != 's' or sdes[0] != 's'):
+            return None
+        build = sdes[1] == '_'
+        return ('s', numpy.where(build, des[1], sdes[1]),
+                sdes[2] & (des[2] | numpy.logical_not(build)))
+
+    def select(self, mask):
+        """Return the keys of the items selected by the boolean array MASK."""
+        return map(self.keys.__getitem__, numpy.nonzero(mask)[0].tolist())
+
+def makeColumn(values):
+    """Return a column for VALUES, with None marking a missing value."""
+    present = filter(lambda val: val is not None, values)
+    kinds = empDb.valueKinds(present)
+    have = numpy.array(map(lambda val: val is not None, values), numpy.bool_)
+    for kind in kinds:
+        if kind not in (types.IntType, types.FloatType):
+            break
+    else:
+        # Missing values are stored as zero (PRESENT masks them out).
+        return ('n', numpy.array(map(lambda val: val or 0, values),
+                                 numpy.float64),
+                have)
+    if kinds == [types.StringType]:
+        return ('s', numpy.array(map(lambda val: val is None and '' or val,
+                                     values)),
+                have)
+    return None
+
+def storeValue(column, pos, val):
+    """Store VAL at POS in COLUMN.  Return false if it doesn't fit."""
+    kind, values, present = column
+    if val is None:
+        present[pos] = 0
+        return 1
+    t = type(val)
+    if kind == 'n':
+        if t is not types.IntType and t is not types.FloatType:
+            return 0
+    elif t is not types.StringType or len(val) > values.itemsize:
+        return 0
+    values[pos] = val
+    present[pos] = 1
+    return 1
+
+###########################################################################
+#############################  Masks            ###########################
+
+compareFormat = re.compile(
+    r"^(?P<var>[a-z_][a-z0-9_]*)\s*(?P<opr>==|!=|<>|<=|>=|<|>)\s*"
+    r"(?P<val>-?\d+(?:\.\d*)?|'[^'\\]*'|\"[^\"\\]*\")$")
+reverseFormat = re.compile(
+    r"^(?P<val>-?\d+(?:\.\d*)?|'[^'\\]*'|\"[^\"\\]*\")\s*"
+    r"(?P<opr>==|!=|<>|<=|>=|<|>)\s*(?P<var>[a-z_][a-z0-9_]*)$")
+# The operator to use when the two sides of a comparison are swapped.
+swapOperators = {'==': '==', '!=': '!=', '<>': '!=',
+                 '<': '>', '>': '<', '<=': '>=', '>=': '<='}
+operators = {'==': lambda a, b: a == b, '!=': lambda a, b: a != b,
+             '<': lambda a, b: a < b, '>': lambda a, b: a > b,
+             '<=': lambda a, b: a <= b, '>=': lambda a, b: a >= b}
+
+def compareMask(column, opr, value):
+    """Return a boolean array of the items where 'item OPR VALUE' is true.
+
+    None is returned if the comparison can't be vectorized.
+    """
+    if column is None:
+        return None
+    kind, values, present = column
+    t = type(value)
+    if kind == 'n':
+        if t is not types.IntType and t is not types.FloatType:
+            return None
+    elif t is not types.StringType:
+        return None
+    return present & operators[opr](values, value)
+
+def rangeMask(values, low, high):
+    """Vector version of empDb.inRange()."""
+    if low <= high:
+        return (values >= low) & (values <= high)
+    return (values >= low) | (values <= high)
+
+def distances(xs, ys, x, y):
+    """Vector version of empDb.sectorDistance()."""
+    size_x, size_y = empDb.megaDB['version']['worldsize']
+    dx = numpy.minimum(numpy.mod(x - xs, size_x), numpy.mod(xs - x, size_x))
+    dy = numpy.minimum(numpy.mod(y - ys, size_y), numpy.mod(ys - y, size_y))
+    d = numpy.minimum(dx, dy)
+    return d + numpy.maximum(numpy.floor_divide(dx - d, 2), dy - d)
+
+def termMask(snap, term, envio):
+    """Return a boolean array for the term TERM (see empEval.parseTerms()).
+
+    ENVIO is the selector table of the database.  None is returned if the
+    term can't be vectorized.
+    """
+    kind = term[0]
+    if term[-1] == "1":
+        # The condition of an unrestricted selection.
+        return numpy.ones(len(snap.keys), numpy.bool_)
+    if kind in ('area', 'circle'):
+        xs = snap.column('x')
+        ys = snap.column('y')
+        if xs is None or ys is None or xs[0] != 'n' or ys[0] != 'n':
+            return None
+        if kind == 'area':
+            minX, maxX, minY, maxY = term[1:5]
+            return (xs[2] & ys[2] & rangeMask(xs[1], minX, maxX)
+                    & rangeMask(ys[1], minY, maxY))
+        x, y, dist = term[1:4]
+        return xs[2] & ys[2] & (distances(xs[1], ys[1], x, y) <= dist)
+    elif kind == 'value':
+        return compareMask(snap.column(term[1]), '==', term[2])
+    elif kind == 'newdes':
+        return compareMask(snap.newdes(), '==', term[1])
+    mc = compareFormat.match(term[-1])
+    if mc:
+        opr = mc.group('opr')
+        if opr == '<>':
+            opr = '!='
+    else:
+        mc = reverseFormat.match(term[-1])
+        if not mc:
+            return None
+        opr = swapOperators[mc.group('opr')]
+    return compareMask(selectorColumn(snap, mc.group('var'), envio), opr,
+                       eval(mc.group('val'), {}))
+
+def selectorColumn(snap, name, envio):
+    """Return the column for the selector NAME, or None."""
+    target = envio.get(name)
+    if type(target) == type(""):
+        return snap.column(target)
+    elif target is not None and target is envio.get('newdes'):
+        return snap.newdes()
+    return None
+
+def getSnapshot(dbname):
+    """Return the (up to date) ColumnSnapshot of DBNAME."""
+    try:
+        snap = snapshots[dbname]
+    except KeyError:
+        snap = snapshots[dbname] = ColumnSnapshot(dbname)
+    snap.sync()
+    return snap
+
+def termsMask(snap, terms, envio):
+    """Combine the arrays of every term of TERMS that can be vectorized.
+
+    Returns a tuple of the boolean array (or None if no term can be
+    vectorized) and the list of the terms that were used.
+    """
+    mask = None
+    used = []
+    for term in terms:
+        tmask = termMask(snap, term, envio)
+        if tmask is None:
+            continue
+        used.append(term)
+        if mask is None:
+            mask = tmask
+        else:
+            mask = mask & tmask
+    return mask, used
+
+def usable(dbname, db):
+    """Return true if queries on DB should be vectorized."""
+    if numpy is None or not enabled or dbname not in databases:
+        return 0
+    snap = snapshots.get(dbname)
+    if snap is not None and snap.db is db:
+        # Counting the keys of a columnDB is slow - use the snapshot.
+        return len(snap.keys) >= minItems
+    return len(db.keys()) >= minItems
+
+def vectorPath(dbname, terms, envio):
+    """Return a query plan access path for the terms TERMS.
+
+    Every term that can be vectorized is converted to a boolean array, and
+    the arrays are combined.  The path is returned as a tuple of:
+        (count, description, function, terms, keysFunction)
+    where function() returns a dictionary of the selected items,
+    keysFunction() returns their sorted keys, and terms is the list of
+    the terms that were used.  None is returned if no term can be
+    vectorized.
+    """
+    snap = getSnapshot(dbname)
+    mask, used = termsMask(snap, terms, envio)
+    if mask is None:
+        return None
+    keys = snap.select(mask)
+    texts = map(lambda term: term[-1], used)
+    return (len(keys), "vector " + string.join(texts, " and "),
+            lambda db=snap.db, keys=keys: selectItems(db, keys),
+            used, lambda keys=keys: keys)
+
+def selectItems(db, keys):
+    """Return a dictionary of the items of DB with the keys KEYS."""
+    dict = {}
+    get = db.get
+    for key in keys:
+        dict[key] = get(key)
+    return dict
+
+###########################################################################
+#############################  Aggregates       ###########################
+def tally(dbname, terms, envio, fields, group):
+    """Vector version of empEval.tally().
+
+    TERMS are the classified terms of the condition.  None is returned if
+    a term, a field, or the group can't be vectorized.
+    """
+    if terms is None:
+        return None
+    snap = getSnapshot(dbname)
+    mask, used = termsMask(snap, terms, envio)
+    if mask is None or len(used) != len(terms):
+        return None
+    columns = []
+    for name in fields:
+        column = selectorColumn(snap, name, envio)
+        if column is None or column[0] != 'n':
+            return None
+        columns.append(column)
+    # Find the items in each group.
+    if group is None:
+        parts = [(None, mask)]
+    else:
+        column = selectorColumn(snap, group, envio)
+        if column is None:
+            return None
+        kind, values, present = column
+        parts = []
+        have = mask & present
+        for value in numpy.unique(values[have]).tolist():
+            parts.append((pythonValue(value), have & (values == value)))
+        missing = mask & numpy.logical_not(present)
+        if missing.any():
+            parts.append((None, missing))
+    result = {}
+    for value, part in parts:
+        stats = []
+        for kind, values, present in columns:
+            found = values[part & present]
+            if not len(found):
+                stats.append(None)
+                continue
+            stats.append([len(found), pythonValue(found.sum()),
+                          pythonValue(found.min()), pythonValue(found.max())])
+        result[value] = [int(part.sum()), stats]
+    return result
+
+def pythonValue(value):
+    """Convert a value from an array to a python number or string.
+
+    Numbers are stored as floats - whole numbers are returned as integers.
+    """
+    if type(value) is not types.StringType:
+        value = float(value)
+        if value == int(value):
+            return int(value)
+    return value
@@ -0,0 +1,522 @@
+"""Tests of the database (src/empDb.py)."""
+
+#    Copyright (C) 1998-1999 Kevin O'Connor
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import os
+import cPickle
+import unittest
+
+import testutil
+from testutil import sectorRow
+
+import empDb
+
+class JournalTest(testutil.DatabaseTest):
+    """The database journal (DatabaseSaver.journalMode)."""
+
+    def setUp(self):
+        testutil.DatabaseTest.setUp(self)
+        empDb.DBIO.journalMode = 1
+        empDb.DBIO.load(self.path("EmpDB"))
+
+    def crash(self):
+        """Drop the database without saving it, and load it again."""
+        empDb.DBIO.journal.close()
+        empDb.DBIO.journal = None
+        empDb.DBIO.reset()
+        empDb.DBIO.load(self.path("EmpDB"))
+
+    def records(self):
+        """Return the records stored in the journal."""
+        list = []
+        empDb.DatabaseJournal(self.path("EmpDB.jnl")).replay(list.append)
+        return list
+
+    def testUpdatesSurviveCrash(self):
+        empDb.megaDB['SECTOR'].updates([sectorRow(0, 0, civ=10)])
+        self.crash()
+        self.assertEqual(empDb.megaDB['SECTOR'][(0, 0)]['civ'], 10)
+
+    def testStateSurvivesCrash(self):
+        empDb.megaDB['nation']['capital'] = (2, 4)
+        empDb.megaDB['telegrams']['list'].append(["> Telegram", "hi"])
+        empDb.DBIO.lastSave = 0
+        empDb.DBIO.checkAutoSave()
+        self.crash()
+        self.assertEqual(empDb.megaDB['nation']['capital'], (2, 4))
+        self.assertEqual(empDb.megaDB['telegrams']['list'],
+                         [["> Telegram", "hi"]])
+
+    def testStateCheckedAtInterval(self):
+        empDb.megaDB['nation']['capital'] = (2, 4)
+        empDb.megaDB['telegrams']['list'].append(["one"])
+        empDb.DBIO.checkAutoSave()
+        # Only the messages are checked every time.
+        self.assertEqual(map(lambda r: r[0], self.records()),
+                         ['messages'])
+        empDb.DBIO.lastSave = 0
+        empDb.DBIO.checkAutoSave()
+        self.assertEqual(self.records()[-1],
+                         ('state', {'nation': empDb.megaDB['nation']}))
+
+    def testOnlyNewMessagesJournaled(self):
+        telegrams = empDb.megaDB['telegrams']
+        telegrams['list'].append(["one"])
+        empDb.DBIO.journalState()
+        telegrams['list'].append(["two"])
+        telegrams['last'] = (1, 2)
+        empDb.DBIO.journalState()
+        self.assertEqual(self.records()[-1],
+                         ('messages', 'telegrams', [["two"]], (1, 2)))
+        self.crash()
+        self.assertEqual(empDb.megaDB['telegrams']['list'],
+                         [["one"], ["two"]])
+        self.assertEqual(empDb.megaDB['telegrams']['last'], (1, 2))
+
+    def testUnchangedStateNotJournaled(self):
+        empDb.megaDB['telegrams']['list'].append(["one"])
+        empDb.DBIO.needSave = 1
+        empDb.DBIO.save()
+        count = len(self.records())
+        empDb.DBIO.load(self.path("EmpDB"))
+        empDb.DBIO.needSave = 1
+        empDb.DBIO.save()
+        self.assertEqual(len(self.records()), count)
+
+class HistoryJournalTest(JournalTest):
+    """The database journal with history (DatabaseSaver.historyMode)."""
+
+    def setUp(self):
+        testutil.DatabaseTest.setUp(self)
+        empDb.DBIO.journalMode = 1
+        empDb.DBIO.historyMode = 1
+        empDb.DBIO.load(self.path("EmpDB"))
+
+    def dump(self, timestamp, previous, rows):
+        """Process a sector dump and check the journal with its state."""
+        empDb.megaDB['SECTOR'].updates(rows)
+        empDb.DBIO.recordHistory('SECTOR', timestamp, previous)
+        empDb.DBIO.lastSave = 0
+        empDb.DBIO.checkAutoSave()
+
+    def testHistoryJournaledByDump(self):
+        rows = []
+        for i in range(400):
+            rows.append(sectorRow(i*2 % 64, i*2 / 64, civ=i, mil=i))
+        self.dump(1000, 0, rows)
+        for i in range(10):
+            size = empDb.DBIO.journal.size
+            self.dump(2000 + i*100, 1000, [sectorRow(0, 0, civ=i+1000)])
+            # Only the new value is added to the journal.
+            self.failUnless(empDb.DBIO.journal.size - size < 2000)
+        for record in self.records():
+            self.failIf(record[0] == 'state'
+                        and record[1].has_key('history'))
+        history = empDb.megaDB['history']
+        civ = history.getHistory('SECTOR', (0, 0), 'civ')
+        mil = history.getHistory('SECTOR', (8, 1), 'mil')
+        self.assertEqual(len(civ), 11)
+        self.crash()
+        history = empDb.megaDB['history']
+        self.assertEqual(history.getHistory('SECTOR', (0, 0), 'civ'), civ)
+        self.assertEqual(history.getHistory('SECTOR', (8, 1), 'mil'), mil)
+        # Changes after the crash are recorded and journaled as before.
+        self.dump(3000, 1000, [sectorRow(0, 0, civ=5)])
+        self.crash()
+        self.assertEqual(empDb.megaDB['history'].getHistory(
+            'SECTOR', (0, 0), 'civ')[-1], (3000, 5))
+
+class HistoryTest(testutil.DatabaseTest):
+    """Field history (HistoryDB)."""
+
+    def setUp(self):
+        testutil.DatabaseTest.setUp(self)
+        empDb.DBIO.historyMode = 1
+        empDb.DBIO.reset()
+
+    def dump(self, timestamp, previous, rows):
+        """Process a sector dump made at server time TIMESTAMP."""
+        empDb.megaDB['SECTOR'].updates(rows)
+        empDb.DBIO.recordHistory('SECTOR', timestamp, previous)
+
+    def testReadBack(self):
+        self.dump(1000, 0, [sectorRow(0, 0, civ=10, mil=5, des='+'),
+                            sectorRow(2, 0, civ=20)])
+        self.dump(2000, 1000, [sectorRow(0, 0, civ=15, mil=5),
+                               sectorRow(2, 0, civ=20)])
+        self.dump(3000, 1000, [sectorRow(0, 0, civ=12, mil=2),
+                               sectorRow(2, 0, civ=30)])
+        history = empDb.megaDB['history']
+        self.assertEqual(history.getHistory('SECTOR', (0, 0), 'civ'),
+                         [(1000, 10), (2000, 15), (3000, 12)])
+        self.assertEqual(history.getHistory('SECTOR', (0, 0), 'mil'),
+                         [(1000, 5), (3000, 2)])
+        self.assertEqual(history.getHistory('SECTOR', (2, 0), 'civ'),
+                         [(1000, 20), (3000, 30)])
+        # Only changed integer fields are stored.
+        fields = history.getFields('SECTOR', (0, 0))
+        fields.sort()
+        self.assertEqual(fields, ['civ', 'mil'])
+        self.assertEqual(history.getHistory('SECTOR', (4, 0), 'civ'), [])
+
+    def testPreviousValue(self):
+        self.dump(1000, 0, [sectorRow(0, 0, civ=10)])
+        # A value that was not seen by the history.
+        empDb.DBIO.history.stop()
+        empDb.megaDB['SECTOR'].updates([sectorRow(0, 0, civ=10, mil=7)])
+        empDb.DBIO.history.start()
+        self.dump(3000, 2000, [sectorRow(0, 0, civ=10, mil=9)])
+        # The field had no history yet - its old value is stored at the
+        # time of the previous dump.
+        self.assertEqual(empDb.megaDB['history'].getHistory(
+            'SECTOR', (0, 0), 'mil'), [(2000, 7), (3000, 9)])
+
+    def testRetention(self):
+        history = empDb.megaDB['history']
+        for i in range(60):
+            self.dump(1000 + i*100, 0, [sectorRow(0, 0, civ=i*3)])
+        list = history.getHistory('SECTOR', (0, 0), 'civ')
+        self.assertEqual(len(list), history.retention)
+        self.assertEqual(list, map(lambda i: (1000 + i*100, i*3),
+                                   range(60 - history.retention, 60)))
+
+    def testMaxAge(self):
+        history = empDb.megaDB['history']
+        history.maxAge = 450
+        for i in range(10):
+            self.dump(1000 + i*100, 0, [sectorRow(0, 0, civ=i)])
+        self.assertEqual(history.getHistory('SECTOR', (0, 0), 'civ'),
+                         map(lambda i: (1000 + i*100, i), range(5, 10)))
+
+    def testPickle(self):
+        for i in range(5):
+            self.dump(1000 + i*100, 0, [sectorRow(0, 0, civ=i, mil=-i),
+                                        sectorRow(2, 0, civ=i*i)])
+        history = empDb.megaDB['history']
+        copy = cPickle.loads(cPickle.dumps(history, 1))
+        for key, field in (((0, 0), 'civ'), ((0, 0), 'mil'),
+                           ((2, 0), 'civ')):
+            self.assertEqual(copy.getHistory('SECTOR', key, field),
+                             history.getHistory('SECTOR', key, field))
+        self.assertEqual(copy.retention, history.retention)
+        # The copy can record new values.
+        copy.record('SECTOR', 2000, 0, {(0, 0): {'civ': (4, 9)}})
+        self.assertEqual(copy.getHistory('SECTOR', (0, 0), 'civ')[-2:],
+                         [(1400, 4), (2000, 9)])
+
+class AutoSaveTest(testutil.DatabaseTest):
+    """Background saves (DatabaseSaver.checkAutoSave())."""
+
+    def setUp(self):
+        testutil.DatabaseTest.setUp(self)
+        empDb.DBIO.load(self.path("EmpDB"))
+        empDb.DBIO.needSave = 1
+
+    def autoSave(self):
+        """Run checkAutoSave() as if the interval had passed."""
+        empDb.DBIO.lastSave = 0
+        empDb.DBIO.checkAutoSave()
+        empDb.DBIO.waitSave()
+
+    def written(self):
+        """Return true if the database file was written since the last call."""
+        filename = self.path("EmpDB")
+        if not os.path.exists(filename):
+            return 0
+        written = os.path.getmtime(filename) != 1000
+        # Make sure a later write gives a different modification time.
+        os.utime(filename, (1000, 1000))
+        return written
+
+    def testSaveWhenChanged(self):
+        self.autoSave()
+        self.failUnless(self.written())
+        empDb.megaDB['SECTOR'].updates([sectorRow(0, 0, civ=10)])
+        self.autoSave()
+        self.failUnless(self.written())
+
+    def testNoSaveWhenUnchanged(self):
+        empDb.megaDB['SECTOR'].updates([sectorRow(0, 0, civ=10)])
+        self.autoSave()
+        self.failUnless(self.written())
+        empDb.megaDB['SECTOR'].updates([sectorRow(0, 0, civ=10)])
+        self.autoSave()
+        empDb.DBIO.save()
+        self.failIf(self.written())
+
+    def testStateChangeSaved(self):
+        self.autoSave()
+        self.failUnless(self.written())
+        empDb.megaDB['nation']['capital'] = (2, 4)
+        self.autoSave()
+        self.failUnless(self.written())
+
+    def testNoSaveAfterLoad(self):
+        empDb.megaDB['SECTOR'].updates([sectorRow(0, 0, civ=10)])
+        empDb.DBIO.save()
+        self.failUnless(self.written())
+        empDb.DBIO.load(self.path("EmpDB"))
+        empDb.DBIO.needSave = 1
+        self.assertEqual(empDb.megaDB['SECTOR'][(0, 0)]['civ'], 10)
+        self.autoSave()
+        self.failIf(self.written())
+
+class SegmentTest(testutil.DatabaseTest):
+    """The segmented database file and lazy loading (lazyDB)."""
+
+    def setUp(self):
+        testutil.DatabaseTest.setUp(self)
+        empDb.megaDB['SECTOR'].updates([sectorRow(0, 0, owner=-1)])
+        empDb.megaDB['SHIPS'].updates([
+            {'id': 3, 'x': 2, 'y': 0, 'owner': -1, 'type': "cs"},
+            {'id': 4, 'x': 40, 'y': 20, 'owner': 2, 'type': "dd"}])
+        empDb.megaDB['nation']['capital'] = (0, 0)
+        empDb.DBIO.needSave = 1
+        empDb.DBIO.save()
+
+    def reload(self):
+        empDb.DBIO.reset()
+        empDb.DBIO.load(self.path("EmpDB"))
+
+    def testLoadedOnFirstUse(self):
+        decoded = []
+        self.reload()
+        megaDB = empDb.megaDB
+        decode = megaDB.decode
+        megaDB.decode = lambda data, decode=decode, decoded=decoded: (
+            decoded.append(data) or decode(data))
+        for name in ('SECTOR', 'SHIPS', 'nation'):
+            self.failIf(megaDB.isLoaded(name), name)
+        self.assertEqual(megaDB['SHIPS'][(3,)]['type'], "cs")
+        self.assertEqual(len(decoded), 1)
+        self.failUnless(megaDB.isLoaded('SHIPS'))
+        self.failIf(megaDB.isLoaded('SECTOR'))
+        megaDB['SHIPS'].get((4,))
+        self.assertEqual(len(decoded), 1)
+        self.assertEqual(megaDB['nation']['capital'], (0, 0))
+        self.assertEqual(len(decoded), 2)
+
+    def testIndexesAndFeedReattached(self):
+        self.reload()
+        events = []
+        sub = empDb.subscribe('SHIPS', lambda dbname, changes, events=events:
+                              events.append(changes))
+        try:
+            ships = empDb.megaDB['SHIPS']
+            self.assertEqual(ships.getSec(('owner',))[(2,)].keys(), [(4,)])
+            self.assertEqual(ships.getRange(0, 4, 0, 0).keys(), [(3,)])
+            ships.updates([{'id': 3, 'mob': 5}])
+            self.failUnless(empDb.updateDB['SHIPS'].has_key((3,)))
+            empDb.flushChanges()
+            self.assertEqual(events, [{(3,): {'mob': (None, 5)}}])
+        finally:
+            empDb.unsubscribe(sub)
+
+    def testJournalReattached(self):
+        empDb.DBIO.journalMode = 1
+        self.reload()
+        empDb.megaDB['SHIPS'].updates([{'id': 3, 'mob': 5}])
+        empDb.DBIO.journal.close()
+        empDb.DBIO.journal = None
+        self.reload()
+        self.assertEqual(empDb.megaDB['SHIPS'][(3,)]['mob'], 5)
+
+class SpatialTest(testutil.DatabaseTest):
+    """Finding the items in an area (getRange() and getRadius())."""
+
+    areas = [(-4, 4, -2, 2), (0, 0, 0, 0), (10, -10, -3, 3),
+             (-3, 3, 5, -5), (14, -14, 6, -6), (-16, 15, -8, 7),
+             (15, -16, 7, -8), (-40, 40, -40, 40)]
+    circles = [((0, 0), 0), ((0, 0), 3), ((15, 7), 2), ((-16, -8), 3),
+               ((14, 0), 5), ((-15, 7), 4), ((1, 1), 8), ((0, 0), 20)]
+
+    def setUp(self):
+        testutil.DatabaseTest.setUp(self)
+        empDb.megaDB['version']['worldsize'] = (32, 16)
+
+    def fill(self, db):
+        rows = []
+        n = 0
+        for y in range(-8, 8):
+            for x in range(-16 + (y % 2), 16, 2):
+                n = n + 1
+                rows.append({'id': n, 'x': x, 'y': y})
+        db.updates(rows)
+        return db
+
+    def bruteRange(self, db, minX, maxX, minY, maxY):
+        keys = []
+        for key, row in db.items():
+            if not row.has_key('x'):
+                continue
+            if (empDb.inRange(row['x'], minX, maxX)
+                and empDb.inRange(row['y'], minY, maxY)):
+                keys.append(key)
+        keys.sort()
+        return keys
+
+    def bruteRadius(self, db, coord, dist):
+        keys = []
+        for key, row in db.items():
+            if not row.has_key('x'):
+                continue
+            if empDb.sectorDistance(coord, (row['x'], row['y'])) <= dist:
+                keys.append(key)
+        keys.sort()
+        return keys
+
+    def sortedKeys(self, dict):
+        keys = dict.keys()
+        keys.sort()
+        return keys
+
+    def checkDB(self, db):
+        for area in self.areas:
+            self.assertEqual(self.sortedKeys(apply(db.getRange, area)),
+                             apply(self.bruteRange, (db,) + area), area)
+        for coord, dist in self.circles:
+            self.assertEqual(self.sortedKeys(db.getRadius(coord, dist)),
+                             self.bruteRadius(db, coord, dist),
+                             (coord, dist))
+
+    def testSpatialIndex(self):
+        db = empDb.dictDB(('id',))
+        db.addSpatialIndex()
+        self.checkDB(self.fill(db))
+
+    def testNoIndex(self):
+        self.checkDB(self.fill(empDb.dictDB(('id',))))
+
+    def testIndexAfterUpdates(self):
+        db = self.fill(empDb.dictDB(('id',)))
+        db.addSpatialIndex()
+        # Move some items (and drop one) after the index was built.
+        db.updates([{'id': 1, 'x': 14, 'y': 6}, {'id': 2, 'x': None},
+                    {'id': 3, 'x': -1, 'y': -7}])
+        self.checkDB(db)
+
+    def testColumnDB(self):
+        empDb.DBIO.sectorClass = empDb.columnDB
+        empDb.DBIO.reset()
+        empDb.megaDB['version']['worldsize'] = (32, 16)
+        db = empDb.megaDB['SECTOR']
+        db.updates(map(lambda row: sectorRow(row['x'], row['y']),
+                       self.fill(empDb.dictDB(('id',))).values()))
+        self.checkDB(db)
+
+class CountriesTest(testutil.DatabaseTest):
+    """Resolving country names (Countries)."""
+
+    def checkResolve(self, dbname, key, row):
+        db = empDb.megaDB[dbname]
+        countries = empDb.megaDB['countries']
+        row['owner'] = countries.resolveName("Foo", dbname, key)
+        db.updates([row])
+        self.assertEqual(db[key]['owner'], "Foo")
+        countries.resolveNameId("Foo", 7)
+        self.assertEqual(db[key]['owner'], 7)
+        owners = db.getSec(('owner',))
+        self.failIf(owners.has_key(("Foo",)))
+        self.assertEqual(owners[(7,)].keys(), [key])
+        # A later update must find the item in the right index entry.
+        row['owner'] = 8
+        db.updates([row])
+        self.failIf(owners.has_key((7,)))
+        self.assertEqual(owners[(8,)].keys(), [key])
+
+    def testResolveShip(self):
+        self.checkResolve('SHIPS', (3,), {'id': 3, 'x': 1, 'y': 1})
+
+    def testResolveSector(self):
+        self.checkResolve('SECTOR', (2, 4), sectorRow(2, 4, des="+"))
+
+    def testResolveColumnSector(self):
+        empDb.DBIO.sectorClass = empDb.columnDB
+        empDb.DBIO.reset()
+        self.checkResolve('SECTOR', (2, 4), sectorRow(2, 4, des="+"))
+
+class TableTest(unittest.TestCase):
+    """The binary table format (encodeTable() and decodeTable())."""
+
+    def roundTrip(self, db):
+        """Encode and decode DB and check that nothing was lost."""
+        copy = empDb.decodeTable(empDb.encodeTable(db))
+        self.assertEqual(copy.__class__, db.__class__)
+        self.assertEqual(copy.timestamp, db.timestamp)
+        items = db.items()
+        items.sort()
+        copyItems = copy.items()
+        copyItems.sort()
+        self.assertEqual(len(copyItems), len(items))
+        for (key, row), (copyKey, copyRow) in map(None, items, copyItems):
+            self.assertEqual(copyKey, key)
+            self.assertEqual(dict(copyRow.items()), dict(row.items()))
+            for field, value in row.items():
+                self.assertEqual(type(copyRow[field]), type(value))
+        return copy
+
+    def testMixedTypes(self):
+        db = empDb.dictDB(('id',), ('owner',))
+        db.updates([
+            {'id': 0, 'owner': 1, 'type': "cs", 'eff': 100, 'mob': 1.5,
+             'cargo': 7, 'big': 1 << 40, 'path': (1, 2)},
+            {'id': 1, 'owner': 2, 'type': "dd", 'eff': -3, 'mob': 0.25,
+             'cargo': "lots", 'big': -1, 'path': "jjuu"},
+            {'id': 2, 'owner': 300000, 'type': "", 'eff': 200000,
+             'mob': -2.0, 'cargo': 2.5, 'big': 5L, 'path': None},
+            ])
+        db.setTimestamp(1234)
+        copy = self.roundTrip(db)
+        self.assertEqual(copy.getSec(('owner',))[(2,)].keys(), [(1,)])
+
+    def testMissingValues(self):
+        db = empDb.dictDB(('id',))
+        rows = []
+        for i in range(200):
+            row = {'id': i, 'name': "n%d" % (i % 7)}
+            if i % 3:
+                row['civ'] = i
+            if i % 5 == 0:
+                row['mob'] = i / 4.0
+            if i == 150:
+                row['rare'] = "only"
+            rows.append(row)
+        db.updates(rows)
+        self.roundTrip(db)
+
+    def testEmptyTable(self):
+        self.roundTrip(empDb.dictDB(('id',)))
+        self.roundTrip(empDb.columnDB(('x', 'y')))
+
+    def testColumnDB(self):
+        db = empDb.columnDB(('x', 'y'), ('owner',))
+        rows = []
+        for x in range(-20, 20, 2):
+            for y in range(-10, 10):
+                row = sectorRow(x, y, owner=(x + y) % 4, des="-+^"[y % 3])
+                if y % 2:
+                    row['civ'] = x * y
+                if x == 0:
+                    row['comment'] = ["odd", x, y]
+                rows.append(row)
+        db.updates(rows)
+        copy = self.roundTrip(db)
+        self.assertEqual(len(copy.getSec(('owner',))[(3,)]),
+                         len(db.getSec(('owner',))[(3,)]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,188 @@
+"""Tests of the query evaluation (src/empEval.py)."""
+
+#    Copyright (C) 1998-1999 Kevin O'Connor
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import unittest
+
+import testutil
+from testutil import sectorRow
+
+import empDb
+import empEval
+import empVector
+
+def rowEnvironment(dbname, row):
+    """Return the selectors of ROW as a dictionary of plain values.
+
+    This is how the selectors were bound before queries were compiled: a
+    selector that the item doesn't have is simply missing, so an
+    expression that uses it raises NameError.
+    """
+    env = {}
+    for name, target in empEval.selectors[dbname].items():
+        if type(target) == type(""):
+            if row.has_key(target):
+                env[name] = row[target]
+        elif isinstance(target, empEval.rowFunction):
+            env[name] = target.bind(row)
+        else:
+            try:
+                env[name] = target(row)
+            except KeyError:
+                pass
+    return env
+
+def referenceForeach(dbname, cond, output):
+    """Evaluate COND and OUTPUT on every item - the reference results."""
+    items = empDb.megaDB[dbname].items()
+    items.sort()
+    result = []
+    for key, row in items:
+        env = rowEnvironment(dbname, row)
+        env['__db'] = (key, row)
+        try:
+            if eval(cond, env):
+                result.append(eval(output, env))
+        except NameError:
+            pass
+    return result
+
+# Conditions for the sector database, as (range, selectors) pairs for
+# selectToExpr() or as python expressions.
+sectorQueries = [
+    ('*', ''),
+    ('*', 'civ>100'),
+    ('0:10,-4:4', 'des=g&mob>20'),
+    ('-6:-2,0:2', ''),
+    ('@2,0:3', 'newdes=+'),
+    ('@-4,2:2', 'owner=3'),
+    ('#1', 'gold>0'),
+    ('*', 'newdes=m'),
+    ('*', 'des=c&civ<mil'),
+    ('*', 'sdes#_'),
+    "owner==-1 and des=='+'",
+    "owner==-1 and __area(-8,8,-4,4) and food<civ/10",
+    "des=='+' or civ>500",
+    "distance(0,0)<5 and owner==-1",
+    "sect=='2,0'",
+    "gold>2 and owner==0",
+    "owner==3 and des=='g' and __circle(0,0,6)",
+    "dist=='1,1' and mob>=0",
+    ]
+
+class QueryTest(testutil.DatabaseTest):
+    """Compiled and planned queries give the same results as evaluating
+    the expression on every item."""
+
+    def setUp(self):
+        testutil.DatabaseTest.setUp(self)
+        self.enabled = empVector.enabled
+        self.minItems = empVector.minItems
+
+    def tearDown(self):
+        empVector.enabled = self.enabled
+        empVector.minItems = self.minItems
+        empVector.snapshots.clear()
+        empEval.queryCache.clear()
+        testutil.DatabaseTest.tearDown(self)
+
+    def fillSectors(self):
+        empDb.megaDB['realm'][1] = (-4, 4, -2, 2)
+        rows = []
+        n = 0
+        for y in range(-4, 5):
+            for x in range(-8 + (y % 2), 9, 2):
+                n = n + 1
+                row = sectorRow(x, y, owner=(-1, -1, 0, 3)[n % 4],
+                                des="g+mc^"[n % 5], sdes="_m_"[n % 3],
+                                civ=(n * 37) % 600, mil=(n * 11) % 90,
+                                food=(n * 7) % 40, mob=(n * 13) % 128,
+                                eff=(n * 17) % 101, dist_x=n % 2,
+                                dist_y=1)
+                if n % 3:
+                    row['gold'] = n % 7
+                rows.append(row)
+        empDb.megaDB['SECTOR'].updates(rows)
+
+    def conditions(self):
+        conditions = []
+        for query in sectorQueries:
+            if type(query) == type(()):
+                query = apply(empEval.selectToExpr, ('SECTOR',) + query)
+            conditions.append(query)
+        return conditions
+
+    def checkSectors(self):
+        outputs = ["__db[0]", empEval.estrToExpr("[sect] [civ/2] [newdes]")]
+        for cond in self.conditions():
+            self.assertEqual(empEval.getSectors(cond, 'SECTOR'),
+                             referenceForeach('SECTOR', cond, "__db[0]"),
+                             cond)
+            for output in outputs:
+                self.assertEqual(empEval.foreach(cond, output, 'SECTOR'),
+                                 referenceForeach('SECTOR', cond, output),
+                                 cond)
+
+    def testSectors(self):
+        empVector.enabled = 0
+        self.fillSectors()
+        self.checkSectors()
+
+    def testColumnSectors(self):
+        empVector.enabled = 0
+        empDb.DBIO.sectorClass = empDb.columnDB
+        empDb.DBIO.reset()
+        self.fillSectors()
+        self.checkSectors()
+
+    def testVectorSectors(self):
+        if empVector.numpy is None:
+            return
+        empVector.minItems = 0
+        self.fillSectors()
+        self.checkSectors()
+
+    def testIndexesUsed(self):
+        empVector.enabled = 0
+        self.fillSectors()
+        for cond in ("owner==-1 and des=='+'", "__circle(0,0,2)",
+                     empEval.selectToExpr('SECTOR', '0:4,0:2', '')):
+            self.failIfEqual(empEval.QueryPlan('SECTOR', cond).access,
+                             None, cond)
+
+    def testShips(self):
+        ships = []
+        for i in range(40):
+            ship = {'id': i, 'x': (i % 8) * 2, 'y': 0,
+                    'owner': (-1, 0)[i % 2], 'type': ("cs", "dd")[i % 3 == 0],
+                    'eff': (i * 9) % 101, 'mob': i}
+            if i % 4:
+                ship['flt'] = "abc"[i % 3]
+            ships.append(ship)
+        empDb.megaDB['SHIPS'].updates(ships)
+        for cond in ("owner==-1 and type=='cs'", "fleet=='a' or eff<20",
+                     "__circle(4,0,2) and mob>10", "group=='b'",
+                     empEval.selectToExpr('SHIPS', '*', 'type=dd&eff>50')):
+            self.assertEqual(empEval.getSectors(cond, 'SHIPS'),
+                             referenceForeach('SHIPS', cond, "__db[0]"),
+                             cond)
+            output = empEval.estrToExpr("[uid]/[type]")
+            self.assertEqual(empEval.foreach(cond, output, 'SHIPS'),
+                             referenceForeach('SHIPS', cond, output), cond)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+"""Tests of the server output parsers (src/empParse.py)."""
+
+#    Copyright (C) 1998-1999 Kevin O'Connor
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import unittest
+
+import testutil
+from testutil import sectorRow
+
+import empDb
+import empParse
+
+class Output:
+    """A viewer that ignores the parsed output."""
+    def Begin(self, cmd):
+        pass
+    def data(self, msg):
+        pass
+    def End(self, cmd):
+        pass
+
+class DumpTest(testutil.DatabaseTest):
+    """Parsing dump output (ParseDump)."""
+
+    def parse(self, cmd, lines):
+        """Send the server output LINES of command CMD to ParseDump."""
+        parser = empParse.ParseDump(Output())
+        parser.Begin(cmd)
+        map(parser.data, lines)
+        parser.End(cmd)
+
+    def testShipDump(self):
+        self.parse("dump *", [
+            "DUMP SHIPS 1000",
+            "id type x y flt eff name",
+            "3 cs 1 1 a 100 \"Old Salt\"",
+            "4 dd -1 1 ~ 55 \"12\"",
+            "2 ships"])
+        ships = empDb.megaDB['SHIPS']
+        self.assertEqual(ships[(3,)]['type'], "cs")
+        self.assertEqual(ships[(3,)]['name'], "Old Salt")
+        self.assertEqual(ships[(4,)]['name'], "12")
+        self.assertEqual(ships[(4,)]['eff'], 55)
+        self.assertEqual(ships[(4,)]['owner'], empDb.CN_OWNED)
+
+    def sectorDump(self, coords):
+        """Return the output of a sector dump reporting COORDS."""
+        lines = ["DUMP SECTOR 1000", "x y des civ"]
+        for x, y in coords:
+            lines.append("%d %d + %d" % (x, y, x*10 + y))
+        lines.append("%d sectors" % len(coords))
+        return lines
+
+    def testLongDump(self):
+        coords = []
+        for i in range(600):
+            coords.append((i*2 % 100, i*2 / 100))
+        lines = self.sectorDump(coords)
+        parser = empParse.ParseDump(Output())
+        parser.Begin("dump *")
+        map(parser.data, lines[:parser.chunkSize + 2])
+        # The first chunk is applied before the dump completes.
+        sectors = empDb.megaDB['SECTOR']
+        self.assertEqual(len(sectors.keys()), parser.chunkSize)
+        map(parser.data, lines[parser.chunkSize + 2:])
+        parser.End("dump *")
+        self.assertEqual(len(sectors.keys()), 600)
+        for x, y in coords:
+            self.assertEqual(sectors[(x, y)]['civ'], x*10 + y)
+            self.assertEqual(sectors[(x, y)]['owner'], empDb.CN_OWNED)
+        self.assertEqual(sectors.timestamp, 999)
+
+    def testFullDumpUnseen(self):
+        empDb.megaDB['SECTOR'].updates([
+            sectorRow(2, 4, owner=empDb.CN_OWNED, des="+"),
+            sectorRow(4, 4, owner=empDb.CN_OWNED, des="+")])
+        # A partial dump doesn't tell which sectors were lost.
+        self.parse("dump 4,4", self.sectorDump([(4, 4)]))
+        self.assertEqual(empDb.megaDB['SECTOR'][(2, 4)]['owner'],
+                         empDb.CN_OWNED)
+        self.parse("dump *", self.sectorDump([(4, 4), (6, 4)]))
+        sectors = empDb.megaDB['SECTOR']
+        self.assertEqual(sectors[(2, 4)]['owner'], empDb.CN_UNOWNED)
+        self.assertEqual(sectors[(4, 4)]['owner'], empDb.CN_OWNED)
+        self.assertEqual(sectors[(6, 4)]['owner'], empDb.CN_OWNED)
+
+    def testLostDump(self):
+        empDb.megaDB['SECTOR'].updates([
+            sectorRow(2, 4, owner=empDb.CN_OWNED, des="+")])
+        empDb.megaDB['SHIPS'].updates([
+            {'id': 3, 'x': 1, 'y': 1, 'owner': empDb.CN_OWNED}])
+        self.parse("lost *", [
+            "DUMP LOST ITEMS 1000",
+            "type id x y timestamp",
+            "0 0 2 4 990",
+            "1 3 1 1 995",
+            "2 lost items"])
+        lost = empDb.megaDB['LOST ITEMS']
+        self.assertEqual(len(lost.keys()), 2)
+        self.failUnless(lost.has_key((1, 3, 1, 1)))
+        self.assertEqual(empDb.megaDB['SECTOR'][(2, 4)]['owner'],
+                         empDb.CN_UNOWNED)
+        self.assertEqual(empDb.megaDB['SHIPS'][(3,)]['owner'],
+                         empDb.CN_UNOWNED)
+
+if __name__ == '__main__':
+    unittest.main()
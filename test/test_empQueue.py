@@ -0,0 +1,271 @@
+"""Tests of the command queue (src/empQueue.py)."""
+
+#    Copyright (C) 1998-1999 Kevin O'Connor
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import random
+import select
+import socket
+import string
+import unittest
+
+import testutil
+
+import empQueue
+
+class CommandQueueTest(unittest.TestCase):
+    """The offset list of queued commands (CommandQueue)."""
+
+    def checkCompact(self, queue):
+        """Make sure the unused front of QUEUE has been released."""
+        self.failUnless(len(queue.items)
+                        <= max(len(queue) + 64, len(queue) * 2))
+
+    def testSendAndRemove(self):
+        queue = empQueue.CommandQueue()
+        next = 0
+        done = 0
+        for i in range(50):
+            # Queue a batch of commands, and complete most of them.
+            for j in range(100):
+                queue.insert(len(queue), next)
+                next = next + 1
+            for j in range(90):
+                self.assertEqual(queue[0], done)
+                del queue[0]
+                done = done + 1
+                self.checkCompact(queue)
+            self.assertEqual(queue[:], range(done, next))
+            self.assertEqual(queue[-1], next - 1)
+        # Complete the rest.
+        while len(queue):
+            del queue[:3]
+            self.checkCompact(queue)
+        self.assertEqual(queue.items, [])
+        self.assertEqual(queue.head, 0)
+
+    def testListOperations(self):
+        # The queue behaves like a list when modified at any position.
+        rand = random.Random(1)
+        queue = empQueue.CommandQueue()
+        list = []
+        for i in range(3000):
+            op = rand.randrange(6)
+            pos = rand.randrange(len(list) + 1)
+            if op <= 2 or not list:
+                queue.insert(pos, i)
+                list.insert(pos, i)
+            elif op == 3:
+                del queue[0]
+                del list[0]
+            elif op == 4:
+                del queue[pos:pos + 2]
+                del list[pos:pos + 2]
+            else:
+                # Put commands back at the front of the queue.
+                queue[:0] = [i, -i]
+                list[:0] = [i, -i]
+            self.assertEqual(len(queue), len(list))
+        self.assertEqual(queue[:], list)
+        self.assertEqual(queue[5:len(list) + 10], list[5:])
+        del queue[5:]
+        self.assertEqual(queue[:], list[:5])
+
+class Handler:
+    """A queued command that stores the lines it receives."""
+    def __init__(self, command, pre=empQueue.QU_SYNC):
+        self.command = command
+        self.out = None
+        self.sending = None
+        self.preFlags = self.postFlags = pre
+        self.pipelined = empQueue.isPipelined(command)
+        self.coalesceKey = empQueue.coalesceKey(command)
+        self.lines = []
+    def start(self):
+        pass
+    def line(self, line):
+        self.lines.append(line)
+    def lull(self):
+        pass
+
+class Async:
+    """A handler of asynchronous data that stores the lines it receives."""
+    def __init__(self):
+        self.lines = []
+    def line(self, line):
+        self.lines.append(line)
+    def lull(self):
+        pass
+
+class QueueTest(unittest.TestCase):
+    """A connected queue, with the test acting as the server."""
+
+    def setUp(self):
+        self.server, client = socket.socketpair()
+        self.queue = empQueue.EmpIOQueue(Async(), None)
+        self.queue.socket = client
+        self.queue.flags = empQueue.QU_BURST
+        self.received = ""
+
+    def tearDown(self):
+        self.server.close()
+        self.queue.socket.close()
+
+    def add(self, *commands):
+        """Queue COMMANDS; return their handlers."""
+        list = []
+        for command in commands:
+            handler = Handler(command)
+            self.queue.AddHandler(handler)
+            list.append(handler)
+        return list
+
+    def sent(self):
+        """Return the commands the server has received."""
+        while select.select([self.server], [], [], 0)[0]:
+            self.received = self.received + self.server.recv(4096)
+        return string.split(self.received, "\n")[:-1]
+
+    def reply(self, *lines):
+        """Send LINES to the client and let the queue process them."""
+        self.server.sendall(string.join(lines, "\n") + "\n")
+        self.queue.HandleInput()
+
+    def replyEach(self, *lines):
+        """Send LINES to the client one at a time.
+
+        (In QU_SYNC mode, HandleInput() stops after each line with a
+        string exception when more lines are buffered - those can't be
+        raised by newer Pythons.)
+        """
+        for line in lines:
+            self.reply(line)
+
+class PipelineTest(QueueTest):
+    """Sending several sub-prompt free commands at once (pipelineDepth)."""
+
+    def testDepthLimit(self):
+        commands = map(lambda i: "dump * ?id=%d" % i, range(7))
+        apply(self.add, commands)
+        depth = self.queue.pipelineDepth
+        self.assertEqual(self.sent(), commands[:depth])
+        # Each prompt lets one more command out.
+        self.replyEach("1 one", "6 0 100")
+        self.assertEqual(self.sent(), commands[:depth + 1])
+        self.replyEach("6 0 100", "6 0 100")
+        self.assertEqual(self.sent(), commands)
+        self.assertEqual(self.queue.FLSentLev - self.queue.FLWaitLev, depth)
+
+    def testNoDepth(self):
+        self.queue.pipelineDepth = 1
+        self.add("dump *", "lost *", "nat")
+        self.assertEqual(self.sent(), ["dump *"])
+        self.replyEach("6 0 100")
+        self.assertEqual(self.sent(), ["dump *", "lost *"])
+
+    def testSubPromptNotPipelined(self):
+        # Nothing is sent while a command that can prompt is waiting.
+        self.add("build ship", "dump *", "nat")
+        self.failIf(self.queue.FuncList[0].pipelined)
+        self.assertEqual(self.sent(), ["build ship"])
+        self.replyEach("4 Ship type?")
+        self.assertEqual(self.sent(), ["build ship"])
+        self.replyEach("6 0 100")
+        self.assertEqual(self.sent(), ["build ship", "dump *", "nat"])
+        # A command that can prompt waits for the commands before it ...
+        self.add("move c 1,1")
+        self.assertEqual(self.sent(), ["build ship", "dump *", "nat",
+                                       "move c 1,1"])
+        # ... and holds back the commands after it.
+        self.add("lost *")
+        self.replyEach("6 0 100", "6 0 100")
+        self.assertEqual(self.sent()[-1], "move c 1,1")
+        self.replyEach("6 0 100")
+        self.assertEqual(self.sent()[-1], "lost *")
+
+    def testOutputMatched(self):
+        handlers = self.add("dump *", "lost *", "nat", "cen *")
+        self.assertEqual(len(self.sent()), 4)
+        # All the output arrives at once.
+        self.reply("1 dump", "1 data", "6 0 100",
+                   "1 lost", "6 0 99",
+                   "6 0 98",
+                   "1 census", "6 0 97")
+        self.assertEqual(map(lambda h: h.lines, handlers),
+                         [["1 dump", "1 data", "6 0 100"],
+                          ["1 lost", "6 0 99"],
+                          ["6 0 98"],
+                          ["1 census", "6 0 97"]])
+        self.assertEqual(len(self.queue.FuncList), 0)
+        self.assertEqual(self.queue.FLSentLev, 0)
+        self.assertEqual(self.queue.FLWaitLev, 0)
+        self.assertEqual(self.queue.defParser.lines, [])
+
+class CoalesceTest(QueueTest):
+    """Dropping duplicate queued commands (coalesceHandler)."""
+
+    def queued(self):
+        """Return the commands that have not been sent."""
+        queue = self.queue
+        return map(lambda h: h.command, queue.FuncList[queue.FLSentLev:])
+
+    def testAdjacentMerged(self):
+        # The commands wait behind a command that can prompt.
+        self.add("build ship")
+        self.add("thr food 3,5 50", "thr  food 3,5 60")
+        self.assertEqual(self.queued(), ["thr  food 3,5 60"])
+        self.add("nat", "cen *", "nat", "nat")
+        self.assertEqual(self.queued(), ["thr  food 3,5 60", "nat", "cen *",
+                                         "nat"])
+        self.replyEach("6 0 100")
+        self.assertEqual(self.sent(), ["build ship", "thr  food 3,5 60",
+                                       "nat", "cen *", "nat"])
+
+    def testStateChangeBetween(self):
+        self.add("build ship")
+        self.add("thr food 3,5 50", "des 3,5 +", "thr food 3,5 70")
+        self.add("cen 3,5", "des 3,5 m", "cen 3,5")
+        self.assertEqual(self.queued(), ["thr food 3,5 50", "des 3,5 +",
+                                         "thr food 3,5 70", "cen 3,5",
+                                         "des 3,5 m", "cen 3,5"])
+
+    def testSentNotMerged(self):
+        self.add("build ship")
+        self.replyEach("6 0 100")
+        self.add("nat", "nat")
+        # The first command was sent - only an unsent command is dropped.
+        self.assertEqual(self.sent(), ["build ship", "nat", "nat"])
+        self.assertEqual(len(self.queue.FuncList), 2)
+
+    def testNotMerged(self):
+        self.add("build ship")
+        # Output to different displays.
+        handler = Handler("nat")
+        handler.out = 1
+        self.queue.AddHandler(handler)
+        self.add("nat")
+        # Commands that need the queue to themselves.
+        handler = Handler("nat", empQueue.QU_FULLSYNC)
+        self.queue.AddHandler(handler)
+        self.add("nat")
+        self.assertEqual(self.queued(), ["nat", "nat", "nat", "nat"])
+        # Coalescing can be disabled.
+        self.queue.coalesce = 0
+        self.add("nat")
+        self.assertEqual(len(self.queued()), 5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+"""Tests of the NumPy query engine (src/empVector.py)."""
+
+#    Copyright (C) 1998-1999 Kevin O'Connor
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import unittest
+
+import testutil
+from testutil import sectorRow
+
+import empDb
+import empEval
+import empVector
+
+queries = [
+    "1",
+    "civ>100",
+    "owner==-1 and des=='g'",
+    "__area(-4,4,-2,2) and mob>=20",
+    "__circle(2,0,3) and newdes=='+'",
+    "gold>2 and civ<mil*10",
+    "sdes!='_' or civ==0",
+    ]
+
+class EngineTest(testutil.DatabaseTest):
+    """The vector and row engines give the same results.
+
+    The tests do nothing if NumPy isn't installed.
+    """
+
+    def setUp(self):
+        testutil.DatabaseTest.setUp(self)
+        self.enabled = empVector.enabled
+        self.minItems = empVector.minItems
+        empVector.minItems = 0
+
+    def tearDown(self):
+        empVector.enabled = self.enabled
+        empVector.minItems = self.minItems
+        empVector.snapshots.clear()
+        testutil.DatabaseTest.tearDown(self)
+
+    def fillSectors(self):
+        rows = []
+        n = 0
+        for y in range(-4, 5):
+            for x in range(-8 + (y % 2), 9, 2):
+                n = n + 1
+                row = sectorRow(x, y, owner=(-1, -1, 0, 3)[n % 4],
+                                des="g+mc"[n % 4], sdes="_m_"[n % 3],
+                                civ=(n * 37) % 600, mil=(n * 11) % 90,
+                                mob=(n * 13) % 128)
+                if n % 3:
+                    row['gold'] = n % 7
+                rows.append(row)
+        empDb.megaDB['SECTOR'].updates(rows)
+
+    def results(self, enabled):
+        """Return the results of every query with one of the engines."""
+        empVector.enabled = enabled
+        results = []
+        for query in queries:
+            results.append(empEval.getSectors(query, 'SECTOR'))
+            results.append(empEval.tally(query, ['civ', 'gold'], 'des',
+                                         'SECTOR'))
+        return results
+
+    def checkEngines(self):
+        self.assertEqual(self.results(1), self.results(0))
+
+    def checkChanges(self):
+        self.fillSectors()
+        self.checkEngines()
+        db = empDb.megaDB['SECTOR']
+        db.updates([sectorRow(0, 0, civ=900, gold=None),
+                    sectorRow(2, 0, des="^", gold=1.5),
+                    sectorRow(-2, 2, mob="x"),
+                    sectorRow(20, 0, owner=-1, des="g", civ=5)])
+        self.checkEngines()
+
+    def testDictDB(self):
+        if empVector.numpy is None:
+            return
+        self.checkChanges()
+
+    def testColumnDB(self):
+        if empVector.numpy is None:
+            return
+        empDb.DBIO.sectorClass = empDb.columnDB
+        empDb.DBIO.reset()
+        self.checkChanges()
+
+    def testWriteWithoutUpdates(self):
+        if empVector.numpy is None:
+            return
+        empDb.DBIO.sectorClass = empDb.columnDB
+        empDb.DBIO.reset()
+        self.fillSectors()
+        self.checkEngines()
+        # A columnRow writes straight to the columns, bypassing the
+        # change feed.
+        empDb.megaDB['SECTOR'][(4, 0)]['civ'] = 950
+        empVector.enabled = 1
+        self.failUnless((4, 0) in empEval.getSectors("civ>900", 'SECTOR'))
+        self.checkEngines()
+
+if __name__ == '__main__':
+    unittest.main()
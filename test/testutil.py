@@ -0,0 +1,66 @@
+"""Helpers shared by the PTkEI unit tests."""
+
+#    Copyright (C) 1998-1999 Kevin O'Connor
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import sys
+import os
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'src'))
+
+import empDb
+
+class DatabaseTest(unittest.TestCase):
+    """A test that starts with a new, empty database.
+
+    The settings of empDb.DBIO are restored after each test, and a
+    temporary directory (self.dir) is removed.
+    """
+    settings = ('journalMode', 'sectorClass', 'historyMode',
+                'autoSaveInterval')
+
+    def setUp(self):
+        self.saved = {}
+        for name in self.settings:
+            self.saved[name] = getattr(empDb.DBIO, name)
+        self.dir = tempfile.mkdtemp()
+        empDb.DBIO.filename = self.path("EmpDB")
+        empDb.DBIO.reset()
+
+    def tearDown(self):
+        DBIO = empDb.DBIO
+        DBIO.waitSave()
+        if DBIO.journal is not None:
+            DBIO.journal.close()
+            DBIO.journal = None
+        for name, value in self.saved.items():
+            setattr(DBIO, name, value)
+        DBIO.reset()
+        shutil.rmtree(self.dir)
+
+    def path(self, name):
+        """Return the name of a file in the temporary directory."""
+        return os.path.join(self.dir, name)
+
+def sectorRow(x, y, **fields):
+    """Return a sector dictionary as made by the dump parser."""
+    row = {'x': x, 'y': y}
+    row.update(fields)
+    return row